@@ -1,575 +1,6363 @@
 import os
 import json
+import math
+import zlib
 import logging
 import uuid
 import tempfile
 import subprocess
 import re
+import time
+import heapq
+import bisect
+import difflib
+import random
+import signal
+import atexit
+import shutil
+import copy
+import hashlib
+import threading
+import contextlib
+import contextvars
+import weakref
 import requests
-from typing import Dict, List, Optional, Tuple, Any
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, Tuple, Any
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.resource import ResourceManagementClient
 from azure.core.exceptions import ResourceNotFoundError
 import anthropic
+from claude_terraform_store import SessionStore, MemorySessionStore, ArtifactStore, create_session_store
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class ConversationalAgent:
+class StageTimings:
     """
-    Handles conversations with users and interprets their intents for cloud infrastructure operations.
-    Uses Claude AI for model inference.
+    Collects wall-clock and CPU timings per pipeline stage while a request is being profiled.
+    Collection is bound to a context variable, so unprofiled code only pays for a lookup.
     """
     
-    def __init__(self, 
-                 anthropic_api_key: Optional[str] = None,
-                 model: Optional[str] = None):
+    MAX_EVENTS = 500
+    _current: contextvars.ContextVar = contextvars.ContextVar("stage_timings", default=None)
+    
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def activate(cls) -> "StageTimings":
         """
-        Initialize the conversational agent.
+        Start collecting timings in the current context.
+        
+        Returns:
+            The collector.
+        """
+        timings = cls()
+        cls._current.set(timings)
+        return timings
+    
+    @classmethod
+    def deactivate(cls) -> None:
+        """
+        Stop collecting timings in the current context.
+        """
+        cls._current.set(None)
+    
+    @classmethod
+    @contextlib.contextmanager
+    def stage(cls, name: str):
+        """
+        Time the enclosed code as a stage of the current profiled request, if any.
         
         Args:
-            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
-            model: The Claude model to use. If None, it will use the default.
+            name: The stage name.
         """
-        # Set Anthropic configuration
-        self.api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
-        if not self.api_key:
-            raise ValueError("Anthropic API key is required. Please provide it or set ANTHROPIC_API_KEY environment variable.")
+        timings = cls._current.get()
+        if timings is None:
+            yield
+            return
         
-        self.model = model or os.getenv("ANTHROPIC_MODEL", "claude-3-sonnet-20240229")
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            timings.add(name, wall_start, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+    
+    @classmethod
+    def record(cls, name: str, wall_seconds: float, cpu_seconds: float = 0.0) -> None:
+        """
+        Record an already measured stage of the current profiled request, if any.
         
-        # Initialize Anthropic client
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+        Args:
+            name: The stage name.
+            wall_seconds: The wall-clock duration.
+            cpu_seconds: The CPU time spent by the thread.
+        """
+        timings = cls._current.get()
+        if timings is not None:
+            timings.add(name, time.perf_counter() - wall_seconds, wall_seconds, cpu_seconds)
+    
+    def add(self, name: str, wall_start: float, wall_seconds: float, cpu_seconds: float) -> None:
+        """
+        Add a stage measurement.
+        """
+        with self.lock:
+            totals = self.totals.setdefault(name, {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            totals["count"] += 1
+            totals["wall_seconds"] += wall_seconds
+            totals["cpu_seconds"] += cpu_seconds
+            if len(self.events) < self.MAX_EVENTS:
+                self.events.append({
+                    "stage": name,
+                    "start_seconds": round(wall_start - self.started_at, 4),
+                    "wall_seconds": round(wall_seconds, 4),
+                    "cpu_seconds": round(cpu_seconds, 4)
+                })
+    
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the collected timings.
         
-        self.conversation_history = []
+        Returns:
+            A dictionary with totals per stage and the individual stage events in start order.
+        """
+        with self.lock:
+            return {
+                "stages": {
+                    name: {key: round(value, 4) for key, value in totals.items()}
+                    for name, totals in sorted(self.totals.items(), key=lambda item: -item[1]["wall_seconds"])
+                },
+                "events": sorted(self.events, key=lambda event: event["start_seconds"])
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: callers using the same key while a computation is
+    in flight wait for that computation and share its result or exception.
+    """
+    
+    def __init__(self, max_workers: Optional[int] = None):
+        """
+        Initialize the single-flight group.
         
-        # Example system message to guide the model behavior
-        self.system_message = """
-        You are an AI assistant that helps users create and manage cloud infrastructure on Azure using Terraform.
-        Your task is to interpret user requests for cloud infrastructure and translate them into detailed specifications.
+        Args:
+            max_workers: Maximum number of computations running at once. If None, it will try to get from environment variable.
+        """
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("SINGLE_FLIGHT_WORKERS", "16")),
+            thread_name_prefix="single-flight"
+        )
+        self.lock = threading.Lock()
+        # Maps key -> [future, cancel event, number of waiters]
+        self.calls: Dict[str, list] = {}
+    
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """
+        Build a key from the content hash of the request parts.
         
-        Required details for any infrastructure request:
-        - Subscription Name
-        - Resource Group Name
-        - Resource Name
-        - Resource Type
-        - Location 
+        Args:
+            parts: JSON-serializable parts identifying the request.
+            
+        Returns:
+            The hex digest of the parts.
+        """
+        serialized = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    
+    def do(self, key: str, fn, timeout: Optional[float] = None,
+           cancel_check: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Run `fn` once for all concurrent callers using the same key.
         
-        When a user requests infrastructure, extract the following information:
-        1. Resource types (e.g., VMs, storage, network components)
-        2. Resource specifications (e.g., VM sizes, storage capacities)
-        3. Relationships between resources
-        4. Resource Group Name and Location
-        5. Subscription name
+        Args:
+            key: The request key.
+            fn: The computation. Called with a `threading.Event` that is set when every waiter has left,
+                so long-running work can stop early.
+            timeout: How long this caller waits, in seconds. If None, it waits until the computation finishes.
+            cancel_check: Polled while waiting. When it returns True this caller stops waiting with
+                CancelledError, cancelling the computation if nobody else waits for it.
+            
+        Returns:
+            The result of the computation.
+        """
+        started = False
+        with self.lock:
+            call = self.calls.get(key)
+            # A finished computation may not be forgotten yet, its result is not shared with later requests
+            if call is None or call[0].done():
+                cancel_event = threading.Event()
+                # Run in a copy of the caller's context so stage timings reach its profile
+                future = self.pool.submit(contextvars.copy_context().run, fn, cancel_event)
+                call = [future, cancel_event, 0]
+                self.calls[key] = call
+                started = True
+            else:
+                logger.info(f"Joining in-flight request {key[:12]}")
+            call[2] += 1
         
-        If ANY details are missing, you need to ask the user for these specific details before continuing.
+        future, cancel_event = call[0], call[1]
+        if started:
+            # Added outside the lock, the callback runs at once if the computation already finished
+            future.add_done_callback(lambda done: self._forget(key, done))
+        try:
+            if cancel_check is None:
+                return future.result(timeout=timeout)
+            
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while True:
+                if cancel_check():
+                    raise CancelledError(f"Request {key[:12]} was cancelled")
+                wait = 0.5 if deadline is None else min(0.5, max(0.0, deadline - time.monotonic()))
+                try:
+                    return future.result(timeout=wait)
+                except FutureTimeoutError:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise
+        finally:
+            with self.lock:
+                call[2] -= 1
+                if call[2] == 0 and not future.done():
+                    # The last waiter left, nobody needs the result anymore
+                    logger.info(f"Cancelling abandoned request {key[:12]}")
+                    cancel_event.set()
+                    future.cancel()
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+    
+    def _forget(self, key: str, future: Future) -> None:
+        """
+        Remove a finished computation so later requests run it again.
         
-        When you have all required information, respond with a valid JSON object containing the infrastructure specifications.
-        Format your JSON like this:
-        ```json
-        {
-          "subscription_name": "...",
-          "resource_group": "...",
-          "resource_name": "...",
-          "resource_type": "...",
-          "location": "...",
-          "additional_properties": { ... }
-        }
-        ```
+        Args:
+            key: The request key.
+            future: The finished computation.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call[0] is future:
+                del self.calls[key]
+
+class UsageBudget:
+    """
+    Token and latency budgets of the Claude calls made for each session and each tenant. Usage is read
+    from every response and charged to the session and tenant bound to the current context, so callers
+    can degrade to cheaper paths as a budget runs low instead of failing outright. Tenant usage is kept
+    in the session store, so all workers charge the same window, which expires with the window.
+    """
+    
+    NORMAL = "normal"
+    ECONOMY = "economy"
+    EXHAUSTED = "exhausted"
+    _current: contextvars.ContextVar = contextvars.ContextVar("usage_budget", default=None)
+    TENANT_KEY_PREFIX = "tenant-usage:"
+    # How often a tenant charge is retried when another worker charged the tenant at the same time
+    CHARGE_ATTEMPTS = 10
+    
+    def __init__(self,
+                 session_tokens: Optional[int] = None,
+                 session_seconds: Optional[float] = None,
+                 tenant_tokens: Optional[int] = None,
+                 tenant_seconds: Optional[float] = None,
+                 tenant_window_seconds: Optional[int] = None,
+                 economy_ratio: Optional[float] = None,
+                 store: Optional[SessionStore] = None):
         """
+        Initialize the budgets. A budget of 0 is unlimited.
         
-    def process_message(self, user_message: str) -> Dict[str, Any]:
+        Args:
+            session_tokens: Tokens a session may use. If None, it will try to get from environment variable.
+            session_seconds: Claude call time a session may use. If None, it will try to get from environment variable.
+            tenant_tokens: Tokens a tenant may use per window. If None, it will try to get from environment variable.
+            tenant_seconds: Claude call time a tenant may use per window. If None, it will try to get from
+                environment variable.
+            tenant_window_seconds: Length of the tenant budget window. If None, it will try to get from
+                environment variable.
+            economy_ratio: Fraction of a budget after which calls degrade. If None, it will try to get from
+                environment variable.
+            store: Store shared by the workers holding the tenant usage. If None, a private in-memory one is used.
         """
-        Process a user message and extract infrastructure requirements.
+        def setting(value: Optional[float], name: str, default: str) -> float:
+            return value if value is not None else float(os.getenv(name, default))
+        
+        self.session_tokens = int(setting(session_tokens, "BUDGET_SESSION_TOKENS", "200000"))
+        self.session_seconds = setting(session_seconds, "BUDGET_SESSION_SECONDS", "1800")
+        self.tenant_tokens = int(setting(tenant_tokens, "BUDGET_TENANT_TOKENS", "2000000"))
+        self.tenant_seconds = setting(tenant_seconds, "BUDGET_TENANT_SECONDS", "36000")
+        self.tenant_window_seconds = int(setting(tenant_window_seconds, "BUDGET_TENANT_WINDOW_SECONDS", "86400"))
+        self.economy_ratio = setting(economy_ratio, "BUDGET_ECONOMY_RATIO", "0.8")
+        
+        self.lock = threading.Lock()
+        # Tenant usage records of the current window, kept until the window ends
+        self.store = store or MemorySessionStore(ttl_seconds=self.tenant_window_seconds)
+    
+    @staticmethod
+    def new_usage() -> Dict[str, Any]:
+        """
+        Create an empty usage record.
+        """
+        return {"input_tokens": 0, "output_tokens": 0, "seconds": 0.0, "calls": 0}
+    
+    @classmethod
+    def merge_usage(cls, latest: Optional[Dict[str, Any]], usage: Dict[str, Any],
+                    loaded: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Add the usage charged since a record was loaded to a newer version of the record.
         
         Args:
-            user_message: The message from the user.
+            latest: The usage of the newer record.
+            usage: The usage of the record now.
+            loaded: The usage of the record when it was loaded.
             
         Returns:
-            A dictionary containing the interpreted infrastructure requirements or missing fields info.
+            The usage of the newer record plus the charges made since loading.
         """
-        # Add user message to history
-        self.conversation_history.append({"role": "user", "content": user_message})
+        merged = {**cls.new_usage(), **(latest or {})}
+        loaded = {**cls.new_usage(), **(loaded or {})}
+        for key, value in usage.items():
+            if isinstance(value, (int, float)):
+                merged[key] = merged.get(key, 0) + value - loaded.get(key, 0)
+        return merged
+    
+    @contextlib.contextmanager
+    def bind(self, session_usage: Dict[str, Any], tenant_id: str):
+        """
+        Charge the Claude calls made in the enclosed code to a session and tenant.
         
-        # Call Anthropic API to get response
+        Args:
+            session_usage: The usage record of the session, updated in place.
+            tenant_id: The tenant of the session.
+        """
+        token = self._current.set((self, session_usage, tenant_id))
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                system=self.system_message,
-                messages=self.conversation_history,
-                temperature=0.2,
-                max_tokens=1024
-            )
-            
-            # Extract the text response
-            assistant_message = response.content[0].text
-            
-            # Add the assistant's message to history
-            self.conversation_history.append({"role": "assistant", "content": assistant_message})
-            
-            # Check if the response is asking for more information
-            missing_fields_pattern = r"need.+?(?:information|details)|missing.+?(?:information|details)|provide.+?(?:information|details)"
-            asking_for_info = re.search(missing_fields_pattern, assistant_message, re.IGNORECASE)
-            
-            # Process the response
-            if asking_for_info:
-                # Extract which fields are being requested
-                missing_fields = []
-                if "subscription" in assistant_message.lower():
-                    missing_fields.append("subscription_name")
-                if "resource group" in assistant_message.lower():
-                    missing_fields.append("resource_group")
-                if "resource name" in assistant_message.lower():
-                    missing_fields.append("resource_name")
-                if "resource type" in assistant_message.lower():
-                    missing_fields.append("resource_type")
-                if "location" in assistant_message.lower():
-                    missing_fields.append("location")
-                
-                # If no specific fields were detected, ask for all
-                if not missing_fields:
-                    missing_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
-                
-                return {
-                    "needs_more_info": True,
-                    "missing_fields": missing_fields,
-                    "message": assistant_message
-                }
-            
-            # Try to parse JSON from the response
-            try:
-                # Look for JSON content in the message
-                json_match = re.search(r'```json\s*(.*?)\s*```', assistant_message, re.DOTALL)
-                if json_match:
-                    json_content = json_match.group(1)
-                    infrastructure_spec = json.loads(json_content)
-                else:
-                    # Try to find JSON content without code block markers
-                    json_start = assistant_message.find('{')
-                    json_end = assistant_message.rfind('}') + 1
-                    
-                    if json_start >= 0 and json_end > json_start:
-                        json_content = assistant_message[json_start:json_end]
-                        infrastructure_spec = json.loads(json_content)
-                    else:
-                        # If no JSON found, check for missing fields in the response
-                        required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
-                        # Check which fields are mentioned in the message to determine what's missing
-                        missing_fields = [field for field in required_fields if field.replace("_", " ") in assistant_message.lower()]
-                        
-                        if missing_fields:
-                            return {
-                                "needs_more_info": True,
-                                "missing_fields": missing_fields,
-                                "message": assistant_message
-                            }
-                        else:
-                            # Request all fields if we can't determine specific missing ones
-                            return {
-                                "needs_more_info": True,
-                                "missing_fields": required_fields,
-                                "message": "To generate the Terraform code, I need the following details:\n\n- Subscription Name\n- Resource Group Name\n- Resource Name\n- Resource Type\n- Location (Azure region)"
-                            }
-                
-                # Check if parsed JSON has all required fields
-                required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
-                missing_fields = [field for field in required_fields if field not in infrastructure_spec or not infrastructure_spec[field]]
-                
-                if missing_fields:
-                    return {
-                        "needs_more_info": True,
-                        "missing_fields": missing_fields,
-                        "message": f"I still need the following information: {', '.join(field.replace('_', ' ').title() for field in missing_fields)}"
-                    }
-                
-                return infrastructure_spec
-                
-            except json.JSONDecodeError:
-                logger.error("Failed to parse JSON response from assistant")
-                # If JSON parsing fails, check if the response is asking for more information
-                required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
-                
-                # If it seems to be asking for more info but we couldn't parse it properly
-                return {
-                    "needs_more_info": True,
-                    "missing_fields": required_fields,
-                    "message": "I need more information to generate the Terraform code. Please provide all of these details:\n\n- Subscription Name\n- Resource Group Name\n- Resource Name\n- Resource Type\n- Location (Azure region)"
-                }
-                    
+            yield
+        finally:
+            self._current.reset(token)
+    
+    @classmethod
+    def record(cls, usage: Any, seconds: float) -> None:
+        """
+        Charge a Claude call to the session and tenant bound to the current context, if any.
+        
+        Args:
+            usage: The usage reported by the API response, or None.
+            seconds: The duration of the call.
+        """
+        scope = cls._current.get()
+        if scope is None:
+            return
+        budget, session_usage, tenant_id = scope
+        charges = {
+            "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+            "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+            "seconds": seconds,
+            "calls": 1
+        }
+        with budget.lock:
+            for key, value in charges.items():
+                session_usage[key] = session_usage.get(key, 0) + value
+        budget._charge_tenant(tenant_id, charges)
+    
+    def _tenant_usage(self, tenant_id: str) -> Tuple[Dict[str, Any], int]:
+        """
+        Get the usage of a tenant in the current window and the version of its record.
+        """
+        usage, version = self.store.load_versioned(self.TENANT_KEY_PREFIX + tenant_id)
+        now = time.time()
+        if usage is None or now - usage["window_start"] >= self.tenant_window_seconds:
+            usage = {**self.new_usage(), "window_start": now}
+        return usage, version
+    
+    def _charge_tenant(self, tenant_id: str, charges: Dict[str, Any]) -> None:
+        """
+        Add a call to the usage of a tenant, retrying when another worker updated it first.
+        """
+        try:
+            for attempt in range(self.CHARGE_ATTEMPTS):
+                usage, version = self._tenant_usage(tenant_id)
+                for key, value in charges.items():
+                    usage[key] += value
+                # The record lives until its window ends, later windows start over
+                ttl_seconds = max(1, math.ceil(usage["window_start"] + self.tenant_window_seconds - time.time()))
+                if self.store.save(self.TENANT_KEY_PREFIX + tenant_id, usage, expected_version=version,
+                                   ttl_seconds=ttl_seconds) is not None:
+                    return
+            logger.warning(f"Dropped a Claude usage charge of tenant {tenant_id}: it kept changing concurrently")
         except Exception as e:
-            logger.error(f"Failed to call Claude API: {str(e)}")
-            return {
-                "error": f"Failed to call Claude API: {str(e)}",
-                "raw_response": ""
-            }
+            logger.error(f"Failed to charge Claude usage to tenant {tenant_id}: {str(e)}")
     
-    def get_conversation_history(self) -> List[Dict[str, str]]:
+    @staticmethod
+    def _ratio(usage: Dict[str, Any], tokens: float, seconds: float) -> float:
         """
-        Get the conversation history.
+        Get the largest fraction of a token or time budget that has been used.
+        """
+        ratios = [0.0]
+        if tokens:
+            ratios.append((usage.get("input_tokens", 0) + usage.get("output_tokens", 0)) / tokens)
+        if seconds:
+            ratios.append(usage.get("seconds", 0.0) / seconds)
+        return max(ratios)
+    
+    def get_status(self, session_usage: Dict[str, Any], tenant_id: str) -> Dict[str, Any]:
+        """
+        Get the usage of a session and its tenant against their budgets.
         
+        Args:
+            session_usage: The usage record of the session.
+            tenant_id: The tenant of the session.
+            
         Returns:
-            The conversation history.
+            A dictionary containing the degradation level and the usage, budgets and used fraction of both.
         """
-        return self.conversation_history
+        try:
+            tenant_usage, _ = self._tenant_usage(tenant_id)
+        except Exception as e:
+            logger.error(f"Failed to read Claude usage of tenant {tenant_id}: {str(e)}")
+            tenant_usage = {**self.new_usage(), "window_start": time.time()}
+        
+        session_ratio = self._ratio(session_usage, self.session_tokens, self.session_seconds)
+        tenant_ratio = self._ratio(tenant_usage, self.tenant_tokens, self.tenant_seconds)
+        ratio = max(session_ratio, tenant_ratio)
+        if ratio >= 1.0:
+            level = self.EXHAUSTED
+        elif ratio >= self.economy_ratio:
+            level = self.ECONOMY
+        else:
+            level = self.NORMAL
+        
+        return {
+            "level": level,
+            "session": {
+                "usage": dict(session_usage),
+                "token_budget": self.session_tokens,
+                "seconds_budget": self.session_seconds,
+                "used_ratio": round(session_ratio, 4)
+            },
+            "tenant": {
+                "tenant_id": tenant_id,
+                "usage": {key: value for key, value in tenant_usage.items() if key != "window_start"},
+                "token_budget": self.tenant_tokens,
+                "seconds_budget": self.tenant_seconds,
+                "window_seconds": self.tenant_window_seconds,
+                "window_resets_in_seconds": round(max(0.0, tenant_usage["window_start"] + self.tenant_window_seconds - time.time()), 1),
+                "used_ratio": round(tenant_ratio, 4)
+            }
+        }
     
-    def clear_conversation_history(self) -> None:
+    def level(self, session_usage: Dict[str, Any], tenant_id: str) -> str:
         """
-        Clear the conversation history, keeping only the system message.
+        Get how far a session has to degrade: NORMAL, ECONOMY once a budget is mostly used, or EXHAUSTED.
+        
+        Args:
+            session_usage: The usage record of the session.
+            tenant_id: The tenant of the session.
+            
+        Returns:
+            The degradation level.
         """
-        self.conversation_history = [self.conversation_history[0]]
+        return self.get_status(session_usage, tenant_id)["level"]
 
-class TerraformGenerator:
+class SchedulerTimeoutError(TimeoutError):
     """
-    Generates Terraform HCL code based on infrastructure specifications.
-    Uses Claude AI for model inference.
+    Raised when a Claude call waited too long for rate limit budget and was never sent.
+    """
+
+class ClaudeCallScheduler:
+    """
+    Coordinates Claude API calls across sessions. Calls wait in a priority queue until they fit in the
+    tokens-per-minute and requests-per-minute budgets, with interactive calls served before bulk generation.
+    
+    The budgets are the account's limits, but every worker process runs its own scheduler, so each one
+    admits calls against an equal share of them. This keeps the workers together under the account limits
+    without a round trip to a shared store on every call; the cost is that an idle worker's share can't be
+    borrowed by a busy one. Within a worker, threads share the queue, which is where prioritization applies.
+    """
+    
+    INTERACTIVE = 0
+    BATCH = 1
+    PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+    WINDOW_SECONDS = 60.0
+    # Queue wait of the last call admitted in the current context, so callers can tell it from API latency
+    _last_wait: contextvars.ContextVar = contextvars.ContextVar("claude_queue_wait", default=0.0)
+    
+    def __init__(self,
+                 tokens_per_minute: Optional[int] = None,
+                 requests_per_minute: Optional[int] = None,
+                 max_wait_seconds: Optional[float] = None,
+                 worker_count: Optional[int] = None):
+        """
+        Initialize the scheduler.
+        
+        Args:
+            tokens_per_minute: Token budget per minute of the whole deployment. If None, it will try to get from environment variable.
+            requests_per_minute: Request budget per minute of the whole deployment. If None, it will try to get from environment variable.
+            max_wait_seconds: How long a call may wait in the queue. If None, it will try to get from environment variable.
+            worker_count: How many worker processes share the budgets. If None, it will try to get from environment variables.
+        """
+        self.total_tokens_per_minute = tokens_per_minute or int(os.getenv("ANTHROPIC_TOKENS_PER_MINUTE", "40000"))
+        self.total_requests_per_minute = requests_per_minute or int(os.getenv("ANTHROPIC_REQUESTS_PER_MINUTE", "50"))
+        self.worker_count = max(1, worker_count or self.default_worker_count())
+        self.tokens_per_minute = max(1, self.total_tokens_per_minute // self.worker_count)
+        self.requests_per_minute = max(1, self.total_requests_per_minute // self.worker_count)
+        self.max_wait_seconds = max_wait_seconds or float(os.getenv("ANTHROPIC_SCHEDULER_MAX_WAIT", "300"))
+        
+        self.condition = threading.Condition()
+        # Heap of (priority, sequence) for queued calls
+        self.queue: List[Tuple[int, int]] = []
+        self.sequence = 0
+        # Admitted calls in the current window as [timestamp, tokens] entries
+        self.window: deque = deque()
+        
+        self.stats = {
+            name: {"calls": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0, "last_wait_seconds": 0.0}
+            for name in self.PRIORITY_NAMES.values()
+        }
+    
+    @staticmethod
+    def default_worker_count() -> int:
+        """
+        Get the number of worker processes sharing the API budgets.
+        
+        Returns:
+            ANTHROPIC_SCHEDULER_WORKERS (the total across all containers), else gunicorn's worker count
+            from WEB_CONCURRENCY or GUNICORN_CMD_ARGS, else 1.
+        """
+        configured = os.getenv("ANTHROPIC_SCHEDULER_WORKERS") or os.getenv("WEB_CONCURRENCY")
+        if configured:
+            return int(configured)
+        match = re.search(r'(?:--workers|-w)[ =]?(\d+)', os.getenv("GUNICORN_CMD_ARGS", ""))
+        return int(match.group(1)) if match else 1
+    
+    @staticmethod
+    def estimate_tokens(system: str, messages: List[Dict[str, str]], max_tokens: int) -> int:
+        """
+        Estimate the token cost of a call from its prompt size and output limit.
+        
+        Args:
+            system: The system prompt.
+            messages: The conversation messages.
+            max_tokens: The maximum number of output tokens.
+            
+        Returns:
+            The estimated number of tokens, using roughly four characters per token for the input.
+        """
+        characters = len(system or "") + sum(len(str(message.get("content", ""))) for message in messages)
+        return characters // 4 + max_tokens
+    
+    def _expire_window(self, now: float) -> None:
+        """
+        Drop admitted calls that are older than the budget window.
+        """
+        while self.window and self.window[0][0] <= now - self.WINDOW_SECONDS:
+            self.window.popleft()
+    
+    def _wait_time(self, tokens: int, now: float) -> float:
+        """
+        Compute how long a call of the given size has to wait for budget.
+        
+        Args:
+            tokens: The estimated tokens of the call.
+            now: The current time.
+            
+        Returns:
+            0 if the call fits now, otherwise the seconds until enough budget frees up.
+        """
+        used_tokens = sum(entry[1] for entry in self.window)
+        if len(self.window) < self.requests_per_minute and (used_tokens + tokens <= self.tokens_per_minute or not self.window):
+            return 0.0
+        
+        # Find when enough of the oldest calls leave the window
+        freed_tokens = 0
+        for index, (timestamp, entry_tokens) in enumerate(self.window):
+            freed_tokens += entry_tokens
+            if (len(self.window) - index - 1 < self.requests_per_minute
+                    and used_tokens - freed_tokens + tokens <= self.tokens_per_minute):
+                return max(0.0, timestamp + self.WINDOW_SECONDS - now)
+        return max(0.0, self.window[-1][0] + self.WINDOW_SECONDS - now)
+    
+    def call(self, priority: int, estimated_tokens: int, fn) -> Any:
+        """
+        Wait for budget and a turn in the queue, then make the call.
+        
+        Args:
+            priority: INTERACTIVE or BATCH.
+            estimated_tokens: The estimated token cost of the call.
+            fn: A function making the API call.
+            
+        Returns:
+            The result of `fn`.
+        """
+        enqueued_at = time.monotonic()
+        with self.condition:
+            self.sequence += 1
+            ticket = (priority, self.sequence)
+            heapq.heappush(self.queue, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._expire_window(now)
+                    waited = now - enqueued_at
+                    if waited > self.max_wait_seconds:
+                        raise SchedulerTimeoutError(f"Claude call waited {waited:.0f}s for rate limit budget")
+                    
+                    if self.queue[0] == ticket:
+                        delay = self._wait_time(estimated_tokens, now)
+                        if delay <= 0:
+                            break
+                    else:
+                        delay = None
+                    self.condition.wait(timeout=min(delay, self.max_wait_seconds) if delay else self.max_wait_seconds)
+            finally:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+            
+            entry = [now, estimated_tokens]
+            self.window.append(entry)
+            self._record_wait(priority, waited)
+        
+        StageTimings.record("claude_queue", waited)
+        self._last_wait.set(waited)
+        api_start = time.monotonic()
+        with StageTimings.stage("claude_api"):
+            result = fn()
+        UsageBudget.record(getattr(result, "usage", None), time.monotonic() - api_start)
+        
+        # Replace the estimate with the actual usage reported by the API
+        usage = getattr(result, "usage", None)
+        if usage is not None:
+            with self.condition:
+                entry[1] = getattr(usage, "input_tokens", 0) + getattr(usage, "output_tokens", 0)
+                self.condition.notify_all()
+        return result
+    
+    def _record_wait(self, priority: int, waited: float) -> None:
+        """
+        Update the wait time statistics of a priority class.
+        """
+        stats = self.stats[self.PRIORITY_NAMES[priority]]
+        stats["calls"] += 1
+        stats["total_wait_seconds"] += waited
+        stats["last_wait_seconds"] = waited
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the queue depth, budget usage and wait times.
+        
+        Returns:
+            A dictionary of scheduler metrics.
+        """
+        with self.condition:
+            self._expire_window(time.monotonic())
+            queue_depth = {name: 0 for name in self.PRIORITY_NAMES.values()}
+            for priority, _ in self.queue:
+                queue_depth[self.PRIORITY_NAMES[priority]] += 1
+            
+            wait_times = {}
+            for name, stats in self.stats.items():
+                wait_times[name] = {
+                    "calls": stats["calls"],
+                    "average_wait_seconds": stats["total_wait_seconds"] / stats["calls"] if stats["calls"] else 0.0,
+                    "max_wait_seconds": stats["max_wait_seconds"],
+                    "last_wait_seconds": stats["last_wait_seconds"]
+                }
+            
+            return {
+                "queue_depth": queue_depth,
+                "tokens_used_last_minute": sum(entry[1] for entry in self.window),
+                "requests_last_minute": len(self.window),
+                "tokens_per_minute": self.tokens_per_minute,
+                "requests_per_minute": self.requests_per_minute,
+                "worker_count": self.worker_count,
+                "total_tokens_per_minute": self.total_tokens_per_minute,
+                "total_requests_per_minute": self.total_requests_per_minute,
+                "wait_times": wait_times
+            }
+
+class ModelRouter:
+    """
+    Routes the Claude calls of one pipeline stage to a primary model, falling back to a secondary model
+    on errors or when the primary keeps breaching its latency SLO.
+    """
+    
+    DEFAULT_MODELS = {
+        "extraction": ("claude-3-haiku-20240307", "claude-3-sonnet-20240229"),
+        "generation": ("claude-3-opus-20240229", "claude-3-sonnet-20240229")
+    }
+    DEFAULT_LATENCY_SLO_SECONDS = {"extraction": 10.0, "generation": 90.0}
+    DEFAULT_TIMEOUT_SECONDS = {"extraction": 60.0, "generation": 300.0}
+    DEFAULT_ECONOMY_MODEL = "claude-3-haiku-20240307"
+    
+    def __init__(self,
+                 stage: str,
+                 model: Optional[str] = None,
+                 fallback_model: Optional[str] = None,
+                 latency_slo_seconds: Optional[float] = None):
+        """
+        Initialize the model router.
+        
+        Args:
+            stage: The pipeline stage, "extraction" or "generation".
+            model: The primary model. If None, it will try to get from environment variables.
+            fallback_model: The secondary model. If None, it will try to get from environment variables.
+            latency_slo_seconds: Latency above which a primary call counts as an SLO breach.
+        """
+        self.stage = stage
+        self.model = model or self.default_model(stage)
+        self.fallback_model = fallback_model or os.getenv(f"ANTHROPIC_{stage.upper()}_FALLBACK_MODEL", self.DEFAULT_MODELS[stage][1])
+        if self.fallback_model == self.model:
+            self.fallback_model = None
+        # Cheaper model used once a usage budget is running low
+        self.economy_model = os.getenv(f"ANTHROPIC_{stage.upper()}_ECONOMY_MODEL") or os.getenv(
+            "ANTHROPIC_ECONOMY_MODEL", self.DEFAULT_ECONOMY_MODEL)
+        
+        self.latency_slo_seconds = latency_slo_seconds or float(
+            os.getenv(f"ANTHROPIC_{stage.upper()}_LATENCY_SLO", str(self.DEFAULT_LATENCY_SLO_SECONDS[stage])))
+        # Hard deadline of a single call, after which the request is abandoned
+        self.timeout_seconds = float(os.getenv(f"ANTHROPIC_{stage.upper()}_TIMEOUT", str(self.DEFAULT_TIMEOUT_SECONDS[stage])))
+        # Consecutive breaches or errors that switch routing to the fallback, and for how long
+        self.breach_threshold = int(os.getenv("ANTHROPIC_ROUTING_BREACH_THRESHOLD", "3"))
+        self.cooldown_seconds = float(os.getenv("ANTHROPIC_ROUTING_COOLDOWN", "300"))
+        
+        self.lock = threading.Lock()
+        self.consecutive_breaches = 0
+        self.degraded_until = 0.0
+        self.model_stats: Dict[str, Dict[str, Any]] = {}
+        self.decisions = {"primary": 0, "fallback_degraded": 0, "fallback_error": 0, "economy": 0}
+    
+    @classmethod
+    def default_model(cls, stage: str) -> str:
+        """
+        Get the configured primary model of a stage.
+        
+        Args:
+            stage: The pipeline stage.
+            
+        Returns:
+            ANTHROPIC_<STAGE>_MODEL, else ANTHROPIC_MODEL, else the built-in default for the stage.
+        """
+        return os.getenv(f"ANTHROPIC_{stage.upper()}_MODEL") or os.getenv("ANTHROPIC_MODEL") or cls.DEFAULT_MODELS[stage][0]
+    
+    def _select_model(self) -> str:
+        """
+        Pick the model for the next call and record the routing decision.
+        """
+        with self.lock:
+            if self.fallback_model and time.monotonic() < self.degraded_until:
+                self.decisions["fallback_degraded"] += 1
+                return self.fallback_model
+            self.decisions["primary"] += 1
+            return self.model
+    
+    def _record(self, model: str, latency: float, error: bool) -> None:
+        """
+        Record the outcome of a call and switch to the fallback if the primary is unhealthy.
+        """
+        with self.lock:
+            stats = self.model_stats.setdefault(model, {"calls": 0, "errors": 0, "slo_breaches": 0, "total_latency_seconds": 0.0})
+            stats["calls"] += 1
+            stats["total_latency_seconds"] += latency
+            breached = error or latency > self.latency_slo_seconds
+            if error:
+                stats["errors"] += 1
+            elif breached:
+                stats["slo_breaches"] += 1
+            
+            if model != self.model:
+                return
+            self.consecutive_breaches = self.consecutive_breaches + 1 if breached else 0
+            if self.fallback_model and self.consecutive_breaches >= self.breach_threshold:
+                logger.warning(f"{self.stage} model {self.model} breached its SLO {self.consecutive_breaches} times in a row, "
+                               f"routing to {self.fallback_model} for {self.cooldown_seconds:.0f}s")
+                self.degraded_until = time.monotonic() + self.cooldown_seconds
+                self.consecutive_breaches = 0
+    
+    def _timed_call(self, fn, model: str) -> Tuple[Any, float]:
+        """
+        Make a call and measure its latency, leaving out the time it waited in the scheduler queue.
+        
+        Returns:
+            A tuple containing (result, latency).
+        """
+        ClaudeCallScheduler._last_wait.set(0.0)
+        start = time.monotonic()
+        result = fn(model)
+        return result, max(0.0, time.monotonic() - start - ClaudeCallScheduler._last_wait.get())
+    
+    def call(self, fn, economy: bool = False) -> Any:
+        """
+        Make a call with the selected model, retrying once with the fallback model if it fails.
+        Calls that timed out waiting for rate limit budget never reached the model, and cancelled calls
+        say nothing about it, so both are raised without being counted against it.
+        
+        Args:
+            fn: A function taking the model name and making the API call.
+            economy: Whether to use the economy model because a usage budget is running low.
+            
+        Returns:
+            The result of `fn`.
+        """
+        if economy:
+            with self.lock:
+                self.decisions["economy"] += 1
+            model = self.economy_model
+        else:
+            model = self._select_model()
+        start = time.monotonic()
+        try:
+            result, latency = self._timed_call(fn, model)
+        except (SchedulerTimeoutError, CancelledError):
+            raise
+        except Exception as e:
+            self._record(model, time.monotonic() - start - ClaudeCallScheduler._last_wait.get(), error=True)
+            if not self.fallback_model or model == self.fallback_model:
+                raise
+            
+            logger.warning(f"{self.stage} call to {model} failed, retrying with {self.fallback_model}: {str(e)}")
+            with self.lock:
+                self.decisions["fallback_error"] += 1
+            start = time.monotonic()
+            try:
+                result, latency = self._timed_call(fn, self.fallback_model)
+            except (SchedulerTimeoutError, CancelledError):
+                raise
+            except Exception:
+                self._record(self.fallback_model, time.monotonic() - start - ClaudeCallScheduler._last_wait.get(), error=True)
+                raise
+            self._record(self.fallback_model, latency, error=False)
+            return result
+        
+        self._record(model, latency, error=False)
+        return result
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the routing decisions and per-model call statistics.
+        
+        Returns:
+            A dictionary of routing metrics.
+        """
+        with self.lock:
+            models = {}
+            for model, stats in self.model_stats.items():
+                models[model] = dict(stats)
+                models[model]["average_latency_seconds"] = stats["total_latency_seconds"] / stats["calls"] if stats["calls"] else 0.0
+            return {
+                "model": self.model,
+                "fallback_model": self.fallback_model,
+                "economy_model": self.economy_model,
+                "latency_slo_seconds": self.latency_slo_seconds,
+                "degraded": bool(self.fallback_model) and time.monotonic() < self.degraded_until,
+                "decisions": dict(self.decisions),
+                "models": models
+            }
+
+class ClaudeTransport:
+    """
+    Sends message requests to Claude in one of three modes. passthrough calls the live API, record also
+    appends every request hash and response to a cassette file, and replay serves the recorded responses
+    without network access, optionally with simulated latency. Makes test and performance runs fast,
+    free and deterministic.
+    """
+    
+    MODES = ["passthrough", "record", "replay"]
+    
+    def __init__(self,
+                 anthropic_api_key: Optional[str] = None,
+                 mode: Optional[str] = None,
+                 cassette_path: Optional[str] = None,
+                 replay_latency: Optional[str] = None):
+        """
+        Initialize the transport.
+        
+        Args:
+            anthropic_api_key: Anthropic API key. Not needed for replay.
+            mode: passthrough, record or replay. If None, it will try to get from environment variable.
+            cassette_path: The JSON lines file responses are recorded to and replayed from.
+                If None, it will try to get from environment variable.
+            replay_latency: Delay of replayed responses, in seconds or "recorded" to reproduce the recorded
+                latency. If None, it will try to get from environment variable.
+        """
+        self.mode = (mode or self.default_mode()).lower()
+        if self.mode not in self.MODES:
+            raise ValueError(f"Invalid Claude transport mode: {self.mode}. Valid modes are {', '.join(self.MODES)}")
+        
+        self.cassette_path = cassette_path or os.getenv("CLAUDE_CASSETTE_PATH", "claude_cassette.jsonl")
+        self.replay_latency = replay_latency if replay_latency is not None else os.getenv("CLAUDE_REPLAY_LATENCY", "0")
+        
+        self.client = anthropic.Anthropic(api_key=anthropic_api_key) if self.mode != "replay" else None
+        self.lock = threading.Lock()
+        
+        # Request hash -> recorded responses in recording order, and how many of them were served
+        self.recordings: Dict[str, List[Dict[str, Any]]] = {}
+        self.replay_positions: Dict[str, int] = {}
+        if self.mode == "replay":
+            self._load_cassette()
+    
+    @staticmethod
+    def default_mode() -> str:
+        """
+        Get the transport mode configured in the environment.
+        
+        Returns:
+            passthrough, record or replay.
+        """
+        return os.getenv("CLAUDE_TRANSPORT_MODE", "passthrough").lower()
+    
+    @staticmethod
+    def request_key(request: Dict[str, Any]) -> str:
+        """
+        Hash a message request.
+        
+        Args:
+            request: The keyword arguments of the request.
+            
+        Returns:
+            A stable hex digest of the request.
+        """
+        serialized = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    
+    def _load_cassette(self) -> None:
+        """
+        Load the recorded responses of the cassette file.
+        """
+        with open(self.cassette_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.recordings.setdefault(entry["key"], []).append(entry)
+        logger.info(f"Loaded {sum(len(entries) for entries in self.recordings.values())} recorded Claude responses "
+                    f"from {self.cassette_path}")
+    
+    def create_message(self, timeout: Optional[float] = None, cancel_check: Optional[Callable[[], bool]] = None,
+                       **request) -> Any:
+        """
+        Send a message request, with the same arguments and response as `client.messages.create`.
+        
+        Args:
+            timeout: The deadline of the request in seconds. Not part of the recorded request.
+            cancel_check: Polled while the response arrives. When it returns True the response stream is
+                closed, so Claude stops generating, and CancelledError is raised. Not part of the recorded request.
+            request: The keyword arguments of the request.
+            
+        Returns:
+            The API response.
+            
+        Raises:
+            CancelledError: If the call was cancelled.
+        """
+        if cancel_check is not None and cancel_check():
+            raise CancelledError("Claude call was cancelled")
+        options = {"timeout": timeout} if timeout else {}
+        if self.mode == "passthrough":
+            return self._send(request, options, cancel_check)
+        
+        key = self.request_key(request)
+        if self.mode == "replay":
+            return self._replay(key, cancel_check)
+        
+        start_time = time.time()
+        response = self._send(request, options, cancel_check)
+        latency = time.time() - start_time
+        
+        entry = {
+            "key": key,
+            "model": request.get("model"),
+            "latency": round(latency, 3),
+            "response": json.loads(response.model_dump_json())
+        }
+        with self.lock, open(self.cassette_path, 'a') as f:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        return response
+    
+    def _send(self, request: Dict[str, Any], options: Dict[str, Any],
+              cancel_check: Optional[Callable[[], bool]]) -> Any:
+        """
+        Send a request to the API. Cancellable requests are streamed so they can be stopped mid-response.
+        
+        Args:
+            request: The keyword arguments of the request.
+            options: The request options, like the timeout.
+            cancel_check: Polled after every streamed event.
+            
+        Returns:
+            The API response.
+        """
+        if cancel_check is None:
+            return self.client.messages.create(**request, **options)
+        
+        # Leaving the stream closes the connection, which ends the generation on the API side
+        with self.client.messages.stream(**request, **options) as stream:
+            for _ in stream:
+                if cancel_check():
+                    raise CancelledError("Claude call was cancelled")
+            return stream.get_final_message()
+    
+    def _replay(self, key: str, cancel_check: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Serve the next recorded response of a request.
+        
+        Args:
+            key: The request hash.
+            cancel_check: Polled during the simulated latency.
+            
+        Returns:
+            The recorded API response.
+        """
+        with self.lock:
+            entries = self.recordings.get(key)
+            if not entries:
+                raise LookupError(f"No recorded response for request {key[:12]} in {self.cassette_path}")
+            # Repeated identical requests get the responses in recording order, then the last one again
+            position = self.replay_positions.get(key, 0)
+            self.replay_positions[key] = position + 1
+            entry = entries[min(position, len(entries) - 1)]
+        
+        if self.replay_latency == "recorded":
+            latency = entry.get("latency", 0)
+        else:
+            latency = float(self.replay_latency or 0)
+        deadline = time.monotonic() + latency
+        while time.monotonic() < deadline:
+            if cancel_check is not None and cancel_check():
+                raise CancelledError("Claude call was cancelled")
+            time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+        
+        # construct builds the nested content and usage models without a network round trip or validation
+        return anthropic.types.Message.construct(**entry["response"])
+
+
+class SpecCache:
+    """
+    Similarity index from past request messages to the infrastructure specs extracted from them.
+    Messages are embedded locally with hashed word and character trigram features, so rephrasings
+    of an earlier request can be answered without a Claude round trip. Entries are scoped, so one
+    tenant's or session's requests are never suggested to another.
+    """
+    
+    DIMENSIONS = 1 << 18
+    # Matched against the new message, so a similar request for a different resource never reuses a spec
+    IDENTIFYING_FIELDS = ["resource_name", "resource_group", "location"]
+    STOPWORDS = {
+        "a", "an", "the", "i", "we", "me", "my", "our", "please", "need", "want", "would", "like", "to",
+        "create", "make", "deploy", "provision", "set", "up", "new", "in", "on", "at", "for", "with",
+        "of", "and", "called", "named", "name", "it", "can", "you", "could", "should", "be", "is", "some"
+    }
+    SYNONYMS = {
+        "acct": "account", "accounts": "account", "rg": "group", "resourcegroup": "group", "grp": "group",
+        "sa": "storage", "vms": "vm", "virtual": "vm", "machine": "vm", "vnet": "network", "vnets": "network",
+        "region": "location", "sub": "subscription"
+    }
+    # Verbs telling what a request does to a resource; a message without any creates one
+    ACTION_VERBS = {
+        "delete": {"delete", "remove", "destroy", "decommission", "drop", "teardown"},
+        "update": {"update", "modify", "change", "resize", "scale", "upgrade", "downgrade", "increase",
+                   "decrease", "rename", "move", "enable", "disable"}
+    }
+    # Words that are property values rather than phrasing, like tiers and replication types
+    PROPERTY_VALUE_WORDS = {
+        "free", "basic", "standard", "premium", "hot", "cool", "cold", "archive", "lrs", "grs", "ragrs", "zrs",
+        "gzrs", "ragzrs", "linux", "windows", "ubuntu", "debian", "public", "private", "static", "dynamic",
+        "ssd", "hdd", "https", "http", "tls"
+    }
+    
+    def __init__(self, threshold: Optional[float] = None, max_entries: Optional[int] = None,
+                 ttl_seconds: Optional[int] = None):
+        """
+        Initialize the spec cache.
+        
+        Args:
+            threshold: Minimum cosine similarity of a match, between 0 and 1. If None, it will try to get
+                from environment variable.
+            max_entries: Maximum number of cached specs, the least recently used are evicted. 0 disables
+                the cache. If None, it will try to get from environment variable.
+            ttl_seconds: How long an unused spec is kept. If None, it will try to get from environment variable.
+        """
+        self.threshold = threshold if threshold is not None else float(os.getenv("SPEC_CACHE_THRESHOLD", "0.75"))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("SPEC_CACHE_MAX_ENTRIES", "1000"))
+        self.ttl_seconds = ttl_seconds or int(os.getenv("SPEC_CACHE_TTL_SECONDS", "604800"))
+        
+        self.lock = threading.Lock()
+        # (scope, spec hash) -> entry holding the message vector, action, spec and last use, in least recently used order
+        self.entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.rejected = 0
+        self.evictions = 0
+    
+    @classmethod
+    def words(cls, text: str) -> List[str]:
+        """
+        Split a message into lowercase words with synonyms folded together.
+        """
+        return [cls.SYNONYMS.get(word, word) for word in re.findall(r"[a-z0-9]+", text.lower())]
+    
+    @classmethod
+    def action(cls, text: str) -> str:
+        """
+        Get what a message asks to do: "create", "update" or "delete".
+        """
+        for word in cls.words(text):
+            for action, verbs in cls.ACTION_VERBS.items():
+                if word in verbs:
+                    return action
+        return "create"
+    
+    @classmethod
+    def vectorize(cls, text: str) -> Dict[int, float]:
+        """
+        Embed a message as a sparse, L2-normalized feature vector.
+        
+        Args:
+            text: The message.
+            
+        Returns:
+            A dictionary mapping feature index to weight.
+        """
+        words = [word for word in cls.words(text) if word not in cls.STOPWORDS]
+        
+        counts: Dict[int, int] = {}
+        features = [f"w:{word}" for word in words]
+        # Trigrams over the joined words match "East US" with "eastus" and tolerate abbreviations
+        joined = "".join(words)
+        features.extend(f"c:{joined[i:i + 3]}" for i in range(len(joined) - 2))
+        for feature in features:
+            index = zlib.crc32(feature.encode("utf-8")) & (cls.DIMENSIONS - 1)
+            counts[index] = counts.get(index, 0) + 1
+        
+        vector = {index: 1.0 + math.log(count) for index, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {index: weight / norm for index, weight in vector.items()} if norm else {}
+    
+    @staticmethod
+    def similarity(left: Dict[int, float], right: Dict[int, float]) -> float:
+        """
+        Get the cosine similarity of two normalized vectors.
+        """
+        if len(left) > len(right):
+            left, right = right, left
+        return sum(weight * right.get(index, 0.0) for index, weight in left.items())
+    
+    @classmethod
+    def _mentions(cls, message: str, spec: Dict[str, Any]) -> bool:
+        """
+        Check whether a message names every identifying value and the resource type of a spec.
+        """
+        normalized_message = re.sub(r"[^a-z0-9]", "", message.lower())
+        for field in cls.IDENTIFYING_FIELDS:
+            value = re.sub(r"[^a-z0-9]", "", str(spec.get(field) or "").lower())
+            if value and value not in normalized_message:
+                return False
+        
+        # "Storage Account" and "azurerm_storage_account" both need storage and account in the message
+        type_words = [word for word in cls.words(str(spec.get("resource_type") or "")) if word not in ("azurerm", *cls.STOPWORDS)]
+        message_words = set(cls.words(message))
+        return all(word in message_words for word in type_words) or (
+            bool(type_words) and "".join(type_words) in normalized_message)
+    
+    @classmethod
+    def _unknown_values(cls, message: str, spec: Dict[str, Any]) -> List[str]:
+        """
+        Find the property values a message names that the spec doesn't have, such as a different size or tier.
+        """
+        spec_values = re.sub(r"[^a-z0-9]", "", json.dumps(spec).lower())
+        unknown = []
+        for token in re.findall(r"[a-z0-9][a-z0-9_.-]*", message.lower()):
+            value = re.sub(r"[^a-z0-9]", "", token)
+            is_value = any(character.isdigit() for character in value) or any(
+                word in cls.PROPERTY_VALUE_WORDS for word in re.split(r"[_.-]", token))
+            if is_value and value not in spec_values:
+                unknown.append(token)
+        return unknown
+    
+    def lookup(self, message: str, scope: str = "default") -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        Find the spec of the most similar earlier request. A match must also have the same action,
+        name the spec's identifying values and resource type, and name no property value the spec lacks.
+        
+        Args:
+            message: The new request message.
+            scope: The tenant or session whose requests are searched.
+            
+        Returns:
+            A tuple containing (copy of the spec, similarity), or None if no earlier request is similar enough.
+        """
+        if self.max_entries <= 0:
+            return None
+        vector = self.vectorize(message)
+        if not vector:
+            return None
+        action = self.action(message)
+        
+        with self.lock:
+            self.lookups += 1
+            self._evict_expired()
+            ranked = sorted(
+                ((self.similarity(vector, entry["vector"]), key) for key, entry in self.entries.items() if key[0] == scope),
+                reverse=True
+            )
+            for score, key in ranked:
+                if score < self.threshold:
+                    break
+                entry = self.entries[key]
+                if (entry["action"] != action or not self._mentions(message, entry["spec"])
+                        or self._unknown_values(message, entry["spec"])):
+                    self.rejected += 1
+                    continue
+                
+                # Move to the most recently used end
+                entry["last_used"] = time.time()
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+                return copy.deepcopy(entry["spec"]), round(score, 4)
+        return None
+    
+    def add(self, message: str, spec: Dict[str, Any], scope: str = "default") -> None:
+        """
+        Remember the spec extracted from a request.
+        
+        Args:
+            message: The request message, including the follow-up answers that completed it.
+            spec: The extracted infrastructure spec.
+            scope: The tenant or session the request belongs to.
+        """
+        if self.max_entries <= 0:
+            return
+        vector = self.vectorize(message)
+        if not vector:
+            return
+        
+        key = (scope, SingleFlight.make_key(spec))
+        entry = {"vector": vector, "action": self.action(message), "spec": copy.deepcopy(spec), "last_used": time.time()}
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+                self.evictions += 1
+    
+    def _evict_expired(self) -> None:
+        """
+        Drop the specs that were not used within the TTL. Must be called with the lock held.
+        """
+        cutoff = time.time() - self.ttl_seconds
+        for key in [key for key, entry in self.entries.items() if entry["last_used"] < cutoff]:
+            del self.entries[key]
+            self.evictions += 1
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the cache size and hit rate.
+        
+        Returns:
+            A dictionary containing the cache metrics.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "scopes": len({scope for scope, _ in self.entries}),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "rejected": self.rejected,
+                "evictions": self.evictions
+            }
+
+class AzureCatalog:
     """
+    Offline catalog of Azure regions, VM sizes, storage SKUs and azurerm resource types, loaded into
+    sorted prefix indexes. Catches typos in a spec before generation instead of at plan time against
+    Azure, and answers autocomplete lookups without any API call.
+    """
+    
+    KIND_LABELS = {
+        "locations": "Azure region",
+        "vm_sizes": "VM size",
+        "storage_account_skus": "storage account SKU",
+        "storage_account_tiers": "storage account tier",
+        "storage_replication_types": "storage replication type",
+        "storage_account_kinds": "storage account kind",
+        "managed_disk_skus": "managed disk SKU",
+        "resource_types": "azurerm resource type"
+    }
+    
+    # Spec properties checked against the catalog, by normalized property name
+    PROPERTY_KINDS = {
+        "location": "locations",
+        "region": "locations",
+        "vm_size": "vm_sizes",
+        "virtual_machine_size": "vm_sizes",
+        "size": "vm_sizes",
+        "account_tier": "storage_account_tiers",
+        "account_replication_type": "storage_replication_types",
+        "replication_type": "storage_replication_types",
+        "account_kind": "storage_account_kinds",
+        "storage_account_type": "managed_disk_skus",
+        "os_disk_type": "managed_disk_skus",
+        "disk_type": "managed_disk_skus",
+        "disk_sku": "managed_disk_skus",
+        "sku": "storage_account_skus",
+        "sku_name": "storage_account_skus",
+        "storage_sku": "storage_account_skus",
+        "account_sku": "storage_account_skus"
+    }
+    
+    # Generic property names that only name a catalog value when the value or resource looks like one
+    AMBIGUOUS_PROPERTIES = {
+        "size": re.compile(r"^(?:standard|basic)_", re.IGNORECASE),
+        "sku": re.compile(r"^(?:standard|premium)_(?:lrs|grs|ragrs|zrs|gzrs|ragzrs)$", re.IGNORECASE),
+        "sku_name": re.compile(r"^(?:standard|premium)_(?:lrs|grs|ragrs|zrs|gzrs|ragzrs)$", re.IGNORECASE)
+    }
+    
+    def __init__(self, path: Optional[str] = None):
+        """
+        Load the catalog and build its indexes.
+        
+        Args:
+            path: The catalog JSON file. If None, it will try to get from environment variable,
+                falling back to the catalog directory next to this file.
+        """
+        self.path = path or os.getenv(
+            "AZURE_CATALOG_PATH",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog", "azure_catalog.json")
+        )
+        # Kind -> {"entries": [(value, label)], "keys": sorted keys, "positions": entry of each key, "exact": key -> entry}
+        self.indexes: Dict[str, Dict[str, Any]] = {}
+        # Normalized resource types deployed to the "global" location, like DNS zones and Front Door
+        self.global_resource_types = set()
+        self.version = None
+        
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
+            data = json.loads(content)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Azure catalog not loaded from {self.path}, specs won't be validated: {str(e)}")
+            return
+        
+        for kind in self.KIND_LABELS:
+            entries = []
+            for item in data.get(kind) or []:
+                if isinstance(item, dict):
+                    entries.append((item["name"], item.get("display_name") or item["name"]))
+                else:
+                    entries.append((item, item))
+            self.indexes[kind] = self._build_index(entries)
+        self.global_resource_types = {
+            self.normalize(re.sub(r"^azurerm_", "", item)) for item in data.get("global_resource_types") or []}
+        
+        self.version = f"{data.get('version', 'unversioned')}+{hashlib.sha256(content).hexdigest()[:12]}"
+        logger.info(f"Loaded Azure catalog {self.version} from {self.path}")
+    
+    @staticmethod
+    def normalize(value: str) -> str:
+        """
+        Reduce a value to its lookup key, ignoring case, spaces and separators.
+        
+        Args:
+            value: The value as written by the user.
+            
+        Returns:
+            The lookup key.
+        """
+        return re.sub(r"[^a-z0-9]", "", str(value).lower())
+    
+    def _build_index(self, entries: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """
+        Index catalog entries by their keys and aliases.
+        
+        Args:
+            entries: The (value, label) pairs of one kind.
+            
+        Returns:
+            The index of the kind.
+        """
+        pairs = set()
+        for position, (value, label) in enumerate(entries):
+            keys = {self.normalize(value), self.normalize(label)}
+            # Standard_D2s_v5 can be looked up as D2s_v5, azurerm_storage_account as storage_account
+            alias = re.sub(r"^(?:standard|basic|azurerm)_", "", value, flags=re.IGNORECASE)
+            keys.add(self.normalize(alias))
+            pairs.update((key, position) for key in keys if key)
+        
+        pairs = sorted(pairs)
+        exact = {}
+        for key, position in pairs:
+            exact.setdefault(key, position)
+        return {
+            "entries": entries,
+            "keys": [key for key, _ in pairs],
+            "positions": [position for _, position in pairs],
+            "exact": exact
+        }
+    
+    def _index(self, kind: str) -> Dict[str, Any]:
+        """
+        Get the index of a kind.
+        
+        Raises:
+            ValueError: If the kind isn't part of the catalog.
+        """
+        if kind not in self.KIND_LABELS:
+            raise ValueError(f"Invalid catalog kind: {kind}. Use one of {', '.join(self.KIND_LABELS)}")
+        return self.indexes.get(kind) or self._build_index([])
+    
+    def lookup(self, kind: str, value: str) -> Optional[str]:
+        """
+        Find the canonical form of a value.
+        
+        Args:
+            kind: The catalog kind, e.g. locations or vm_sizes.
+            value: The value as written by the user.
+            
+        Returns:
+            The canonical value, or None if the catalog doesn't know it.
+        """
+        index = self._index(kind)
+        position = index["exact"].get(self.normalize(value))
+        return index["entries"][position][0] if position is not None else None
+    
+    def search(self, kind: str, prefix: str, limit: int = 10) -> List[Dict[str, str]]:
+        """
+        Find the values starting with a prefix, for autocomplete.
+        
+        Args:
+            kind: The catalog kind, e.g. locations or vm_sizes.
+            prefix: The text typed so far.
+            limit: Maximum number of results.
+            
+        Returns:
+            The matching values and their labels, in key order.
+        """
+        index = self._index(kind)
+        key_prefix = self.normalize(prefix)
+        keys, positions = index["keys"], index["positions"]
+        
+        results = []
+        seen = set()
+        position = bisect.bisect_left(keys, key_prefix)
+        while position < len(keys) and len(results) < limit and keys[position].startswith(key_prefix):
+            entry = positions[position]
+            if entry not in seen:
+                seen.add(entry)
+                value, label = index["entries"][entry]
+                results.append({"value": value, "label": label})
+            position += 1
+        return results
+    
+    def suggest(self, kind: str, value: str, limit: int = 3) -> List[str]:
+        """
+        Find the known values closest to an unknown one.
+        
+        Args:
+            kind: The catalog kind.
+            value: The unknown value.
+            limit: Maximum number of suggestions.
+            
+        Returns:
+            The canonical values, closest first.
+        """
+        index = self._index(kind)
+        suggestions = []
+        for key in difflib.get_close_matches(self.normalize(value), index["keys"], n=limit * 3, cutoff=0.6):
+            suggestion = index["entries"][index["exact"][key]][0]
+            if suggestion not in suggestions:
+                suggestions.append(suggestion)
+        return suggestions[:limit]
+    
+    def validate_spec(self, infrastructure_spec: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Check the catalog values of a spec: its location ("global" for global resource types), an azurerm
+        resource type, and the region, VM size and storage properties among its additional properties.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+            
+        Returns:
+            A dictionary mapping the path of each unknown value to a description with suggestions.
+            Empty if everything is known or the catalog isn't loaded.
+        """
+        if not self.indexes:
+            return {}
+        
+        resource_type = str(infrastructure_spec.get("resource_type") or "")
+        checks = []
+        # Global resources such as DNS zones aren't deployed to a region
+        location = infrastructure_spec.get("location")
+        is_global = self.normalize(re.sub(r"^azurerm_", "", resource_type, flags=re.IGNORECASE)) in self.global_resource_types
+        if not (is_global and self.normalize(location or "") == "global"):
+            checks.append(("location", "locations", location))
+        if resource_type.lower().startswith("azurerm_"):
+            checks.append(("resource_type", "resource_types", resource_type))
+        
+        def collect(value: Any, path: str) -> None:
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    name = re.sub(r"[^a-z0-9]+", "_", str(key).lower()).strip("_")
+                    kind = self.PROPERTY_KINDS.get(name)
+                    if kind and isinstance(item, str):
+                        pattern = self.AMBIGUOUS_PROPERTIES.get(name)
+                        if pattern is None or pattern.match(item) or (kind == "storage_account_skus" and "storage" in resource_type.lower()):
+                            checks.append((f"{path}.{key}", kind, item))
+                    else:
+                        collect(item, f"{path}.{key}")
+            elif isinstance(value, list):
+                for position, item in enumerate(value):
+                    collect(item, f"{path}[{position}]")
+        
+        collect(infrastructure_spec.get("additional_properties") or {}, "additional_properties")
+        
+        problems = {}
+        for field, kind, value in checks:
+            if not isinstance(value, str) or not value or self.lookup(kind, value) is not None:
+                continue
+            problem = f"'{value}' is not a known {self.KIND_LABELS[kind]}"
+            suggestions = self.suggest(kind, value)
+            if suggestions:
+                problem += f", did you mean {' or '.join(suggestions)}?"
+            problems[field] = problem
+        return problems
+    
+    def get_info(self) -> Dict[str, Any]:
+        """
+        Describe the loaded catalog.
+        
+        Returns:
+            A dictionary with the catalog version and the number of values of each kind.
+        """
+        return {
+            "version": self.version,
+            "path": self.path,
+            "kinds": {kind: len(self._index(kind)["entries"]) for kind in self.KIND_LABELS}
+        }
+
+class ConversationalAgent:
+    """
+    Handles conversations with users and interprets their intents for cloud infrastructure operations.
+    Uses Claude AI for model inference.
+    """
+    
+    CONFIRMATION_PATTERN = re.compile(r"^\s*(?:yes|y|yep|yeah|sure|ok|okay|confirm(?:ed)?|use it|go ahead)(?:,?\s+please)?[\s.!]*$", re.IGNORECASE)
+    
+    def __init__(self, 
+                 anthropic_api_key: Optional[str] = None,
+                 model: Optional[str] = None,
+                 scheduler: Optional[ClaudeCallScheduler] = None,
+                 fallback_model: Optional[str] = None,
+                 transport: Optional[ClaudeTransport] = None,
+                 spec_cache: Optional[SpecCache] = None,
+                 catalog: Optional[AzureCatalog] = None):
+        """
+        Initialize the conversational agent.
+        
+        Args:
+            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
+            model: The Claude model to use. If None, it will use the extraction stage default.
+            scheduler: Scheduler shared by all Claude calls. If None, a private one is created.
+            fallback_model: The model used when the primary one fails or is too slow.
+            transport: Transport for the Claude calls. If None, one is created from the environment.
+            spec_cache: Index of earlier requests and their specs. If None, a private one is created.
+            catalog: Catalog extracted specs are checked against. If None, the bundled catalog is loaded.
+        """
+        # Set Anthropic configuration
+        self.api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
+        transport_mode = transport.mode if transport else ClaudeTransport.default_mode()
+        if not self.api_key and transport_mode != "replay":
+            raise ValueError("Anthropic API key is required. Please provide it or set ANTHROPIC_API_KEY environment variable.")
+        
+        # Intent and slot extraction is simple, so it defaults to a fast model
+        self.router = ModelRouter("extraction", model=model, fallback_model=fallback_model)
+        self.model = self.router.model
+        
+        # Initialize the Claude transport, which talks to the Anthropic API unless replaying a cassette
+        self.client = transport or ClaudeTransport(anthropic_api_key=self.api_key)
+        self.scheduler = scheduler or ClaudeCallScheduler()
+        self.spec_cache = spec_cache or SpecCache()
+        # Spec cache entries are only shared within this scope, set per tenant or session
+        self.spec_cache_scope = "default"
+        self.catalog = catalog or AzureCatalog()
+        # Most recent messages sent with each call once a usage budget is running low
+        self.economy_history_messages = int(os.getenv("ANTHROPIC_ECONOMY_HISTORY_MESSAGES", "5"))
+        
+        self.conversation_history = []
+        # User messages of the request being extracted, and a cached spec waiting for confirmation
+        self.pending_messages: List[str] = []
+        self.suggested_spec: Optional[Dict[str, Any]] = None
+        # Catalog problems already reported for the request, a value the user keeps anyway is accepted
+        self.catalog_warnings: List[str] = []
+        
+        # Example system message to guide the model behavior
+        self.system_message = """
+        You are an AI assistant that helps users create and manage cloud infrastructure on Azure using Terraform.
+        Your task is to interpret user requests for cloud infrastructure and translate them into detailed specifications.
+        
+        Required details for any infrastructure request:
+        - Subscription Name
+        - Resource Group Name
+        - Resource Name
+        - Resource Type
+        - Location 
+        
+        When a user requests infrastructure, extract the following information:
+        1. Resource types (e.g., VMs, storage, network components)
+        2. Resource specifications (e.g., VM sizes, storage capacities)
+        3. Relationships between resources
+        4. Resource Group Name and Location
+        5. Subscription name
+        
+        If ANY details are missing, you need to ask the user for these specific details before continuing.
+        
+        When you have all required information, respond with a valid JSON object containing the infrastructure specifications.
+        Format your JSON like this:
+        ```json
+        {
+          "subscription_name": "...",
+          "resource_group": "...",
+          "resource_name": "...",
+          "resource_type": "...",
+          "location": "...",
+          "additional_properties": { ... }
+        }
+        ```
+        """
+        
+    def process_message(self, user_message: str, budget_level: str = UsageBudget.NORMAL,
+                        cancel_check: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+        """
+        Process a user message and extract infrastructure requirements.
+        
+        Args:
+            user_message: The message from the user.
+            budget_level: The usage budget level of the session. ECONOMY uses the economy model with a
+                shorter history window, EXHAUSTED only answers from the spec cache.
+            cancel_check: Polled while Claude answers. When it returns True the call stops, the message is
+                left out of the history and CancelledError is raised.
+            
+        Returns:
+            A dictionary containing the interpreted infrastructure requirements or missing fields info.
+        """
+        # Answer a suggested spec without calling Claude
+        suggested_spec, self.suggested_spec = self.suggested_spec, None
+        if suggested_spec is not None and self.CONFIRMATION_PATTERN.match(user_message):
+            self.conversation_history.append({"role": "user", "content": user_message})
+            self.conversation_history.append({
+                "role": "assistant",
+                "content": f"```json\n{json.dumps(suggested_spec, indent=2)}\n```"
+            })
+            self.pending_messages = []
+            return suggested_spec
+        
+        # A new request may be a rephrasing of an earlier one
+        if not self.pending_messages:
+            match = self.spec_cache.lookup(user_message, self.spec_cache_scope)
+            if match is not None:
+                spec, similarity = match
+                message = (
+                    "This looks like an earlier request, which used this specification:\n\n"
+                    f"```json\n{json.dumps(spec, indent=2)}\n```\n\n"
+                    "Reply \"yes\" to use it, or tell me what should be different."
+                )
+                self.conversation_history.append({"role": "user", "content": user_message})
+                self.conversation_history.append({"role": "assistant", "content": message})
+                self.pending_messages = [user_message]
+                self.suggested_spec = spec
+                return {
+                    "needs_confirmation": True,
+                    "suggested_spec": spec,
+                    "similarity": similarity,
+                    "message": message
+                }
+        if budget_level == UsageBudget.EXHAUSTED:
+            return {
+                "error": "The Claude usage budget of this session is exhausted",
+                "raw_response": ""
+            }
+        self.pending_messages.append(user_message)
+        
+        # Add user message to history
+        self.conversation_history.append({"role": "user", "content": user_message})
+        
+        messages = self.conversation_history
+        economy = budget_level == UsageBudget.ECONOMY
+        if economy:
+            # Keep the latest turns, starting the window on a user turn as the API requires
+            messages = messages[-self.economy_history_messages:]
+            while messages and messages[0]["role"] != "user":
+                messages = messages[1:]
+        
+        # Call Anthropic API to get response
+        try:
+            # Chat turns are interactive, so they are scheduled ahead of code generation
+            response = self.router.call(lambda model: self.scheduler.call(
+                ClaudeCallScheduler.INTERACTIVE,
+                ClaudeCallScheduler.estimate_tokens(self.system_message, messages, 1024),
+                lambda: self.client.create_message(
+                    timeout=self.router.timeout_seconds,
+                    cancel_check=cancel_check,
+                    model=model,
+                    system=self.system_message,
+                    messages=messages,
+                    temperature=0.2,
+                    max_tokens=1024
+                )
+            ), economy=economy)
+            
+            # Extract the text response
+            assistant_message = response.content[0].text
+            
+            # Add the assistant's message to history
+            self.conversation_history.append({"role": "assistant", "content": assistant_message})
+            
+            # Check if the response is asking for more information
+            missing_fields_pattern = r"need.+?(?:information|details)|missing.+?(?:information|details)|provide.+?(?:information|details)"
+            asking_for_info = re.search(missing_fields_pattern, assistant_message, re.IGNORECASE)
+            
+            # Process the response
+            if asking_for_info:
+                # Extract which fields are being requested
+                missing_fields = []
+                if "subscription" in assistant_message.lower():
+                    missing_fields.append("subscription_name")
+                if "resource group" in assistant_message.lower():
+                    missing_fields.append("resource_group")
+                if "resource name" in assistant_message.lower():
+                    missing_fields.append("resource_name")
+                if "resource type" in assistant_message.lower():
+                    missing_fields.append("resource_type")
+                if "location" in assistant_message.lower():
+                    missing_fields.append("location")
+                
+                # If no specific fields were detected, ask for all
+                if not missing_fields:
+                    missing_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
+                
+                return {
+                    "needs_more_info": True,
+                    "missing_fields": missing_fields,
+                    "message": assistant_message
+                }
+            
+            # Try to parse JSON from the response
+            try:
+                # Look for JSON content in the message
+                json_match = re.search(r'```json\s*(.*?)\s*```', assistant_message, re.DOTALL)
+                if json_match:
+                    json_content = json_match.group(1)
+                    infrastructure_spec = json.loads(json_content)
+                else:
+                    # Try to find JSON content without code block markers
+                    json_start = assistant_message.find('{')
+                    json_end = assistant_message.rfind('}') + 1
+                    
+                    if json_start >= 0 and json_end > json_start:
+                        json_content = assistant_message[json_start:json_end]
+                        infrastructure_spec = json.loads(json_content)
+                    else:
+                        # If no JSON found, check for missing fields in the response
+                        required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
+                        # Check which fields are mentioned in the message to determine what's missing
+                        missing_fields = [field for field in required_fields if field.replace("_", " ") in assistant_message.lower()]
+                        
+                        if missing_fields:
+                            return {
+                                "needs_more_info": True,
+                                "missing_fields": missing_fields,
+                                "message": assistant_message
+                            }
+                        else:
+                            # Request all fields if we can't determine specific missing ones
+                            return {
+                                "needs_more_info": True,
+                                "missing_fields": required_fields,
+                                "message": "To generate the Terraform code, I need the following details:\n\n- Subscription Name\n- Resource Group Name\n- Resource Name\n- Resource Type\n- Location (Azure region)"
+                            }
+                
+                # Check if parsed JSON has all required fields
+                required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
+                missing_fields = [field for field in required_fields if field not in infrastructure_spec or not infrastructure_spec[field]]
+                
+                if missing_fields:
+                    return {
+                        "needs_more_info": True,
+                        "missing_fields": missing_fields,
+                        "message": f"I still need the following information: {', '.join(field.replace('_', ' ').title() for field in missing_fields)}"
+                    }
+                
+                # Catch typos before generation, the catalog may be older than Azure so a repeated value is trusted
+                invalid_fields = self.catalog.validate_spec(infrastructure_spec)
+                if any(problem not in self.catalog_warnings for problem in invalid_fields.values()):
+                    self.catalog_warnings.extend(invalid_fields.values())
+                    message = "Some values don't look right:\n\n" + "\n".join(
+                        f"- {field}: {problem}" for field, problem in invalid_fields.items()
+                    ) + "\n\nPlease correct them, or repeat them if they are right."
+                    # Part of the history so the correction is made against it
+                    self.conversation_history[-1]["content"] += f"\n\n{message}"
+                    return {
+                        "needs_more_info": True,
+                        "missing_fields": list(invalid_fields),
+                        "invalid_fields": invalid_fields,
+                        "message": message
+                    }
+                if invalid_fields:
+                    logger.info(f"Accepting values missing from the Azure catalog: {invalid_fields}")
+                
+                # Index the whole exchange, follow-up answers included, under the extracted spec
+                self.spec_cache.add("\n".join(self.pending_messages), infrastructure_spec, self.spec_cache_scope)
+                self.pending_messages = []
+                self.catalog_warnings = []
+                return infrastructure_spec
+                
+            except json.JSONDecodeError:
+                logger.error("Failed to parse JSON response from assistant")
+                # If JSON parsing fails, check if the response is asking for more information
+                required_fields = ["subscription_name", "resource_group", "resource_name", "resource_type", "location"]
+                
+                # If it seems to be asking for more info but we couldn't parse it properly
+                return {
+                    "needs_more_info": True,
+                    "missing_fields": required_fields,
+                    "message": "I need more information to generate the Terraform code. Please provide all of these details:\n\n- Subscription Name\n- Resource Group Name\n- Resource Name\n- Resource Type\n- Location (Azure region)"
+                }
+                    
+        except CancelledError:
+            # The message was never answered, so it isn't part of the conversation
+            self.conversation_history.pop()
+            self.pending_messages.pop()
+            raise
+        except Exception as e:
+            logger.error(f"Failed to call Claude API: {str(e)}")
+            return {
+                "error": f"Failed to call Claude API: {str(e)}",
+                "raw_response": ""
+            }
+    
+    def get_conversation_history(self) -> List[Dict[str, str]]:
+        """
+        Get the conversation history.
+        
+        Returns:
+            The conversation history.
+        """
+        return self.conversation_history
+    
+    def clear_conversation_history(self) -> None:
+        """
+        Clear the conversation history, keeping only the system message.
+        """
+        self.conversation_history = [self.conversation_history[0]]
+        self.pending_messages = []
+        self.suggested_spec = None
+        self.catalog_warnings = []
+
+class TerraformGenerator:
+    """
+    Generates Terraform HCL code based on infrastructure specifications.
+    Uses Claude AI for model inference.
+    """
+    
+    # Resource type keywords of the module templates used when the usage budget runs low
+    TEMPLATE_MODULES = [("storage", "storage"), ("virtualnetwork", "vnet"), ("vnet", "vnet")]
+    
+    def __init__(self, 
+                 anthropic_api_key: Optional[str] = None,
+                 model: Optional[str] = None,
+                 scheduler: Optional[ClaudeCallScheduler] = None,
+                 fallback_model: Optional[str] = None,
+                 transport: Optional[ClaudeTransport] = None,
+                 module_library: Optional["TerraformModuleLibrary"] = None):
+        """
+        Initialize the Terraform code generator.
+        
+        Args:
+            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
+            model: The Claude model to use. If None, it will use the generation stage default.
+            scheduler: Scheduler shared by all Claude calls. If None, a private one is created.
+            fallback_model: The model used when the primary one fails or is too slow.
+            transport: Transport for the Claude calls. If None, one is created from the environment.
+            module_library: The local modules generated code calls instead of writing resources inline.
+                If None, the default library is loaded.
+        """
+        # Set Anthropic configuration
+        self.api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
+        transport_mode = transport.mode if transport else ClaudeTransport.default_mode()
+        if not self.api_key and transport_mode != "replay":
+            raise ValueError("Anthropic API key is required. Please provide it or set ANTHROPIC_API_KEY environment variable.")
+        
+        # HCL generation needs a strong model
+        self.router = ModelRouter("generation", model=model, fallback_model=fallback_model)
+        self.model = self.router.model
+        
+        # Initialize the Claude transport, which talks to the Anthropic API unless replaying a cassette
+        self.client = transport or ClaudeTransport(anthropic_api_key=self.api_key)
+        self.scheduler = scheduler or ClaudeCallScheduler()
+        
+        # Identical concurrent generations share a single API call
+        self.single_flight = SingleFlight()
+        
+        self.module_library = module_library or TerraformModuleLibrary()
+        
+        # Output budget per call, and how many times a truncated generation is continued
+        self.max_output_tokens = int(os.getenv("ANTHROPIC_GENERATION_MAX_TOKENS", "4096"))
+        self.max_continuations = int(os.getenv("ANTHROPIC_GENERATION_MAX_CONTINUATIONS", "3"))
+        
+        # Candidate generations raced against each other, the first one passing the syntax check wins.
+        # With a hedge delay the extra candidates only start if no candidate passed by then.
+        self.candidates = max(1, int(os.getenv("ANTHROPIC_GENERATION_CANDIDATES", "1")))
+        self.hedge_delay_seconds = float(os.getenv("ANTHROPIC_GENERATION_HEDGE_DELAY_SECONDS", "0"))
+        self.candidate_temperature = float(os.getenv("ANTHROPIC_GENERATION_CANDIDATE_TEMPERATURE", "0.7"))
+        self.candidate_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("ANTHROPIC_GENERATION_CANDIDATE_WORKERS", "8")),
+            thread_name_prefix="generation-candidate"
+        )
+    
+    def estimate_max_tokens(self, infrastructure_spec: Dict[str, Any]) -> int:
+        """
+        Size the output budget of a generation to the complexity of the spec.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+            
+        Returns:
+            The max_tokens to request, between 2000 and the configured maximum.
+        """
+        def count_values(value: Any) -> int:
+            if isinstance(value, dict):
+                return sum(count_values(item) for item in value.values())
+            if isinstance(value, list):
+                return sum(count_values(item) for item in value) or 1
+            return 1
+        
+        # Provider, variables and outputs boilerplate, plus a few lines of HCL per spec value.
+        # A value usually becomes a single module argument when modules are available.
+        per_value = 40 if self.module_library.modules else 120
+        estimate = 1500 + per_value * count_values(infrastructure_spec)
+        return max(2000, min(estimate, self.max_output_tokens))
+    
+    def _create_message(self, system_prompt: str, messages: List[Dict[str, str]], max_tokens: int,
+                        economy: bool = False, temperature: float = 0.2,
+                        cancel_event: Optional[threading.Event] = None) -> Any:
+        """
+        Make a scheduled, routed generation call to the Claude API.
+        
+        Args:
+            system_prompt: The system prompt.
+            messages: The conversation messages.
+            max_tokens: The maximum number of output tokens.
+            economy: Whether to use the economy model.
+            temperature: The sampling temperature.
+            cancel_event: When set, the call stops mid-response with CancelledError.
+            
+        Returns:
+            The API response.
+        """
+        return self.router.call(lambda model: self.scheduler.call(
+            ClaudeCallScheduler.BATCH,
+            ClaudeCallScheduler.estimate_tokens(system_prompt, messages, max_tokens),
+            lambda: self.client.create_message(
+                timeout=self.router.timeout_seconds,
+                cancel_check=cancel_event.is_set if cancel_event is not None else None,
+                model=model,
+                system=system_prompt,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+        ), economy=economy)
+    
+    @staticmethod
+    def _response_text(response: Any) -> str:
+        """
+        Get the text of a response, which has no content blocks when Claude stops right away.
+        """
+        return "".join(getattr(block, "text", "") for block in response.content or [])
+    
+    def _generate_with_continuation(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                                    cancel_event: Optional[threading.Event] = None, economy: bool = False,
+                                    temperature: float = 0.2) -> str:
+        """
+        Generate text, continuing from the cut-off point whenever the output hits max_tokens.
+        
+        Args:
+            system_prompt: The system prompt.
+            user_prompt: The user prompt.
+            max_tokens: The maximum number of output tokens per call.
+            cancel_event: When set, the running call stops and CancelledError is raised.
+            economy: Whether to use the economy model.
+            temperature: The sampling temperature.
+            
+        Returns:
+            The stitched generated text.
+        """
+        response = self._create_message(system_prompt, [{"role": "user", "content": user_prompt}], max_tokens,
+                                        economy, temperature, cancel_event)
+        text = self._response_text(response)
+        
+        continuations = 0
+        while getattr(response, "stop_reason", None) == "max_tokens" and continuations < self.max_continuations:
+            if cancel_event is not None and cancel_event.is_set():
+                raise CancelledError("Generation was cancelled")
+            continuations += 1
+            logger.info(f"Generation truncated at {len(text)} characters, continuing ({continuations}/{self.max_continuations})")
+            
+            # Prefill the assistant turn with the partial output so Claude resumes exactly where it stopped.
+            # The API rejects a prefill ending in whitespace, so it is put back unless the continuation
+            # starts with the same kind of whitespace itself.
+            prefill = text.rstrip()
+            stripped = text[len(prefill):]
+            response = self._create_message(
+                system_prompt,
+                [{"role": "user", "content": user_prompt}, {"role": "assistant", "content": prefill}],
+                max_tokens,
+                economy,
+                temperature,
+                cancel_event
+            )
+            continuation = self._response_text(response)
+            if not continuation:
+                logger.warning("Continuation returned no text, keeping the truncated output")
+                text = prefill + stripped
+                break
+            
+            leading = continuation[:len(continuation) - len(continuation.lstrip())]
+            if not leading:
+                text = prefill + stripped + continuation
+            elif "\n" in stripped and "\n" not in leading:
+                # The continuation indents the next line itself, so only the stripped line break is put back
+                text = prefill + stripped[:stripped.rindex("\n") + 1] + continuation
+            else:
+                text = prefill + continuation
+        
+        if getattr(response, "stop_reason", None) == "max_tokens":
+            logger.warning(f"Generation still truncated after {continuations} continuations")
+        
+        return text
+    
+    def _generate_candidates(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                             cancel_event: Optional[threading.Event] = None, economy: bool = False) -> str:
+        """
+        Race several generations and keep the first one that passes the syntax check.
+        
+        The first candidate starts at once. The others start together with it, or one every hedge
+        delay while no candidate passed yet. Once a candidate passes, the others stop mid-response.
+        
+        Args:
+            system_prompt: The system prompt.
+            user_prompt: The user prompt.
+            max_tokens: The maximum number of output tokens per call.
+            cancel_event: When set, every candidate stops and CancelledError is raised.
+            economy: Whether to use the economy model. Economy generations are never raced.
+            
+        Returns:
+            The text of the winning candidate, or of the first finished one if none passed.
+        """
+        if self.candidates <= 1 or economy:
+            return self._generate_with_continuation(system_prompt, user_prompt, max_tokens, cancel_event, economy)
+        
+        candidate_events = []
+        running: Dict[Future, int] = {}
+        finished_text = None
+        first_error = None
+        
+        def launch() -> None:
+            index = len(candidate_events)
+            # Identical requests would fail identically, later candidates sample more freely
+            temperature = 0.2 if index == 0 else self.candidate_temperature
+            candidate_event = threading.Event()
+            candidate_events.append(candidate_event)
+            future = self.candidate_pool.submit(
+                contextvars.copy_context().run, self._generate_with_continuation,
+                system_prompt, user_prompt, max_tokens, candidate_event, economy, temperature
+            )
+            running[future] = index
+        
+        try:
+            launch()
+            next_launch = time.monotonic() + self.hedge_delay_seconds
+            while running or len(candidate_events) < self.candidates:
+                while len(candidate_events) < self.candidates and (time.monotonic() >= next_launch or not running):
+                    launch()
+                    next_launch = time.monotonic() + self.hedge_delay_seconds
+                
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CancelledError("Generation was cancelled")
+                
+                timeout = 0.5
+                if len(candidate_events) < self.candidates:
+                    timeout = min(timeout, max(0.0, next_launch - time.monotonic()))
+                done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        text = future.result()
+                    except CancelledError:
+                        continue
+                    except Exception as e:
+                        logger.warning(f"Generation candidate {index} failed: {str(e)}")
+                        first_error = first_error or e
+                        continue
+                    
+                    problem = self.check_syntax(self.parse_terraform_files(text))
+                    if problem is None:
+                        logger.info(f"Accepted generation candidate {index} of {len(candidate_events)} started")
+                        return text
+                    logger.warning(f"Generation candidate {index} rejected: {problem}")
+                    finished_text = finished_text if finished_text is not None else text
+        finally:
+            # Stop the losers mid-response, and drop the ones that haven't started
+            for candidate_event in candidate_events:
+                candidate_event.set()
+            for future in running:
+                future.cancel()
+        
+        if finished_text is not None:
+            logger.warning("No generation candidate passed the syntax check, returning the first one")
+            return finished_text
+        if first_error is None:
+            # Every candidate was cancelled before finishing
+            raise CancelledError("Every generation candidate was cancelled")
+        raise first_error
+    
+    @staticmethod
+    def check_syntax(terraform_files: Dict[str, str]) -> Optional[str]:
+        """
+        Quickly check the structure of Terraform files without running Terraform: every file must
+        consist of top-level blocks with balanced braces, brackets and parentheses, and every string,
+        comment and heredoc must be closed. Files may hold only comments, as long as some file has a block.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+            
+        Returns:
+            A description of the first problem found, or None if the files look well formed.
+        """
+        if not terraform_files:
+            return "no Terraform files"
+        
+        header_pattern = re.compile(r'[A-Za-z_][\w-]*(?:\s+(?:"[^"\n]*"|[A-Za-z_][\w-]*))*')
+        closers = {"{": "}", "[": "]", "(": ")"}
+        total_blocks = 0
+        
+        for file_name, content in terraform_files.items():
+            if not file_name.endswith(".tf"):
+                return f"{file_name} is not a Terraform file"
+            
+            # Open brackets, with "${" marking a template interpolation inside a string
+            stack: List[str] = []
+            top_level: List[str] = []
+            block_count = 0
+            index = 0
+            line = 1
+            in_string = False
+            
+            while index < len(content):
+                char = content[index]
+                pair = content[index:index + 2]
+                
+                if in_string:
+                    if not stack:
+                        top_level.append(char)
+                    if char == "\\":
+                        index += 2
+                        continue
+                    if char == '"':
+                        in_string = False
+                    elif pair in ("${", "%{"):
+                        stack.append("${")
+                        in_string = False
+                        index += 2
+                        continue
+                    elif char == "\n":
+                        return f"{file_name}:{line}: unterminated string"
+                    index += 1
+                    continue
+                
+                if char == "#" or pair == "//":
+                    end = content.find("\n", index)
+                    index = len(content) if end == -1 else end
+                    continue
+                if pair == "/*":
+                    end = content.find("*/", index + 2)
+                    if end == -1:
+                        return f"{file_name}:{line}: unterminated comment"
+                    line += content.count("\n", index, end)
+                    index = end + 2
+                    continue
+                
+                heredoc = re.match(r'<<-?([A-Za-z_][\w-]*)[ \t]*\n', content[index:index + 256]) if pair == "<<" else None
+                if heredoc:
+                    end = re.compile(rf'^[ \t]*{re.escape(heredoc.group(1))}[ \t]*$', re.MULTILINE).search(content, index + heredoc.end())
+                    if end is None:
+                        return f"{file_name}:{line}: unterminated heredoc {heredoc.group(1)}"
+                    line += content.count("\n", index, end.end())
+                    index = end.end()
+                    continue
+                
+                if char == "\n":
+                    line += 1
+                elif char == '"':
+                    in_string = True
+                elif char in closers:
+                    if not stack:
+                        if char != "{":
+                            return f"{file_name}:{line}: unexpected '{char}' outside of a block"
+                        header = " ".join("".join(top_level).split())
+                        if not header_pattern.fullmatch(header):
+                            return f"{file_name}:{line}: invalid block header '{header[:80]}'"
+                        top_level = []
+                        block_count += 1
+                    stack.append(char)
+                elif char in ("}", "]", ")"):
+                    if not stack:
+                        return f"{file_name}:{line}: unmatched '{char}'"
+                    opener = stack.pop()
+                    if opener == "${":
+                        if char != "}":
+                            return f"{file_name}:{line}: unmatched '{char}' in template interpolation"
+                        in_string = True
+                    elif closers[opener] != char:
+                        return f"{file_name}:{line}: expected '{closers[opener]}' but found '{char}'"
+                
+                if not stack and char not in ("{", "}"):
+                    top_level.append(char)
+                index += 1
+            
+            if in_string:
+                return f"{file_name}:{line}: unterminated string"
+            if stack:
+                return f"{file_name}: {len(stack)} unclosed '{stack[-1]}'"
+            leftover = " ".join("".join(top_level).split())
+            if leftover:
+                return f"{file_name}: unexpected content outside of a block '{leftover[:80]}'"
+            total_blocks += block_count
+        
+        # A file may hold only comments, like a placeholder outputs.tf, but the configuration needs blocks
+        if not total_blocks:
+            return "the Terraform files contain no blocks"
+        return None
+    
+    def render_template(self, infrastructure_spec: Dict[str, Any]) -> Optional[str]:
+        """
+        Render Terraform code for a spec from the module library, without calling Claude.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+            
+        Returns:
+            The Terraform code in the same format as a generation, or None if no module covers the resource type.
+        """
+        resource_type = re.sub(r"[^a-z]", "", str(infrastructure_spec.get("resource_type") or "").lower())
+        module_name = next(
+            (name for keyword, name in self.TEMPLATE_MODULES if keyword in resource_type and name in self.module_library.modules),
+            None
+        )
+        if module_name is None:
+            return None
+        module = self.module_library.modules[module_name]
+        
+        arguments = {
+            "name": infrastructure_spec.get("resource_name"),
+            "resource_group_name": "azurerm_resource_group.main.name",
+            "location": "azurerm_resource_group.main.location"
+        }
+        # Spec properties named after optional module inputs are passed through, JSON literals are valid HCL
+        properties = {
+            re.sub(r"[^a-z0-9]+", "_", str(key).lower()).strip("_"): value
+            for key, value in (infrastructure_spec.get("additional_properties") or {}).items()
+        }
+        required = [variable["name"] for variable in module["inputs"] if variable["required"]]
+        if any(name not in arguments and name not in properties for name in required):
+            return None
+        
+        lines = [f'module "{module_name}" {{', f'  source = "./modules/{module_name}"']
+        for variable in module["inputs"]:
+            name = variable["name"]
+            if name in ("resource_group_name", "location"):
+                lines.append(f"  {name} = {arguments[name]}")
+            elif name in arguments:
+                lines.append(f"  {name} = {json.dumps(arguments[name])}")
+            elif name in properties:
+                lines.append(f"  {name} = {json.dumps(properties[name])}")
+        lines.append("}")
+        
+        outputs = "\n\n".join(
+            f'output "{module_name}_{output}" {{\n  value = module.{module_name}.{output}\n}}' for output in module["outputs"]
+        )
+        return f"""# provider.tf
+```hcl
+terraform {{
+  required_providers {{
+    azurerm = {{
+      source = "hashicorp/azurerm"
+    }}
+  }}
+}}
+
+provider "azurerm" {{
+  features {{}}
+}}
+```
+
+# main.tf
+```hcl
+resource "azurerm_resource_group" "main" {{
+  name     = {json.dumps(infrastructure_spec.get("resource_group"))}
+  location = {json.dumps(infrastructure_spec.get("location"))}
+}}
+
+{chr(10).join(lines)}
+```
+
+# outputs.tf
+```hcl
+{outputs}
+```"""
+    
+    def generate_terraform_code(self, infrastructure_spec: Dict[str, Any],
+                                cancel_check: Optional[Callable[[], bool]] = None,
+                                budget_level: str = UsageBudget.NORMAL) -> str:
+        """
+        Generate Terraform HCL code based on the infrastructure specification.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+            cancel_check: Polled while waiting for the generation. Returning True raises CancelledError.
+            budget_level: The usage budget level of the session. Below NORMAL, code is rendered from a
+                module template when one covers the resource type, otherwise the economy model is used.
+            
+        Returns:
+            The generated Terraform HCL code as a string.
+        """
+        if budget_level != UsageBudget.NORMAL:
+            template = self.render_template(infrastructure_spec)
+            if template is not None:
+                logger.info(f"Usage budget is {budget_level}, rendering the {infrastructure_spec.get('resource_type')} template")
+                return template
+        economy = budget_level != UsageBudget.NORMAL
+        
+        # Prepare a detailed prompt for the Claude model to generate Terraform code
+        system_prompt = "You are an expert Terraform developer specializing in Azure infrastructure."
+        
+        user_prompt = f"""
+        Generate complete, valid Terraform HCL code for Azure to implement the following infrastructure specification:
+        
+        {json.dumps(infrastructure_spec, indent=2)}
+        
+        Include:
+        1. Provider configuration for Azure
+        2. Resource group definition
+        3. All required resources with appropriate configurations
+        4. Output definitions for important resource identifiers
+        
+        Use terraform best practices, including:
+        - Proper variable declarations
+        - Resource naming conventions
+        - Use of locals where appropriate
+        - Organized file structure (provider.tf, variables.tf, main.tf, outputs.tf)
+        
+        Return ONLY the Terraform code, grouped by file, with each file name as a markdown header.
+        Format the code with proper Terraform code blocks like:
+        
+        # provider.tf
+        ```hcl
+        provider "azurerm" {{
+          features {{}}
+        }}
+        ```
+        
+        # main.tf
+        ```hcl
+        // Terraform code
+        ```
+        """
+        
+        module_catalog = self.module_library.describe()
+        if module_catalog:
+            user_prompt += f"""
+        These vetted local modules are available:
+        
+        {module_catalog}
+        
+        Whenever a module covers a resource, call the module instead of writing its resources, for example
+        module "storage" {{ source = "./modules/storage" ... }}. Pass the required inputs and only the optional
+        inputs the specification sets. Refer to module results as module.<name>.<output>.
+        Don't write the module source files, they are provided.
+        """
+        
+        try:
+            max_tokens = self.estimate_max_tokens(infrastructure_spec)
+            
+            # Call Anthropic API to generate Terraform code, joining an identical in-flight call if there is one
+            request_key = SingleFlight.make_key("generate", self.model, system_prompt, user_prompt, max_tokens,
+                                                self.module_library.version, economy)
+            terraform_code = self.single_flight.do(
+                request_key,
+                lambda cancel_event: self._generate_candidates(system_prompt, user_prompt, max_tokens,
+                                                               cancel_event, economy),
+                cancel_check=cancel_check
+            )
+            
+            return terraform_code
+            
+        except CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to call Claude API: {str(e)}")
+            return f"Error generating Terraform code: {str(e)}"
+    
+    def parse_terraform_files(self, terraform_code: str) -> Dict[str, str]:
+        """
+        Parse the generated Terraform code into separate files.
+        
+        Args:
+            terraform_code: The Terraform code as a single string with markdown headers.
+            
+        Returns:
+            A dictionary mapping file names to their content.
+        """
+        files = {}
+        current_file = None
+        current_content = []
+        in_code_block = False
+        
+        # Split the code by lines
+        lines = terraform_code.strip().split('\n')
+        
+        for line in lines:
+            # Check if the line is a markdown header (file name)
+            header_match = re.match(r'^#+\s+(.+\.tf)$', line)
+            if header_match:
+                # Save the previous file if there was one
+                if current_file and current_content:
+                    files[current_file] = '\n'.join(current_content)
+                
+                # Start a new file
+                current_file = header_match.group(1)
+                current_content = []
+                in_code_block = False
+            elif line.strip().startswith('```') and not in_code_block:
+                # Start of code block - skip this line
+                in_code_block = True
+            elif line.strip().startswith('```') and in_code_block:
+                # End of code block - skip this line
+                in_code_block = False
+            elif current_file and in_code_block:
+                # We're inside a code block for the current file - add the line
+                current_content.append(line)
+        
+        # Save the last file
+        if current_file and current_content:
+            files[current_file] = '\n'.join(current_content)
+        
+        # If no files were found using markdown headers, assume it's a single file
+        if not files:
+            # Try to extract content from code blocks
+            code_blocks = re.findall(r'```(?:hcl|terraform)?\s*(.*?)\s*```', terraform_code, re.DOTALL)
+            if code_blocks:
+                # Combine all code blocks into main.tf
+                files["main.tf"] = '\n\n'.join(code_blocks)
+            else:
+                # Just extract all text as main.tf
+                files["main.tf"] = terraform_code.strip()
+        
+        return files
+
+
+class TerraformDependencyGraph:
+    """
+    Lightweight view of the top-level blocks in a set of Terraform files and the references between them.
+    Used to turn a change scope into `-target` addresses for plan/apply.
+    """
+    
+    BLOCK_HEADER_PATTERN = re.compile(
+        r'^[ \t]*(resource|data|module|variable|output|locals|provider|terraform)((?:[ \t]+"[^"\n]*")*)[ \t]*\{',
+        re.MULTILINE
+    )
+    REFERENCE_PATTERN = re.compile(
+        r'(?<![\w.])(data\.[A-Za-z_][\w-]*\.[A-Za-z_][\w-]*|(?:module|var|local)\.[A-Za-z_][\w-]*|[A-Za-z_][\w-]*\.[A-Za-z_][\w-]*)'
+    )
+    
+    def __init__(self, terraform_files: Optional[Dict[str, str]] = None):
+        """
+        Build the graph from Terraform files.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+        """
+        # Maps block address -> whitespace-normalized block body
+        self.blocks: Dict[str, str] = {}
+        # Maps block address -> addresses of the blocks it references
+        self.references: Dict[str, set] = {}
+        self.local_names: set = set()
+        
+        raw_bodies = {}
+        for file_name in sorted(terraform_files or {}):
+            for address, body in self._parse_blocks(terraform_files[file_name]):
+                # Multiple locals blocks are merged into a single node
+                raw_bodies[address] = raw_bodies.get(address, "") + body
+        
+        for address, body in raw_bodies.items():
+            self.blocks[address] = " ".join(body.split())
+            if address == "local":
+                self.local_names.update(re.findall(r'^\s*([A-Za-z_][\w-]*)\s*=', body, re.MULTILINE))
+        
+        for address, body in raw_bodies.items():
+            refs = set()
+            for reference in self.REFERENCE_PATTERN.findall(body):
+                if reference.startswith("local."):
+                    if reference.split(".", 1)[1] in self.local_names:
+                        refs.add("local")
+                elif reference in self.blocks:
+                    refs.add(reference)
+            refs.discard(address)
+            self.references[address] = refs
+    
+    def _parse_blocks(self, content: str) -> List[Tuple[str, str]]:
+        """
+        Split HCL content into (address, body) pairs for each top-level block.
+        
+        Args:
+            content: The HCL content of a single file.
+        
+        Returns:
+            A list of (address, body) tuples.
+        """
+        blocks = []
+        position = 0
+        while True:
+            match = self.BLOCK_HEADER_PATTERN.search(content, position)
+            if not match:
+                break
+            
+            body_end = self._find_block_end(content, match.end())
+            body = content[match.end():body_end]
+            position = body_end + 1
+            
+            block_type = match.group(1)
+            labels = re.findall(r'"([^"]*)"', match.group(2))
+            if block_type == "resource" and len(labels) == 2:
+                address = f"{labels[0]}.{labels[1]}"
+            elif block_type == "data" and len(labels) == 2:
+                address = f"data.{labels[0]}.{labels[1]}"
+            elif block_type == "variable" and labels:
+                address = f"var.{labels[0]}"
+            elif block_type in ["module", "output", "provider"] and labels:
+                address = f"{block_type}.{labels[0]}"
+            elif block_type == "locals":
+                address = "local"
+            elif block_type == "terraform":
+                address = "terraform"
+            else:
+                continue
+            
+            blocks.append((address, body))
+        
+        return blocks
+    
+    @staticmethod
+    def _find_block_end(content: str, start: int) -> int:
+        """
+        Find the index of the closing brace matching an already opened block.
+        
+        Args:
+            content: The HCL content.
+            start: The index just after the opening brace.
+        
+        Returns:
+            The index of the matching closing brace, or the end of the content.
+        """
+        depth = 1
+        index = start
+        in_string = False
+        while index < len(content):
+            char = content[index]
+            if in_string:
+                if char == '\\':
+                    index += 1
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '#' or content.startswith('//', index):
+                newline = content.find('\n', index)
+                index = len(content) if newline < 0 else newline
+                continue
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    return index
+            index += 1
+        return len(content)
+    
+    @staticmethod
+    def is_targetable(address: str) -> bool:
+        """
+        Check whether an address can be passed to `terraform -target`.
+        
+        Args:
+            address: The block address.
+        
+        Returns:
+            True for managed resources and module calls.
+        """
+        if address.startswith("module."):
+            return True
+        return "." in address and address.split(".", 1)[0] not in ["data", "var", "local", "output", "provider"]
+    
+    def changed_addresses(self, previous: "TerraformDependencyGraph") -> Optional[set]:
+        """
+        Compute the addresses whose definition differs from a previous version of the configuration.
+        
+        Args:
+            previous: The graph for the previous Terraform files.
+        
+        Returns:
+            The set of changed addresses, or None when provider/backend settings changed and the
+            whole configuration has to be planned.
+        """
+        changed = set()
+        for address in set(self.blocks) | set(previous.blocks):
+            if self.blocks.get(address) != previous.blocks.get(address):
+                changed.add(address)
+        
+        if any(address == "terraform" or address.startswith("provider.") for address in changed):
+            return None
+        return changed
+    
+    def addresses_for_resource_type(self, resource_type: str) -> set:
+        """
+        Find the resource blocks matching a resource type from an infrastructure spec.
+        
+        Args:
+            resource_type: The resource type as written in the spec (e.g. "Storage Account").
+        
+        Returns:
+            The matching resource addresses.
+        """
+        normalized = re.sub(r'[^a-z0-9]+', '_', resource_type.lower()).strip('_')
+        if not normalized:
+            return set()
+        return {
+            address for address in self.blocks
+            if self.is_targetable(address) and not address.startswith("module.")
+            and normalized in address.split(".", 1)[0]
+        }
+    
+    @staticmethod
+    def block_address(address: str) -> str:
+        """
+        Get the address of the block a target address belongs to, e.g. `module.app` for
+        `module.app.azurerm_linux_web_app.main` and `azurerm_subnet.main` for `azurerm_subnet.main[0]`.
+        
+        Args:
+            address: A resource, resource instance or module address.
+        
+        Returns:
+            The address of the top-level block.
+        """
+        address = re.sub(r'\[[^\]]*\]', '', address)
+        if address.startswith("module."):
+            return ".".join(address.split(".")[:2])
+        return address
+    
+    def dependency_closure(self, addresses: set) -> set:
+        """
+        Expand a set of addresses with every block that depends on them, directly or transitively.
+        Upstream dependencies are pulled in by Terraform itself when targeting.
+        
+        Args:
+            addresses: The starting addresses.
+        
+        Returns:
+            The expanded set of addresses.
+        """
+        dependents: Dict[str, set] = {}
+        for address, refs in self.references.items():
+            for ref in refs:
+                dependents.setdefault(ref, set()).add(address)
+        
+        closure = set(addresses)
+        pending = list(addresses)
+        while pending:
+            for dependent in dependents.get(self.block_address(pending.pop()), ()):
+                if dependent not in closure:
+                    closure.add(dependent)
+                    pending.append(dependent)
+        return closure
+    
+    def target_addresses(self, addresses: set) -> List[str]:
+        """
+        Translate a change scope into sorted `-target` addresses including dependents.
+        
+        Args:
+            addresses: The changed or explicitly requested addresses.
+        
+        Returns:
+            The addresses to pass to Terraform with `-target`.
+        """
+        return sorted(address for address in self.dependency_closure(addresses) if self.is_targetable(address))
+
+
+class TerraformModuleLibrary:
+    """
+    Vetted local Terraform modules the generator can call instead of writing resources inline.
+    Module calls are a fraction of the size of the resources they stand for, which cuts the output
+    tokens, and with them the latency, of every generation.
+    """
+    
+    SOURCE_PATTERN = re.compile(r'\bsource\s*=\s*"\./modules/([A-Za-z0-9_-]+)/?"')
+    
+    def __init__(self, root: Optional[str] = None):
+        """
+        Load the module library.
+        
+        Args:
+            root: Directory holding one subdirectory per module. If None, it will try to get from
+                environment variable, falling back to the modules directory next to this file.
+        """
+        self.root = root or os.getenv(
+            "TERRAFORM_MODULE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "modules")
+        )
+        # Module name -> {"files", "description", "inputs", "outputs"}
+        self.modules: Dict[str, Dict[str, Any]] = {}
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                module_path = os.path.join(self.root, name)
+                if os.path.isdir(module_path) and re.match(r"^[A-Za-z0-9_-]+$", name):
+                    module = self._load_module(module_path)
+                    if module["files"]:
+                        self.modules[name] = module
+        
+        # Part of the generation cache key, so changing a module invalidates generations that used it
+        version = hashlib.sha256()
+        for name, module in self.modules.items():
+            for file_name, content in sorted(module["files"].items()):
+                version.update(f"{name}/{file_name}\0{content}\0".encode("utf-8"))
+        self.version = version.hexdigest()
+        
+        logger.info(f"Loaded {len(self.modules)} Terraform modules from {self.root}")
+    
+    @staticmethod
+    def _load_module(module_path: str) -> Dict[str, Any]:
+        """
+        Read a module and describe its interface.
+        
+        Args:
+            module_path: The module directory.
+            
+        Returns:
+            A dictionary containing the module files, description, inputs and outputs.
+        """
+        files = {}
+        for file_name in sorted(os.listdir(module_path)):
+            if file_name.endswith(".tf"):
+                with open(os.path.join(module_path, file_name), 'r') as f:
+                    files[file_name] = f.read()
+        
+        # The leading comment of main.tf describes the module
+        description_lines = []
+        for line in files.get("main.tf", "").splitlines():
+            if not line.startswith("#"):
+                break
+            description_lines.append(line.lstrip("# ").strip())
+        
+        graph = TerraformDependencyGraph(files)
+        inputs = []
+        outputs = []
+        for address, body in graph.blocks.items():
+            if address.startswith("var."):
+                description = re.search(r'\bdescription\s*=\s*"((?:[^"\\]|\\.)*)"', body)
+                variable_type = re.search(r'\btype\s*=\s*([a-z]+(?:\([a-z]+\))?)', body)
+                inputs.append({
+                    "name": address[len("var."):],
+                    "type": variable_type.group(1) if variable_type else "any",
+                    "required": not re.search(r'\bdefault\s*=', body),
+                    "description": description.group(1).replace('\\"', '"') if description else ""
+                })
+            elif address.startswith("output."):
+                outputs.append(address[len("output."):])
+        
+        return {
+            "files": files,
+            "description": " ".join(description_lines),
+            "inputs": inputs,
+            "outputs": outputs
+        }
+    
+    def describe(self) -> str:
+        """
+        Describe the modules for the generation prompt.
+        
+        Returns:
+            The module interfaces, one module per paragraph. Empty if there are no modules.
+        """
+        paragraphs = []
+        for name, module in self.modules.items():
+            lines = [f'module source "./modules/{name}": {module["description"]}']
+            for variable in module["inputs"]:
+                requirement = "required" if variable["required"] else "optional"
+                lines.append(f'  input {variable["name"]} ({variable["type"]}, {requirement}): {variable["description"]}')
+            lines.append(f'  outputs: {", ".join(module["outputs"])}')
+            paragraphs.append("\n".join(lines))
+        return "\n\n".join(paragraphs)
+    
+    def referenced_modules(self, terraform_files: Dict[str, str]) -> List[str]:
+        """
+        Find the library modules a set of Terraform files calls.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+            
+        Returns:
+            The sorted names of the called modules.
+        """
+        names = set()
+        for content in terraform_files.values():
+            names.update(self.SOURCE_PATTERN.findall(content))
+        return sorted(name for name in names if name in self.modules)
+    
+    def files_for(self, terraform_files: Dict[str, str]) -> Dict[str, str]:
+        """
+        Get the module files a set of Terraform files needs, keyed by their path relative to the root module.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+            
+        Returns:
+            A dictionary mapping "modules/<name>/<file>" paths to their content.
+        """
+        return {
+            f"modules/{name}/{file_name}": content
+            for name in self.referenced_modules(terraform_files)
+            for file_name, content in self.modules[name]["files"].items()
+        }
+    
+    def install(self, directory: str, terraform_files: Dict[str, str]) -> List[str]:
+        """
+        Copy the modules a set of Terraform files calls into its working directory.
+        
+        Args:
+            directory: The working directory of the Terraform files.
+            terraform_files: A dictionary mapping file names to their content.
+            
+        Returns:
+            The names of the installed modules.
+        """
+        modules_path = os.path.join(directory, "modules")
+        # Replace the previous copy so a persistent workspace never runs an outdated module
+        shutil.rmtree(modules_path, ignore_errors=True)
+        
+        names = self.referenced_modules(terraform_files)
+        for path, content in self.files_for(terraform_files).items():
+            file_path = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                f.write(content)
+        return names
+
+class TerraformPlanReader:
+    """
+    Incrementally reads the output of `terraform show -json` and yields one resource change at a time.
+    Only a single resource change is held in memory, so very large plans can be summarized safely.
+    """
+    
+    CHUNK_SIZE = 65536
+    STRUCTURE_PATTERN = re.compile(r'["{}\[\]]')
+    STRING_PATTERN = re.compile(r'["\\]')
+    SCALAR_END_PATTERN = re.compile(r'[\s,\]}]')
+    
+    def __init__(self, stream):
+        """
+        Initialize the plan reader.
+        
+        Args:
+            stream: A text file object containing the plan JSON.
+        """
+        self.stream = stream
+        self.buffer = ""
+        self.position = 0
+    
+    def _fill(self) -> bool:
+        """
+        Read the next chunk from the stream, dropping the consumed part of the buffer.
+        
+        Returns:
+            False when the stream is exhausted.
+        """
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+    
+    def _consume(self, end: int, parts: Optional[List[str]]) -> None:
+        """
+        Advance the read position, optionally keeping the consumed text.
+        
+        Args:
+            end: The buffer index to advance to.
+            parts: A list collecting the consumed text, or None to discard it.
+        """
+        if parts is not None:
+            parts.append(self.buffer[self.position:end])
+        self.position = end
+    
+    def _peek(self) -> str:
+        """
+        Skip whitespace and return the next character without consuming it.
+        
+        Returns:
+            The next character, or an empty string at the end of the stream.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+    
+    def _expect(self, char: str) -> None:
+        """
+        Consume the next non-whitespace character, which must be `char`.
+        
+        Args:
+            char: The expected character.
+        """
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Malformed plan JSON: expected '{char}' but found '{found}'")
+        self.position += 1
+    
+    def _scan_value(self, capture: bool) -> Optional[str]:
+        """
+        Consume one JSON value without decoding it.
+        
+        Args:
+            capture: Whether to return the raw text of the value.
+        
+        Returns:
+            The raw JSON text of the value if `capture` is set, otherwise None.
+        """
+        parts = [] if capture else None
+        first = self._peek()
+        if not first:
+            raise ValueError("Malformed plan JSON: unexpected end of input")
+        
+        if first not in '"{[':
+            # Scalar value (number, true, false, null)
+            while True:
+                match = self.SCALAR_END_PATTERN.search(self.buffer, self.position)
+                if match:
+                    self._consume(match.start(), parts)
+                    break
+                self._consume(len(self.buffer), parts)
+                if not self._fill():
+                    break
+            return "".join(parts) if capture else None
+        
+        depth = 0
+        in_string = False
+        while True:
+            pattern = self.STRING_PATTERN if in_string else self.STRUCTURE_PATTERN
+            match = pattern.search(self.buffer, self.position)
+            if not match:
+                self._consume(len(self.buffer), parts)
+                if not self._fill():
+                    raise ValueError("Malformed plan JSON: unexpected end of input")
+                continue
+            
+            char = match.group()
+            self._consume(match.end(), parts)
+            if char == '\\':
+                # Keep the escaped character together with the backslash
+                if self.position >= len(self.buffer) and not self._fill():
+                    raise ValueError("Malformed plan JSON: unexpected end of input")
+                self._consume(self.position + 1, parts)
+            elif char == '"':
+                in_string = not in_string
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+            
+            if not in_string and depth == 0:
+                return "".join(parts) if capture else None
+    
+    def iter_resource_changes(self):
+        """
+        Iterate over the `resource_changes` entries of the plan.
+        
+        Yields:
+            One decoded resource change dictionary at a time.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        
+        while True:
+            key = json.loads(self._scan_value(capture=True))
+            self._expect(':')
+            
+            if key == "resource_changes" and self._peek() == '[':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield json.loads(self._scan_value(capture=True))
+                        separator = self._peek()
+                        self.position += 1
+                        if separator == ']':
+                            break
+                        if separator != ',':
+                            raise ValueError(f"Malformed plan JSON: unexpected '{separator}' in resource_changes")
+            else:
+                self._scan_value(capture=False)
+            
+            separator = self._peek()
+            self.position += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"Malformed plan JSON: unexpected '{separator}' in plan object")
+    
+    @staticmethod
+    def action_label(actions: List[str]) -> str:
+        """
+        Collapse a Terraform change action list into a single label.
+        
+        Args:
+            actions: The `change.actions` list of a resource change.
+        
+        Returns:
+            One of create, update, delete, replace, read or no-op.
+        """
+        if "create" in actions and "delete" in actions:
+            return "replace"
+        return actions[0] if actions else "no-op"
+    
+    def summarize(self) -> Dict[str, Any]:
+        """
+        Build a compact per-resource summary of the plan.
+        
+        Returns:
+            A dictionary with action counts and the list of changed resources.
+        """
+        counts = {"create": 0, "update": 0, "delete": 0, "replace": 0, "read": 0, "no-op": 0}
+        resources = []
+        
+        for resource_change in self.iter_resource_changes():
+            action = self.action_label(resource_change.get("change", {}).get("actions", []))
+            counts[action] = counts.get(action, 0) + 1
+            if action != "no-op":
+                resources.append({
+                    "address": resource_change.get("address"),
+                    "type": resource_change.get("type"),
+                    "action": action
+                })
+        
+        return {
+            "counts": counts,
+            "resources": resources
+        }
+    
+    @staticmethod
+    def format_summary(summary: Dict[str, Any]) -> str:
+        """
+        Format a plan summary as readable text.
+        
+        Args:
+            summary: The summary returned by `summarize`.
+        
+        Returns:
+            The plan summary as text.
+        """
+        symbols = {"create": "+", "update": "~", "delete": "-", "replace": "-/+", "read": "<="}
+        counts = summary["counts"]
+        lines = [f"Plan: {counts['create'] + counts['replace']} to add, {counts['update']} to change, "
+                 f"{counts['delete'] + counts['replace']} to destroy."]
+        for resource in summary["resources"]:
+            lines.append(f"  {symbols.get(resource['action'], '?')} {resource['address']} ({resource['action']})")
+        if not summary["resources"]:
+            lines.append("No changes. Your infrastructure matches the configuration.")
+        return "\n".join(lines)
+
+
+class WorkspaceLockManager:
+    """
+    Serializes Terraform runs per workspace while runs in different workspaces proceed in parallel.
+    Waiters within a process queue up in arrival order, and the holder also takes an exclusive file lock
+    per workspace, so gunicorn workers sharing the workspace root exclude each other as well.
+    Interactive runs waiting on another process leave a marker, so background holders can yield to them.
+    Lock files and markers live outside the workspaces, so removing a workspace never replaces a lock
+    someone holds or waits for.
+    """
+    
+    LOCKS_DIR_NAME = ".terraform-agent-locks"
+    
+    def __init__(self, workspace_root: str, timeout_seconds: Optional[float] = None):
+        """
+        Initialize the lock manager.
+        
+        Args:
+            workspace_root: The directory holding the workspaces.
+            timeout_seconds: How long a run waits for its workspace by default. If None, it will try to get
+                from environment variable.
+        """
+        self.workspace_root = workspace_root
+        self.locks_dir = os.path.join(workspace_root, self.LOCKS_DIR_NAME)
+        self.timeout_seconds = timeout_seconds if timeout_seconds is not None else float(
+            os.getenv("TERRAFORM_WORKSPACE_LOCK_TIMEOUT", "300"))
+        
+        self.lock = threading.Lock()
+        # Workspace -> {"condition", "queue", "background"}. The head of the queue holds the workspace,
+        # background holds only take it when it is free and yield to interactive waiters.
+        self.workspaces: Dict[str, Dict[str, Any]] = {}
+        self.stats = {
+            "acquisitions": 0,
+            "contended_acquisitions": 0,
+            "timeouts": 0,
+            "cancellations": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0
+        }
+    
+    @contextlib.contextmanager
+    def hold(self, workspace_id: str, timeout: Optional[float] = None,
+             cancel_check: Optional[Callable[[], bool]] = None, background: bool = False):
+        """
+        Hold a workspace exclusively for the duration of the context.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            timeout: How long to wait for the workspace, 0 to give up at once. If None, the default timeout is used.
+            cancel_check: Polled while waiting. When it returns True the wait ends with CancelledError.
+            background: Whether the holder is background work, which should stop when `interactive_waiting`
+                turns True. Background waiters don't announce themselves to other processes.
+            
+        Raises:
+            TimeoutError: If the workspace didn't become free in time.
+            CancelledError: If the wait was cancelled.
+        """
+        started = time.monotonic()
+        deadline = started + (self.timeout_seconds if timeout is None else timeout)
+        ticket = object()
+        
+        with self.lock:
+            entry = self.workspaces.get(workspace_id)
+            if entry is None:
+                entry = {"condition": threading.Condition(self.lock), "queue": deque(), "background": set()}
+                self.workspaces[workspace_id] = entry
+            entry["queue"].append(ticket)
+            if background:
+                entry["background"].add(ticket)
+            contended = len(entry["queue"]) > 1
+            try:
+                while entry["queue"][0] is not ticket:
+                    self._check_wait(workspace_id, deadline, cancel_check)
+                    entry["condition"].wait(min(0.5, max(0.0, deadline - time.monotonic())))
+            except BaseException:
+                self._leave(workspace_id, entry, ticket)
+                raise
+        
+        # First in line in this process, now exclude the other processes
+        try:
+            lock_fd = self._lock_file(workspace_id, deadline, cancel_check, announce=not background)
+        except BaseException:
+            with self.lock:
+                self._leave(workspace_id, entry, ticket)
+            raise
+        
+        waited = time.monotonic() - started
+        with self.lock:
+            self.stats["acquisitions"] += 1
+            self.stats["total_wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+            if contended or waited > 0.05:
+                self.stats["contended_acquisitions"] += 1
+        StageTimings.record("workspace_lock_wait", waited)
+        
+        try:
+            yield
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)  # Closing releases the file lock
+            with self.lock:
+                self._leave(workspace_id, entry, ticket)
+    
+    def _check_wait(self, workspace_id: str, deadline: float, cancel_check: Optional[Callable[[], bool]]) -> None:
+        """
+        End a wait that timed out or was cancelled. Must be called with the lock held.
+        """
+        if cancel_check is not None and cancel_check():
+            self.stats["cancellations"] += 1
+            raise CancelledError(f"Waiting for workspace {workspace_id} was cancelled")
+        if time.monotonic() >= deadline:
+            self.stats["timeouts"] += 1
+            raise TimeoutError(f"Workspace {workspace_id} is busy with another Terraform operation")
+    
+    def _leave(self, workspace_id: str, entry: Dict[str, Any], ticket: object) -> None:
+        """
+        Remove a ticket from a workspace queue and wake the next waiter. Must be called with the lock held.
+        """
+        entry["queue"].remove(ticket)
+        entry["background"].discard(ticket)
+        if entry["queue"]:
+            entry["condition"].notify_all()
+        elif self.workspaces.get(workspace_id) is entry:
+            del self.workspaces[workspace_id]
+    
+    def _lock_file(self, workspace_id: str, deadline: float,
+                   cancel_check: Optional[Callable[[], bool]], announce: bool = False) -> Optional[int]:
+        """
+        Take the exclusive file lock of a workspace, polling until the deadline.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            deadline: The monotonic time to give up at.
+            cancel_check: Polled while waiting.
+            announce: Whether to leave a waiter marker for other processes while waiting.
+        
+        Returns:
+            The open lock file descriptor, or None where file locks aren't available.
+        """
+        if fcntl is None:
+            return None
+        
+        os.makedirs(self.locks_dir, exist_ok=True)
+        lock_fd = os.open(os.path.join(self.locks_dir, f"{workspace_id}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        marker_path = None
+        delay = 0.05
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # The workspace may have been removed while it was idle
+                    os.makedirs(os.path.join(self.workspace_root, workspace_id), exist_ok=True)
+                    return lock_fd
+                except BlockingIOError:
+                    pass
+                if announce and marker_path is None:
+                    waiters_path = self._waiters_path(workspace_id)
+                    os.makedirs(waiters_path, exist_ok=True)
+                    marker_path = os.path.join(waiters_path, f"{os.getpid()}-{uuid.uuid4().hex}")
+                    open(marker_path, 'w').close()
+                with self.lock:
+                    self._check_wait(workspace_id, deadline, cancel_check)
+                time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+                delay = min(delay * 2, 0.5)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        finally:
+            if marker_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(marker_path)
+    
+    def _waiters_path(self, workspace_id: str) -> str:
+        """
+        Get the directory of the markers left by interactive runs of other processes waiting for a workspace.
+        """
+        return os.path.join(self.locks_dir, f"{workspace_id}.waiters")
+    
+    def interactive_waiting(self, workspace_id: str) -> bool:
+        """
+        Check whether an interactive run waits for a workspace, in this or any other process.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            True if background work holding the workspace should give it up.
+        """
+        with self.lock:
+            entry = self.workspaces.get(workspace_id)
+            if entry is not None and any(ticket not in entry["background"] for ticket in list(entry["queue"])[1:]):
+                return True
+        
+        waiters_path = self._waiters_path(workspace_id)
+        try:
+            markers = os.listdir(waiters_path)
+        except FileNotFoundError:
+            return False
+        for marker in markers:
+            try:
+                # Signal 0 only checks that the waiting process is still alive
+                os.kill(int(marker.split("-", 1)[0]), 0)
+                return True
+            except PermissionError:
+                return True
+            except (ValueError, ProcessLookupError):
+                # Left behind by a process that died while waiting
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(waiters_path, marker))
+        return False
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the lock contention metrics.
+        
+        Returns:
+            A dictionary with the busy workspaces, waiters and wait statistics.
+        """
+        with self.lock:
+            waiting = {workspace_id: len(entry["queue"]) - 1 for workspace_id, entry in self.workspaces.items()}
+            acquisitions = self.stats["acquisitions"]
+            return {
+                "held": len(waiting),
+                "waiting": sum(waiting.values()),
+                "most_contended": sorted(
+                    ({"workspace_id": workspace_id, "waiting": count} for workspace_id, count in waiting.items() if count),
+                    key=lambda item: -item["waiting"]
+                )[:10],
+                "timeout_seconds": self.timeout_seconds,
+                **self.stats,
+                "average_wait_seconds": self.stats["total_wait_seconds"] / acquisitions if acquisitions else 0.0
+            }
+
+class TerraformResultCache:
+    """
+    Keeps the results of successful validate and plan runs, so repeating an operation on unchanged
+    code returns at once. Callers key the results on everything the run depends on, so any change
+    misses the cache, and plans additionally expire because they also depend on the real infrastructure.
+    """
+    
+    def __init__(self, max_entries: Optional[int] = None, validate_ttl_seconds: Optional[float] = None,
+                 plan_ttl_seconds: Optional[float] = None):
+        """
+        Initialize the result cache.
+        
+        Args:
+            max_entries: Maximum number of cached results, the least recently used are evicted. 0 disables
+                the cache. If None, it will try to get from environment variable.
+            validate_ttl_seconds: How long a validate result is kept. If None, it will try to get from environment variable.
+            plan_ttl_seconds: How long a plan result is kept. If None, it will try to get from environment variable.
+        """
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("TERRAFORM_RESULT_CACHE_MAX_ENTRIES", "500"))
+        self.ttl_seconds = {
+            "validate": validate_ttl_seconds if validate_ttl_seconds is not None else float(
+                os.getenv("TERRAFORM_VALIDATE_CACHE_TTL_SECONDS", "86400")),
+            "plan": plan_ttl_seconds if plan_ttl_seconds is not None else float(
+                os.getenv("TERRAFORM_PLAN_CACHE_TTL_SECONDS", "60"))
+        }
+        
+        self.lock = threading.Lock()
+        # Key -> (expiry time, result), in least recently used order
+        self.entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.stats = {operation: {"hits": 0, "misses": 0} for operation in self.ttl_seconds}
+    
+    def get(self, operation: str, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached result.
+        
+        Args:
+            operation: The operation the result belongs to, validate or plan.
+            key: The key built from everything the operation depends on.
+            
+        Returns:
+            A copy of the cached result marked as cached, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.stats[operation]["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats[operation]["hits"] += 1
+        
+        result = copy.deepcopy(entry[1])
+        result["cached"] = True
+        return result
+    
+    def put(self, operation: str, key: str, result: Dict[str, Any]) -> None:
+        """
+        Cache the result of a successful run.
+        
+        Args:
+            operation: The operation the result belongs to, validate or plan.
+            key: The key built from everything the operation depends on.
+            result: The result returned to the caller.
+        """
+        if self.max_entries <= 0 or not result.get("success"):
+            return
+        
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl_seconds[operation], copy.deepcopy(result))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the cache size and hit rates.
+        
+        Returns:
+            A dictionary containing the cache metrics.
+        """
+        with self.lock:
+            metrics = {"entries": len(self.entries), "max_entries": self.max_entries}
+            for operation, stats in self.stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                metrics[operation] = {
+                    **stats,
+                    "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+                    "ttl_seconds": self.ttl_seconds[operation]
+                }
+            return metrics
+
+class TerraformExecutor:
+    """
+    Executes Terraform commands on the generated code.
+    """
+    
+    # Every executor of the process, so a single exit hook and signal handler stop the commands of all of them
+    instances: "weakref.WeakSet[TerraformExecutor]" = weakref.WeakSet()
+    shutdown_lock = threading.Lock()
+    exit_hook_registered = False
+    shutdown_handler_installed = False
+    
+    def __init__(self, module_library: Optional[TerraformModuleLibrary] = None):
+        """
+        Initialize the Terraform executor.
+        
+        Args:
+            module_library: The local modules generated code may call. If None, the default library is loaded.
+        """
+        # Verify terraform is installed
+        try:
+            subprocess.run(["terraform", "--version"], check=True, capture_output=True)
+        except (subprocess.SubprocessError, FileNotFoundError):
+            logger.error("Terraform not found. Please install Terraform and make sure it's in your PATH.")
+            raise RuntimeError("Terraform not found")
+        
+        # Set up Azure credentials
+        self.credential = DefaultAzureCredential()
+        self.subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+        if not self.subscription_id:
+            raise ValueError("Azure subscription ID is required. Please set AZURE_SUBSCRIPTION_ID environment variable.")
+        
+        # Copied into the working directory of code calling them
+        self.module_library = module_library or TerraformModuleLibrary()
+        
+        # Initialize resource client. The endpoint can point at a sovereign cloud or a local ARM stand-in.
+        self.resource_client = ResourceManagementClient(
+            self.credential,
+            self.subscription_id,
+            base_url=os.getenv("AZURE_RESOURCE_MANAGER_URL", "https://management.azure.com")
+        )
+        
+        # Directory where JSON plans are kept so the full plan can be fetched on demand
+        self.plan_directory = os.getenv("TERRAFORM_PLAN_DIR", os.path.join(tempfile.gettempdir(), "terraform-agent-plans"))
+        self.max_saved_plans = int(os.getenv("TERRAFORM_MAX_SAVED_PLANS", "20"))
+        os.makedirs(self.plan_directory, exist_ok=True)
+        
+        # Directory where operation output is spooled, only the tail is kept in memory
+        self.log_directory = os.getenv("TERRAFORM_LOG_DIR", os.path.join(tempfile.gettempdir(), "terraform-agent-logs"))
+        self.max_saved_logs = int(os.getenv("TERRAFORM_MAX_SAVED_LOGS", "50"))
+        self.output_tail_lines = int(os.getenv("TERRAFORM_OUTPUT_TAIL_LINES", "200"))
+        os.makedirs(self.log_directory, exist_ok=True)
+        
+        # Persistent workspaces keep state and initialized providers between operations
+        self.workspace_root = os.getenv("TERRAFORM_WORKSPACE_ROOT", os.path.join(tempfile.gettempdir(), "terraform-agent-workspaces"))
+        os.makedirs(self.workspace_root, exist_ok=True)
+        # One Terraform run per workspace at a time, across threads and worker processes
+        self.workspace_locks = WorkspaceLockManager(self.workspace_root)
+        # Workspaces without deployed resources are removed once unused for this long, 0 keeps them forever
+        self.workspace_idle_seconds = float(os.getenv("TERRAFORM_WORKSPACE_IDLE_SECONDS", "604800"))
+        self.workspace_prune_interval = float(os.getenv("TERRAFORM_WORKSPACE_PRUNE_INTERVAL", "3600"))
+        self.last_workspace_prune = 0.0
+        
+        # Shared provider cache so init never downloads the same provider twice
+        self.plugin_cache_dir = os.getenv("TF_PLUGIN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "terraform-agent-plugin-cache"))
+        os.makedirs(self.plugin_cache_dir, exist_ok=True)
+        
+        # Background workspace preparation, overlapping provider download with code generation
+        self.preparation_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("TERRAFORM_PREPARE_WORKERS", "4")),
+            thread_name_prefix="terraform-prepare"
+        )
+        self.preparations: Dict[str, Future] = {}
+        self.preparations_lock = threading.Lock()
+        
+        # Running interactive operations per workspace, so background work can stay out of their way.
+        # Every operation also leaves a marker under the workspace root, so the other workers see it too.
+        self.active_operations: Dict[Optional[str], int] = {}
+        self.active_operations_lock = threading.Lock()
+        self.active_operations_dir = os.path.join(self.workspace_root, ".terraform-agent-active")
+        os.makedirs(self.active_operations_dir, exist_ok=True)
+        
+        # Deadline of each terraform command, after which its whole process group is stopped
+        default_timeouts = {"init": 600, "validate": 120, "plan": 1800, "apply": 3600, "destroy": 3600, "show": 300}
+        self.operation_timeouts = {
+            operation: float(os.getenv(f"TERRAFORM_TIMEOUT_{operation.upper()}", str(default)))
+            for operation, default in default_timeouts.items()
+        }
+        # Time Terraform gets after an interrupt to release its lock and persist state before it is killed
+        self.kill_grace_seconds = float(os.getenv("TERRAFORM_KILL_GRACE_SECONDS", "30"))
+        
+        # Commands run in their own session and would outlive this process, keeping the state lock
+        # and writing the workspace without a watchdog, so they are stopped when the process exits
+        self.running_processes: Dict[int, subprocess.Popen] = {}
+        self.running_processes_lock = threading.Lock()
+        TerraformExecutor.instances.add(self)
+        # Only possible on the main thread, the web app installs the handler when it is imported
+        self.install_shutdown_handler()
+    
+    def _terraform_env(self, subscription_id: Optional[str] = None) -> Dict[str, str]:
+        """
+        Build the environment for Terraform commands.
+        
+        Args:
+            subscription_id: The Azure subscription to deploy to. If None, the default subscription is used.
+        
+        Returns:
+            The environment variables including Azure credentials.
+        """
+        # Set Azure credentials environment variables for Terraform
+        env = os.environ.copy()
+        env["ARM_CLIENT_ID"] = os.getenv("AZURE_CLIENT_ID", "")
+        env["ARM_CLIENT_SECRET"] = os.getenv("AZURE_CLIENT_SECRET", "")
+        env["ARM_SUBSCRIPTION_ID"] = subscription_id or self.subscription_id
+        env["ARM_TENANT_ID"] = os.getenv("AZURE_TENANT_ID", "")
+        env["TF_LOG"] = "INFO"  # Enable Terraform logging
+        env["TF_PLUGIN_CACHE_DIR"] = self.plugin_cache_dir
+        # Since Terraform 1.4 the cache is only used for providers the lock file already lists. Workspaces
+        # and temporary directories start without one, so allow the cache to fill the lock file instead
+        env["TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE"] = "true"
+        env["TF_IN_AUTOMATION"] = "1"
+        return env
+    
+    def get_workspace_path(self, workspace_id: str) -> str:
+        """
+        Get the directory of a persistent workspace.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The path of the workspace directory.
+        """
+        if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', workspace_id or ""):
+            raise ValueError(f"Invalid workspace ID: {workspace_id}")
+        return os.path.join(self.workspace_root, workspace_id)
+    
+    def prepare_workspace_async(self, workspace_id: str, provider_requirements: Dict[str, str]) -> Future:
+        """
+        Start initializing a workspace with the given providers in the background.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            provider_requirements: A dictionary mapping provider names to their sources (e.g. hashicorp/azurerm).
+            
+        Returns:
+            A future resolving to True if the workspace was prepared successfully.
+        """
+        workspace_path = self.get_workspace_path(workspace_id)
+        self._schedule_workspace_pruning()
+        with self.preparations_lock:
+            pending = self.preparations.get(workspace_path)
+            if pending and not pending.done():
+                return pending
+            
+            future = self.preparation_pool.submit(self._prepare_workspace, workspace_path, provider_requirements)
+            self.preparations[workspace_path] = future
+            future.add_done_callback(lambda done: self._finish_preparation(workspace_path, done))
+            return future
+    
+    def _schedule_workspace_pruning(self) -> None:
+        """
+        Prune idle workspaces in the background, at most once per prune interval.
+        """
+        if self.workspace_idle_seconds <= 0:
+            return
+        now = time.monotonic()
+        with self.preparations_lock:
+            if self.last_workspace_prune and now - self.last_workspace_prune < self.workspace_prune_interval:
+                return
+            self.last_workspace_prune = now
+        self.preparation_pool.submit(self.prune_idle_workspaces)
+    
+    def prune_idle_workspaces(self) -> List[str]:
+        """
+        Remove the workspaces that weren't used within the idle time and have no deployed resources in
+        their state. Workspaces managing resources are kept, their state is the only record of them.
+        
+        Returns:
+            The identifiers of the removed workspaces.
+        """
+        cutoff = time.time() - self.workspace_idle_seconds
+        removed = []
+        for workspace_id in os.listdir(self.workspace_root):
+            workspace_path = os.path.join(self.workspace_root, workspace_id)
+            if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', workspace_id) or not os.path.isdir(workspace_path):
+                continue
+            try:
+                if self._workspace_last_used(workspace_path) >= cutoff or self._has_managed_resources(workspace_path):
+                    continue
+                if self.active_operation_count(workspace_id):
+                    continue
+                
+                with self.workspace_locks.hold(workspace_id, timeout=0, background=True):
+                    # An operation may have started between the checks and taking the lock
+                    if self.active_operation_count(workspace_id) or self._workspace_last_used(workspace_path) >= cutoff:
+                        continue
+                    shutil.rmtree(workspace_path)
+            except (TimeoutError, CancelledError):
+                continue
+            except OSError as e:
+                logger.warning(f"Failed to remove idle workspace {workspace_id}: {str(e)}")
+                continue
+            removed.append(workspace_id)
+        
+        if removed:
+            logger.info(f"Removed {len(removed)} idle workspaces")
+        return removed
+    
+    @staticmethod
+    def _workspace_last_used(workspace_path: str) -> float:
+        """
+        Get when anything in a workspace was last written, which includes the marker touched by every operation.
+        """
+        last_used = 0.0
+        for name in os.listdir(workspace_path):
+            with contextlib.suppress(OSError):
+                last_used = max(last_used, os.path.getmtime(os.path.join(workspace_path, name)))
+        return last_used
+    
+    @staticmethod
+    def _has_managed_resources(workspace_path: str) -> bool:
+        """
+        Check whether the state of a workspace still manages resources. Unreadable states count as managing some.
+        """
+        try:
+            with open(os.path.join(workspace_path, "terraform.tfstate"), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            return True
+        return any(resource.get("mode") == "managed" for resource in state.get("resources") or [])
+    
+    def _finish_preparation(self, workspace_path: str, future: Future) -> None:
+        """
+        Forget a finished workspace preparation.
+        
+        Args:
+            workspace_path: The path of the workspace directory.
+            future: The finished preparation.
+        """
+        with self.preparations_lock:
+            if self.preparations.get(workspace_path) is future:
+                del self.preparations[workspace_path]
+    
+    def wait_for_workspace(self, workspace_id: str) -> None:
+        """
+        Wait for a background preparation of a workspace to finish, if one is running.
+        
+        Args:
+            workspace_id: The workspace identifier.
+        """
+        with self.preparations_lock:
+            pending = self.preparations.get(self.get_workspace_path(workspace_id))
+        if pending:
+            logger.info(f"Waiting for workspace {workspace_id} preparation to finish")
+            try:
+                pending.result()
+            except Exception as e:
+                logger.warning(f"Workspace {workspace_id} preparation failed: {str(e)}")
+    
+    def _prepare_workspace(self, workspace_path: str, provider_requirements: Dict[str, str]) -> bool:
+        """
+        Initialize a workspace with only the required providers, unless an operation is running in it.
+        
+        Args:
+            workspace_path: The path of the workspace directory.
+            provider_requirements: A dictionary mapping provider names to their sources.
+            
+        Returns:
+            True if terraform init succeeded.
+        """
+        # Preparation only saves time, so it never waits for the workspace
+        try:
+            with self.workspace_locks.hold(os.path.basename(workspace_path), timeout=0):
+                return self._init_providers(workspace_path, provider_requirements)
+        except TimeoutError:
+            logger.info(f"Skipping preparation of busy workspace {workspace_path}")
+            return False
+    
+    def _init_providers(self, workspace_path: str, provider_requirements: Dict[str, str]) -> bool:
+        """
+        Initialize a workspace with only the required providers, before the generated files exist.
+        
+        Args:
+            workspace_path: The path of the workspace directory.
+            provider_requirements: A dictionary mapping provider names to their sources.
+            
+        Returns:
+            True if terraform init succeeded.
+        """
+        requirements_hash = hashlib.sha256(json.dumps(provider_requirements, sort_keys=True).encode("utf-8")).hexdigest()
+        marker_path = os.path.join(workspace_path, ".terraform-agent-prepared")
+        if os.path.exists(marker_path):
+            with open(marker_path, 'r') as f:
+                if f.read() == requirements_hash:
+                    return True
+        
+        os.makedirs(workspace_path, exist_ok=True)
+        bootstrap_path = os.path.join(workspace_path, "_terraform_agent_providers.tf")
+        providers = "\n".join(f'    {name} = {{\n      source = "{source}"\n    }}' for name, source in sorted(provider_requirements.items()))
+        with open(bootstrap_path, 'w') as f:
+            f.write(f"terraform {{\n  required_providers {{\n{providers}\n  }}\n}}\n")
+        
+        try:
+            logger.info(f"Preparing workspace {workspace_path} with providers {', '.join(sorted(provider_requirements))}")
+            result = subprocess.run(
+                ["terraform", "init", "-input=false", "-backend=false"],
+                cwd=workspace_path,
+                env={key: value for key, value in self._terraform_env().items() if key != "TF_LOG"},
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=self.operation_timeouts["init"]
+            )
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Workspace preparation timed out after {self.operation_timeouts['init']:.0f}s")
+            return False
+        finally:
+            # The generated code brings its own provider block and version constraints
+            os.remove(bootstrap_path)
+            lock_path = os.path.join(workspace_path, ".terraform.lock.hcl")
+            if os.path.exists(lock_path):
+                os.remove(lock_path)
+        
+        if result.returncode != 0:
+            logger.warning(f"Workspace preparation failed: {result.stderr[-2000:]}")
+            return False
+        
+        with open(marker_path, 'w') as f:
+            f.write(requirements_hash)
+        return True
+    
+    @contextlib.contextmanager
+    def track_operation(self, workspace_id: Optional[str]):
+        """
+        Mark an interactive operation as running for the duration of the context.
+        
+        Args:
+            workspace_id: The workspace the operation runs in, or None for a temporary directory.
+        """
+        marker_path = os.path.join(self.active_operations_dir, f"{workspace_id or 'temporary'}.{os.getpid()}.{uuid.uuid4().hex}")
+        if workspace_id:
+            # Keeps the workspace from being pruned as idle
+            with contextlib.suppress(OSError):
+                open(os.path.join(self.get_workspace_path(workspace_id), ".terraform-agent-last-used"), 'w').close()
+        with self.active_operations_lock:
+            self.active_operations[workspace_id] = self.active_operations.get(workspace_id, 0) + 1
+        try:
+            open(marker_path, 'w').close()
+        except OSError as e:
+            logger.warning(f"Failed to mark operation as running: {str(e)}")
+        try:
+            yield
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(marker_path)
+            with self.active_operations_lock:
+                self.active_operations[workspace_id] -= 1
+                if not self.active_operations[workspace_id]:
+                    del self.active_operations[workspace_id]
+    
+    def active_operation_count(self, workspace_id: Optional[str] = None) -> int:
+        """
+        Count the running interactive operations of every process sharing the workspace root.
+        
+        Args:
+            workspace_id: Only count operations in this workspace. If None, count all of them.
+            
+        Returns:
+            The number of running operations.
+        """
+        try:
+            markers = os.listdir(self.active_operations_dir)
+        except OSError:
+            # Without the shared markers only this process's operations are known
+            with self.active_operations_lock:
+                if workspace_id is None:
+                    return sum(self.active_operations.values())
+                return self.active_operations.get(workspace_id, 0)
+        
+        count = 0
+        alive: Dict[int, bool] = {os.getpid(): True}
+        for marker in markers:
+            parts = marker.split(".")
+            if len(parts) != 3 or (workspace_id is not None and parts[0] != workspace_id):
+                continue
+            try:
+                pid = int(parts[1])
+            except ValueError:
+                continue
+            if pid not in alive:
+                try:
+                    os.kill(pid, 0)
+                    alive[pid] = True
+                except PermissionError:
+                    alive[pid] = True
+                except ProcessLookupError:
+                    alive[pid] = False
+            if alive[pid]:
+                count += 1
+            else:
+                # Left behind by a worker that died during the operation
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.active_operations_dir, marker))
+        return count
+    
+    def get_plan_path(self, plan_id: str) -> str:
+        """
+        Get the path of a saved JSON plan.
+        
+        Args:
+            plan_id: The plan identifier.
+            
+        Returns:
+            The path of the JSON plan file.
+        """
+        if not re.fullmatch(r'[0-9a-f]{32}', plan_id or ""):
+            raise ValueError(f"Invalid plan ID: {plan_id}")
+        return os.path.join(self.plan_directory, f"{plan_id}.json")
+    
+    def provider_lock_hash(self, workspace_id: str) -> Optional[str]:
+        """
+        Hash the dependency lock file of a workspace, which records the selected provider versions.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The hex digest of the lock file, or None if the workspace wasn't initialized yet.
+        """
+        try:
+            with open(os.path.join(self.get_workspace_path(workspace_id), ".terraform.lock.hcl"), 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+    
+    def state_serial(self, workspace_id: str) -> Optional[str]:
+        """
+        Identify the current state of a workspace by its lineage and serial, which Terraform
+        bumps on every write.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The lineage and serial, or None if the workspace has no state.
+        """
+        state_path = os.path.join(self.get_workspace_path(workspace_id), "terraform.tfstate")
+        try:
+            with open(state_path, 'rb') as f:
+                # Both come first in the state file, so large states don't need to be parsed
+                head = f.read(4096).decode("utf-8", errors="replace")
+                serial = re.search(r'"serial":\s*(\d+)', head)
+                lineage = re.search(r'"lineage":\s*"([^"]*)"', head)
+                if serial and lineage:
+                    return f"{lineage.group(1)}:{serial.group(1)}"
+                
+                f.seek(0)
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+    
+    def workspace_fingerprint(self, workspace_id: str) -> Dict[str, Optional[str]]:
+        """
+        Identify what a validate or plan result of a workspace depends on besides its code.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            A dictionary containing the module library version, provider lock hash and state serial.
+        """
+        return {
+            "module_version": self.module_library.version,
+            "provider_lock_hash": self.provider_lock_hash(workspace_id),
+            "state_serial": self.state_serial(workspace_id)
+        }
+    
+    def get_log_path(self, log_id: str) -> str:
+        """
+        Get the path of a spooled operation log.
+        
+        Args:
+            log_id: The log identifier.
+            
+        Returns:
+            The path of the log file.
+        """
+        if not re.fullmatch(r'[0-9a-f]{32}', log_id or ""):
+            raise ValueError(f"Invalid log ID: {log_id}")
+        return os.path.join(self.log_directory, f"{log_id}.log")
+    
+    @staticmethod
+    def _prune_directory(directory: str, suffix: str, keep: int) -> None:
+        """
+        Remove the oldest files with a suffix beyond a retention limit.
+        
+        Args:
+            directory: The directory to prune.
+            suffix: The file name suffix to consider.
+            keep: The number of most recent files to keep.
+        """
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(suffix)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[keep:]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove old file {path}: {str(e)}")
+    
+    def read_log(self, log_id: str, offset: int = 0, limit: int = 65536) -> Dict[str, Any]:
+        """
+        Read a byte range of a spooled operation log.
+        
+        Args:
+            log_id: The log identifier.
+            offset: The byte offset to start reading from. Negative values count from the end.
+            limit: The maximum number of bytes to read, capped at 1 MiB.
+            
+        Returns:
+            A dictionary containing the content, the offsets and the total log size.
+        """
+        log_path = self.get_log_path(log_id)
+        limit = max(1, min(limit, 1048576))
+        
+        with open(log_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if offset < 0:
+                offset = max(0, size + offset)
+            offset = min(offset, size)
+            f.seek(offset)
+            data = f.read(limit)
+        
+        # Don't split a multi-byte character at the end of the range
+        try:
+            content = data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            if e.start >= len(data) - 3:
+                data = data[:e.start]
+            content = data.decode("utf-8", errors="replace")
+        
+        next_offset = offset + len(data)
+        return {
+            "content": content,
+            "offset": offset,
+            "next_offset": next_offset,
+            "size": size,
+            "eof": next_offset >= size
+        }
+    
+    def _run_logged(self, cmd: List[str], cwd: str, env: Dict[str, str], log_file, tail: deque,
+                    timeout: Optional[float] = None,
+                    cancel_check: Optional[Callable[[], bool]] = None) -> Tuple[Optional[int], int]:
+        """
+        Run a command, spooling its combined output to a log file and keeping only the last lines in memory.
+        
+        Args:
+            cmd: The command to run.
+            cwd: The working directory.
+            env: The environment variables.
+            log_file: The open log file to append the output to.
+            tail: A bounded deque receiving the most recent output lines.
+            timeout: The deadline of the command in seconds.
+            cancel_check: Polled while the command runs. When it returns True the command is stopped.
+            
+        Returns:
+            A tuple containing (return code, number of output lines). The return code is None if the
+            command was stopped on timeout or cancellation.
+        """
+        line_count = 0
+        log_file.write(f"$ {' '.join(cmd)}\n")
+        with StageTimings.stage("subprocess_spawn"):
+            # Own process group, so providers and other children can be stopped together with Terraform
+            process = subprocess.Popen(
+                cmd,
+                cwd=cwd,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors="replace",
+                start_new_session=True
+            )
+        with self.running_processes_lock:
+            self.running_processes[process.pid] = process
+        
+        finished = threading.Event()
+        stop_reason: List[str] = []
+        if timeout or cancel_check:
+            threading.Thread(
+                target=self._watch_process,
+                args=(process, timeout, cancel_check, finished, stop_reason),
+                name="terraform-watchdog",
+                daemon=True
+            ).start()
+        
+        try:
+            with StageTimings.stage(f"terraform_{cmd[1]}"):
+                # Read in bounded pieces so a single huge line can't exhaust memory
+                for line in iter(lambda: process.stdout.readline(8192), ""):
+                    log_file.write(line)
+                    tail.append(line)
+                    line_count += 1
+                
+                process.stdout.close()
+                returncode = process.wait()
+        finally:
+            finished.set()
+            with self.running_processes_lock:
+                self.running_processes.pop(process.pid, None)
+        
+        if stop_reason:
+            message = f"Stopped terraform {cmd[1]}: {stop_reason[0]}\n"
+            log_file.write(message)
+            tail.append(message)
+            logger.warning(message.strip())
+            return None, line_count + 1
+        return returncode, line_count
+    
+    def _watch_process(self, process: subprocess.Popen, timeout: Optional[float],
+                       cancel_check: Optional[Callable[[], bool]], finished: threading.Event,
+                       stop_reason: List[str]) -> None:
+        """
+        Stop a command's process group when it runs past its deadline or is cancelled.
+        
+        Args:
+            process: The running command.
+            timeout: The deadline of the command in seconds.
+            cancel_check: Returns True when the command should be cancelled.
+            finished: Set once the command has exited.
+            stop_reason: Receives the reason the command was stopped.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        while not finished.wait(0.5):
+            if cancel_check is not None and cancel_check():
+                stop_reason.append("cancelled")
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                stop_reason.append(f"timed out after {timeout:.0f}s")
+                break
+        else:
+            return
+        
+        # Interrupt first so Terraform can release the state lock and persist state, then kill what is left
+        self._signal_process_group(process, signal.SIGINT)
+        if not finished.wait(self.kill_grace_seconds):
+            self._signal_process_group(process, signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+    
+    def stop_running_processes(self) -> None:
+        """
+        Stop every command started by this executor, interrupting them first and killing what is left
+        after the grace period. Called when the process exits.
+        """
+        with self.running_processes_lock:
+            processes = list(self.running_processes.values())
+        if not processes:
+            return
+        
+        logger.warning(f"Stopping {len(processes)} running terraform commands before exiting")
+        for process in processes:
+            self._signal_process_group(process, signal.SIGINT)
+        deadline = time.monotonic() + self.kill_grace_seconds
+        for process in processes:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self._signal_process_group(process, signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+    
+    @classmethod
+    def stop_all_running_processes(cls) -> None:
+        """
+        Stop the running commands of every executor in the process, all within one grace period.
+        """
+        stoppers = [
+            threading.Thread(target=executor.stop_running_processes, name="terraform-shutdown", daemon=True)
+            for executor in list(cls.instances)
+        ]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
+    
+    @classmethod
+    def install_shutdown_handler(cls) -> bool:
+        """
+        Stop the running commands when the process exits or is asked to terminate, then hand the signal on
+        to the previous handler, e.g. the graceful shutdown of a gunicorn worker. Signal handlers can only be
+        installed from the main thread, so this is called when the web app is imported rather than when the
+        agent is created in a request thread. Calling it again has no effect.
+        
+        Returns:
+            Whether the signal handler is installed.
+        """
+        with cls.shutdown_lock:
+            if not cls.exit_hook_registered:
+                atexit.register(cls.stop_all_running_processes)
+                cls.exit_hook_registered = True
+            if cls.shutdown_handler_installed or not hasattr(signal, "SIGTERM") \
+                    or threading.current_thread() is not threading.main_thread():
+                return cls.shutdown_handler_installed
+            previous = signal.getsignal(signal.SIGTERM)
+            
+            def handle_terminate(signum, frame):
+                if callable(previous):
+                    # Requests keep running until their commands exit, so don't block the handler
+                    threading.Thread(target=cls.stop_all_running_processes, name="terraform-shutdown", daemon=True).start()
+                    previous(signum, frame)
+                elif previous != signal.SIG_IGN:
+                    cls.stop_all_running_processes()
+                    raise SystemExit(128 + signum)
+            
+            signal.signal(signal.SIGTERM, handle_terminate)
+            cls.shutdown_handler_installed = True
+            return True
+    
+    @staticmethod
+    def _signal_process_group(process: subprocess.Popen, sig: int) -> None:
+        """
+        Send a signal to the process group of a command.
+        """
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, sig)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+    
+    def request_cancel(self, workspace_id: str) -> None:
+        """
+        Cancel the operations running in a workspace, in this or any other process sharing the workspace root.
+        
+        Args:
+            workspace_id: The workspace identifier.
+        """
+        workspace_path = self.get_workspace_path(workspace_id)
+        os.makedirs(workspace_path, exist_ok=True)
+        with open(os.path.join(workspace_path, ".terraform-agent-cancel"), 'w') as f:
+            f.write(str(time.time()))
+    
+    def cancel_requested(self, workspace_id: str, since: float) -> bool:
+        """
+        Check whether the operations of a workspace were cancelled after a point in time.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            since: The start time of the operation, as returned by time.time().
+            
+        Returns:
+            True if a cancellation was requested after `since`.
+        """
+        try:
+            with open(os.path.join(self.get_workspace_path(workspace_id), ".terraform-agent-cancel"), 'r') as f:
+                return float(f.read() or 0) >= since
+        except (OSError, ValueError):
+            return False
+    
+    def _cleanup_aborted_run(self, work_dir: str, workspace_id: Optional[str]) -> None:
+        """
+        Remove what a stopped command may have left behind in its workspace.
+        
+        Args:
+            work_dir: The working directory of the command.
+            workspace_id: The persistent workspace, or None for a temporary directory.
+        """
+        # Another operation in the same workspace may legitimately hold the lock
+        if workspace_id and self.active_operation_count(workspace_id) > 1:
+            return
+        for file_name in [".terraform.tfstate.lock.info", "tfplan"]:
+            path = os.path.join(work_dir, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Removed {file_name} left by a stopped operation")
+    
+    def _format_tail(self, tail: deque, log_id: str, lines_written: int) -> str:
+        """
+        Format the buffered output tail for an API response.
+        
+        Args:
+            tail: The bounded deque with the most recent output lines.
+            log_id: The log identifier.
+            lines_written: The number of lines that went through the buffer.
+            
+        Returns:
+            The tail text, noting omitted lines if the output was longer.
+        """
+        text = "".join(tail)
+        omitted = lines_written - len(tail)
+        if omitted > 0:
+            text = f"... {omitted} earlier lines omitted, see log {log_id} for the full output ...\n{text}"
+        return text
+    
+    def summarize_plan(self, plan_id: str) -> Dict[str, Any]:
+        """
+        Summarize a saved JSON plan per resource without loading it into memory.
+        
+        Args:
+            plan_id: The plan identifier.
+            
+        Returns:
+            A dictionary with action counts and the list of changed resources.
+        """
+        with open(self.get_plan_path(plan_id), 'r') as f:
+            return TerraformPlanReader(f).summarize()
+    
+    def _write_terraform_files(self, directory: str, files: Dict[str, str]) -> None:
+        """
+        Write Terraform files to a directory.
+        
+        Args:
+            directory: The directory to write the files to.
+            files: A dictionary mapping file names to their content.
+        """
+        # Remove files left over from a previous generation in a persistent workspace
+        for existing in os.listdir(directory):
+            if existing.endswith((".tf", ".auto.tfvars.json")) and existing not in files:
+                os.remove(os.path.join(directory, existing))
+        
+        for file_name, content in files.items():
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, 'w') as f:
+                f.write(content)
+    
+    def execute_terraform(self, terraform_files: Dict[str, str], operation: str = "apply", auto_approve: bool = False,
+                          targets: Optional[List[str]] = None, refresh: bool = True,
+                          plan_id: Optional[str] = None, log_id: Optional[str] = None,
+                          workspace_id: Optional[str] = None, subscription_id: Optional[str] = None,
+                          timeout: Optional[float] = None,
+                          cancel_event: Optional[threading.Event] = None,
+                          fingerprint: Optional[Dict[str, Any]] = None) -> Tuple[bool, str]:
+        """
+        Execute Terraform operations on the generated code.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+            operation: The Terraform operation to execute (init, plan, apply, destroy).
+            auto_approve: Whether to automatically approve apply/destroy operations.
+            targets: Resource addresses to limit plan/apply/destroy to. If None or empty, all resources are used.
+            refresh: Whether to refresh resource state before plan/apply/destroy.
+            plan_id: For plan operations, save the plan as JSON under this identifier (see `get_plan_path`).
+            log_id: Identifier of the log file the full output is spooled to (see `read_log`). Generated if None.
+            workspace_id: Run in this persistent workspace, keeping state and providers. If None, a temporary
+                directory is used.
+            subscription_id: The Azure subscription to deploy to. If None, the default subscription is used.
+            timeout: The deadline of the operation in seconds. If None, the configured operation timeout is used.
+            cancel_event: When set, the running command is stopped. Operations in a persistent workspace can
+                also be cancelled with `request_cancel`.
+            fingerprint: If given, filled with the `workspace_fingerprint` of a persistent workspace once the
+                operation ran to completion, successful or not, while the workspace is still locked.
+            
+        Returns:
+            A tuple containing (success boolean, output/error message). The output only contains the
+            last lines of the command output, the full output is in the spooled log.
+        """
+        valid_operations = ["init", "validate", "plan", "apply", "destroy"]
+        if operation not in valid_operations:
+            return False, f"Invalid operation: {operation}. Valid operations are {', '.join(valid_operations)}"
+        
+        log_id = log_id or uuid.uuid4().hex
+        log_path = self.get_log_path(log_id)
+        self._prune_directory(self.log_directory, ".log", self.max_saved_logs - 1)
+        self._prune_directory(self.log_directory, ".trace", self.max_saved_logs - 1)
+        
+        started_at = time.time()
+        
+        def cancel_check() -> bool:
+            return (cancel_event is not None and cancel_event.is_set()) or (
+                workspace_id is not None and self.cancel_requested(workspace_id, started_at))
+        
+        workspace_lock = contextlib.ExitStack()
+        if workspace_id:
+            # Don't run init while a background preparation is still initializing the same directory
+            self.wait_for_workspace(workspace_id)
+            workspace_path = self.get_workspace_path(workspace_id)
+            os.makedirs(workspace_path, exist_ok=True)
+            workspace = contextlib.nullcontext(workspace_path)
+            
+            # Queue behind other operations on the same workspace, other workspaces aren't affected
+            try:
+                workspace_lock.enter_context(self.workspace_locks.hold(workspace_id, cancel_check=cancel_check))
+            except (TimeoutError, CancelledError) as e:
+                logger.warning(str(e))
+                return False, f"Terraform {operation} did not start: {str(e)}"
+        else:
+            # Create a temporary directory for Terraform files
+            workspace = tempfile.TemporaryDirectory()
+        
+        # Line buffered so the log can be followed while the command runs
+        with workspace_lock, self.track_operation(workspace_id), workspace as work_dir, open(log_path, 'w', buffering=1) as log_file:
+            logger.info(f"Using directory: {work_dir}, spooling output to {log_path}")
+            
+            if workspace_id and subscription_id:
+                # Background jobs like drift detection need to know where the workspace deploys to
+                self.save_workspace_settings(workspace_id, {"subscription_id": subscription_id})
+            
+            # Write Terraform files and the library modules they call to the working directory
+            self._write_terraform_files(work_dir, terraform_files)
+            self.module_library.install(work_dir, terraform_files)
+            
+            env = self._terraform_env(subscription_id)
+            env["TF_LOG_PATH"] = f"{log_path}.trace"  # Keep the verbose log out of the command output
+            
+            tail = deque(maxlen=self.output_tail_lines)
+            
+            # Execute Terraform init
+            logger.info("Running terraform init")
+            init_returncode, line_count = self._run_logged(
+                ["terraform", "init", "-input=false"], work_dir, env, log_file, tail,
+                timeout=self.operation_timeouts["init"], cancel_check=cancel_check
+            )
+            
+            if init_returncode is None:
+                self._cleanup_aborted_run(work_dir, workspace_id)
+            if init_returncode != 0:
+                output = self._format_tail(tail, log_id, line_count)
+                logger.error(f"Terraform init failed, see log {log_id}")
+                return False, f"Terraform init failed: {output}"
+            
+            # Only the operation's own output goes in the response tail
+            tail.clear()
+            
+            # Execute the requested Terraform operation
+            cmd = ["terraform", operation]
+            if operation in ["apply", "destroy"] and auto_approve:
+                cmd.append("-auto-approve")
+            if operation in ["plan", "apply", "destroy"]:
+                cmd.extend(f"-target={target}" for target in targets or [])
+                if not refresh:
+                    cmd.append("-refresh=false")
+            if operation == "plan" and plan_id:
+                cmd.append("-out=tfplan")
+            
+            logger.info(f"Running terraform {operation}")
+            operation_returncode, line_count = self._run_logged(
+                cmd, work_dir, env, log_file, tail,
+                timeout=timeout or self.operation_timeouts[operation], cancel_check=cancel_check
+            )
+            output = self._format_tail(tail, log_id, line_count)
+            
+            if operation_returncode is None:
+                self._cleanup_aborted_run(work_dir, workspace_id)
+            elif fingerprint is not None and workspace_id:
+                # Read before the lock is released, so it matches what the operation ran against
+                fingerprint.update(self.workspace_fingerprint(workspace_id))
+            if operation_returncode != 0:
+                logger.error(f"Terraform {operation} failed, see log {log_id}")
+                return False, f"Terraform {operation} failed: {output}"
+            
+            if operation == "plan" and plan_id:
+                # Convert the binary plan to JSON, streaming it straight to disk
+                show_env = {key: value for key, value in env.items() if key not in ["TF_LOG", "TF_LOG_PATH"]}
+                plan_path = self.get_plan_path(plan_id)
+                logger.info(f"Saving JSON plan to {plan_path}")
+                try:
+                    with open(plan_path, 'w') as plan_file:
+                        show_result = subprocess.run(
+                            ["terraform", "show", "-json", "tfplan"],
+                            cwd=work_dir,
+                            env=show_env,
+                            stdout=plan_file,
+                            stderr=subprocess.PIPE,
+                            text=True,
+                            timeout=self.operation_timeouts["show"]
+                        )
+                except subprocess.TimeoutExpired:
+                    os.remove(plan_path)
+                    logger.error("Terraform show timed out")
+                    return False, f"Terraform show timed out after {self.operation_timeouts['show']:.0f}s"
+                
+                if show_result.returncode != 0:
+                    os.remove(plan_path)
+                    logger.error(f"Terraform show failed: {show_result.stderr}")
+                    return False, f"Terraform show failed: {show_result.stderr}"
+                
+                self._prune_directory(self.plan_directory, ".json", self.max_saved_plans)
+            
+            return True, output
+    
+    def save_workspace_settings(self, workspace_id: str, settings: Dict[str, Any]) -> None:
+        """
+        Store settings of a persistent workspace, such as the subscription it deploys to.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            settings: The settings to merge into the stored ones.
+        """
+        stored = self.load_workspace_settings(workspace_id)
+        stored.update(settings)
+        with open(os.path.join(self.get_workspace_path(workspace_id), ".terraform-agent-settings.json"), 'w') as f:
+            json.dump(stored, f)
+    
+    def load_workspace_settings(self, workspace_id: str) -> Dict[str, Any]:
+        """
+        Load the settings of a persistent workspace.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The stored settings, empty if there are none.
+        """
+        try:
+            with open(os.path.join(self.get_workspace_path(workspace_id), ".terraform-agent-settings.json"), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+    
+    def get_drift_result_path(self, workspace_id: str) -> str:
+        """
+        Get the path of the last drift summary of a workspace.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The path of the drift summary file.
+        """
+        return os.path.join(self.get_workspace_path(workspace_id), ".terraform-agent-drift.json")
+    
+    def read_drift_result(self, workspace_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Read the last drift summary of a workspace.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            The drift summary, or None if the workspace was never checked.
+        """
+        try:
+            with open(self.get_drift_result_path(workspace_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def list_deployed_workspaces(self) -> List[str]:
+        """
+        List the persistent workspaces that have Terraform state, i.e. deployed infrastructure.
+        
+        Returns:
+            The workspace identifiers.
+        """
+        workspace_ids = []
+        for workspace_id in os.listdir(self.workspace_root):
+            state_path = os.path.join(self.workspace_root, workspace_id, "terraform.tfstate")
+            try:
+                if re.fullmatch(r'[0-9a-f]{32}', workspace_id) and os.path.getsize(state_path) > 0:
+                    workspace_ids.append(workspace_id)
+            except OSError:
+                continue
+        return workspace_ids
+    
+    def detect_drift(self, workspace_id: str, log_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Compare the state of a workspace with the real infrastructure using
+        `terraform plan -refresh-only -detailed-exitcode`, and store a compact summary.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            log_id: Identifier of the log file the full output is spooled to. Generated if None.
+            
+        Returns:
+            The drift summary with status in_sync, drifted or error, or busy if an operation holds the workspace.
+        """
+        workspace_path = self.get_workspace_path(workspace_id)
+        
+        # A drift check is never worth waiting for an operation, or making one wait, the next cycle checks again
+        try:
+            with self.workspace_locks.hold(workspace_id, timeout=0, background=True):
+                result = self._detect_drift(
+                    workspace_id, workspace_path, log_id,
+                    preempt_check=lambda: self.workspace_locks.interactive_waiting(workspace_id)
+                )
+                if result is not None:
+                    return result
+                logger.info(f"Drift check of workspace {workspace_id} yielded to an interactive operation")
+        except TimeoutError:
+            pass
+        return {
+            "workspace_id": workspace_id,
+            "checked_at": time.time(),
+            "status": "busy",
+            "message": "The workspace is busy with another Terraform operation"
+        }
+    
+    def _detect_drift(self, workspace_id: str, workspace_path: str, log_id: Optional[str],
+                      preempt_check: Optional[Callable[[], bool]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Run the drift check of a workspace that is held by the caller.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            workspace_path: The path of the workspace directory.
+            log_id: Identifier of the log file the full output is spooled to. Generated if None.
+            preempt_check: Polled while the commands run. When it returns True the check is stopped.
+            
+        Returns:
+            The drift summary with status in_sync, drifted or error, or None if the check was preempted.
+        """
+        log_id = log_id or uuid.uuid4().hex
+        log_path = self.get_log_path(log_id)
+        self._prune_directory(self.log_directory, ".log", self.max_saved_logs - 1)
+        self._prune_directory(self.log_directory, ".trace", self.max_saved_logs - 1)
+        
+        started_at = time.time()
+        env = self._terraform_env(self.load_workspace_settings(workspace_id).get("subscription_id"))
+        env["TF_LOG_PATH"] = f"{log_path}.trace"
+        tail = deque(maxlen=self.output_tail_lines)
+        
+        with open(log_path, 'w', buffering=1) as log_file:
+            returncode = 0
+            if not os.path.isdir(os.path.join(workspace_path, ".terraform")):
+                returncode, line_count = self._run_logged(
+                    ["terraform", "init", "-input=false"], workspace_path, env, log_file, tail,
+                    timeout=self.operation_timeouts["init"], cancel_check=preempt_check
+                )
+            
+            if returncode == 0:
+                tail.clear()
+                # Refresh-only plans never write state, so they don't need the state lock of interactive operations
+                returncode, line_count = self._run_logged(
+                    ["terraform", "plan", "-refresh-only", "-detailed-exitcode", "-input=false", "-lock=false", "-json"],
+                    workspace_path, env, log_file, tail,
+                    timeout=self.operation_timeouts["plan"], cancel_check=preempt_check
+                )
+        
+        if returncode is None and preempt_check is not None and preempt_check():
+            return None
+        
+        result = {
+            "workspace_id": workspace_id,
+            "checked_at": started_at,
+            "duration_seconds": round(time.time() - started_at, 1),
+            "log_id": log_id
+        }
+        
+        if returncode not in (0, 2):
+            result["status"] = "error"
+            result["message"] = self._format_tail(tail, log_id, line_count)
+        else:
+            # The machine-readable output has one resource_drift message per drifted resource
+            resources = []
+            drift_count = 0
+            with open(log_path, 'r') as log_file:
+                for line in log_file:
+                    if '"resource_drift"' not in line:
+                        continue
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        continue
+                    if message.get("type") != "resource_drift":
+                        continue
+                    drift_count += 1
+                    if len(resources) < 50:
+                        change = message.get("change", {})
+                        resources.append({
+                            "address": change.get("resource", {}).get("addr"),
+                            "type": change.get("resource", {}).get("resource_type"),
+                            "action": change.get("action")
+                        })
+            
+            result["status"] = "drifted" if returncode == 2 else "in_sync"
+            result["drift_count"] = drift_count
+            result["resources"] = resources
+        
+        with open(self.get_drift_result_path(workspace_id), 'w') as f:
+            json.dump(result, f)
+        
+        logger.info(f"Drift check of workspace {workspace_id}: {result['status']}")
+        return result
+    
+    def generate_import_config(self, terraform_files: Dict[str, str], log_id: Optional[str] = None,
+                               subscription_id: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
+        """
+        Let Terraform write the configuration of import blocks that have none, using
+        `terraform plan -generate-config-out`.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content, including the import blocks.
+            log_id: Identifier of the log file the full output is spooled to. Generated if None.
+            subscription_id: The Azure subscription the resources are in. If None, the default subscription is used.
+            
+        Returns:
+            A tuple containing (success boolean, output/error message, generated configuration or None).
+        """
+        log_id = log_id or uuid.uuid4().hex
+        log_path = self.get_log_path(log_id)
+        self._prune_directory(self.log_directory, ".log", self.max_saved_logs - 1)
+        self._prune_directory(self.log_directory, ".trace", self.max_saved_logs - 1)
+        
+        env = self._terraform_env(subscription_id)
+        env["TF_LOG_PATH"] = f"{log_path}.trace"
+        tail = deque(maxlen=self.output_tail_lines)
+        
+        with tempfile.TemporaryDirectory() as work_dir, open(log_path, 'w', buffering=1) as log_file:
+            self._write_terraform_files(work_dir, terraform_files)
+            returncode, line_count = self._run_logged(
+                ["terraform", "init", "-input=false"], work_dir, env, log_file, tail,
+                timeout=self.operation_timeouts["init"]
+            )
+            if returncode != 0:
+                return False, f"Terraform init failed: {self._format_tail(tail, log_id, line_count)}", None
+            
+            tail.clear()
+            # Nothing is applied and there is no state to protect, so no lock is taken
+            returncode, line_count = self._run_logged(
+                ["terraform", "plan", "-input=false", "-lock=false", "-generate-config-out=generated.tf"],
+                work_dir, env, log_file, tail,
+                timeout=self.operation_timeouts["plan"]
+            )
+            output = self._format_tail(tail, log_id, line_count)
+            
+            # The configuration is written even when the plan then fails on it, so it can still be fixed by hand
+            generated_path = os.path.join(work_dir, "generated.tf")
+            if not os.path.exists(generated_path):
+                return False, f"Terraform config generation failed: {output}", None
+            with open(generated_path, 'r') as f:
+                generated = f.read()
+        
+        return returncode == 0, output, generated
+
+
+class DriftDetector:
+    """
+    Periodically checks every deployed workspace for drift between its state and the real infrastructure.
+    Checks are spread over the interval with random jitter, rate limited, run on a small pool and held back
+    while interactive operations are running so they never compete with users.
+    """
+    
+    def __init__(self, executor: TerraformExecutor, interval_seconds: Optional[float] = None,
+                 max_workers: Optional[int] = None, max_checks_per_minute: Optional[int] = None):
+        """
+        Initialize the drift detector.
+        
+        Args:
+            executor: The Terraform executor owning the workspaces.
+            interval_seconds: How often every workspace is checked, 0 disables the schedule.
+                If None, it will try to get from environment variable.
+            max_workers: The maximum number of concurrent checks. If None, it will try to get from environment variable.
+            max_checks_per_minute: The maximum number of checks started per minute.
+                If None, it will try to get from environment variable.
+        """
+        self.executor = executor
+        self.interval_seconds = interval_seconds if interval_seconds is not None else float(os.getenv("TERRAFORM_DRIFT_INTERVAL", "3600"))
+        self.max_checks_per_minute = max_checks_per_minute or int(os.getenv("TERRAFORM_DRIFT_MAX_PER_MINUTE", "6"))
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("TERRAFORM_DRIFT_WORKERS", "2")),
+            thread_name_prefix="terraform-drift"
+        )
+        
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, Future] = {}
+        self.check_times = deque()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.leader_file = None
+        
+        self.metrics = {
+            "cycles": 0,
+            "checks": 0,
+            "drifted": 0,
+            "errors": 0,
+            "deferred": 0,
+            "busy": 0,
+            "last_cycle_at": None
+        }
+    
+    def start(self) -> bool:
+        """
+        Start the background schedule. Only one process per workspace root runs it.
+        
+        Returns:
+            True if this process runs the schedule.
+        """
+        if self.interval_seconds <= 0 or self.thread is not None:
+            return False
+        
+        if fcntl is not None:
+            # Several workers share the workspace root, the first one to get the lock runs the schedule
+            leader_file = open(os.path.join(self.executor.workspace_root, ".drift-scheduler.lock"), 'w')
+            try:
+                fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                leader_file.close()
+                logger.info("Drift detection is scheduled by another process")
+                return False
+            self.leader_file = leader_file
+        
+        self.thread = threading.Thread(target=self._run, name="terraform-drift-scheduler", daemon=True)
+        self.thread.start()
+        logger.info(f"Drift detection scheduled every {self.interval_seconds} seconds")
+        return True
+    
+    def stop(self) -> None:
+        """
+        Stop the background schedule after the running checks finish.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.pool.shutdown(wait=True)
+        if self.leader_file is not None:
+            self.leader_file.close()
+            self.leader_file = None
+    
+    def _run(self) -> None:
+        """
+        Check every deployed workspace once per interval until stopped.
+        """
+        while not self.stop_event.is_set():
+            cycle_started_at = time.time()
+            workspace_ids = self.executor.list_deployed_workspaces()
+            random.shuffle(workspace_ids)
+            
+            # Give each workspace its own slot in the interval and a random start within it
+            slot = self.interval_seconds / max(1, len(workspace_ids))
+            for index, workspace_id in enumerate(workspace_ids):
+                due_at = cycle_started_at + index * slot + random.uniform(0, slot / 2)
+                if self.stop_event.wait(max(0.0, due_at - time.time())) or not self._wait_for_capacity():
+                    return
+                self.check_async(workspace_id)
+            
+            with self.lock:
+                self.metrics["cycles"] += 1
+                self.metrics["last_cycle_at"] = cycle_started_at
+            
+            self.stop_event.wait(max(0.0, cycle_started_at + self.interval_seconds - time.time()))
+    
+    def _wait_for_capacity(self) -> bool:
+        """
+        Block until a check may start: under the rate limit and with no interactive operation running
+        in any worker sharing the workspace root.
+        
+        Returns:
+            False if the detector was stopped while waiting.
+        """
+        while not self.stop_event.is_set():
+            now = time.time()
+            with self.lock:
+                while self.check_times and self.check_times[0] <= now - 60:
+                    self.check_times.popleft()
+                
+                if len(self.check_times) >= self.max_checks_per_minute:
+                    delay = self.check_times[0] + 60 - now
+                elif self.executor.active_operation_count() > 0:
+                    self.metrics["deferred"] += 1
+                    delay = 5.0
+                else:
+                    self.check_times.append(now)
+                    return True
+            
+            self.stop_event.wait(delay)
+        return False
+    
+    def check_async(self, workspace_id: str) -> Future:
+        """
+        Start a drift check of a workspace on the pool, or join the one already running.
+        
+        Args:
+            workspace_id: The workspace identifier.
+            
+        Returns:
+            A future resolving to the drift summary.
+        """
+        with self.lock:
+            future = self.in_flight.get(workspace_id)
+            if future is None:
+                future = self.pool.submit(self._check, workspace_id)
+                self.in_flight[workspace_id] = future
+                future.add_done_callback(lambda f: self._finish_check(workspace_id))
+            return future
+    
+    def _finish_check(self, workspace_id: str) -> None:
+        with self.lock:
+            self.in_flight.pop(workspace_id, None)
+    
+    def _check(self, workspace_id: str) -> Dict[str, Any]:
+        """
+        Run a drift check, recording its outcome in the metrics.
+        """
+        try:
+            result = self.executor.detect_drift(workspace_id)
+        except Exception as e:
+            logger.error(f"Drift check of workspace {workspace_id} failed: {str(e)}")
+            result = {
+                "workspace_id": workspace_id,
+                "checked_at": time.time(),
+                "status": "error",
+                "message": str(e)
+            }
+        
+        with self.lock:
+            self.metrics["checks"] += 1
+            if result["status"] == "drifted":
+                self.metrics["drifted"] += 1
+            elif result["status"] == "error":
+                self.metrics["errors"] += 1
+            elif result["status"] == "busy":
+                self.metrics["busy"] += 1
+        return result
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the state of the drift schedule.
+        
+        Returns:
+            A dictionary with the schedule settings, counters and running checks.
+        """
+        with self.lock:
+            return {
+                "enabled": self.thread is not None,
+                "interval_seconds": self.interval_seconds,
+                "in_flight": len(self.in_flight),
+                **self.metrics
+            }
+
+
+class AzureResourceImporter:
+    """
+    Adopts existing Azure resources into Terraform in bulk. Resource groups are listed concurrently,
+    resources are mapped to azurerm types and turned into import blocks, and configuration is rendered
+    from templates wherever the listing carries enough information, so no Claude call is needed per resource.
+    """
+    
+    # ARM resource type -> azurerm resource type. Types resolved from the resource kind are handled separately.
+    RESOURCE_TYPES = {
+        "microsoft.storage/storageaccounts": "azurerm_storage_account",
+        "microsoft.network/virtualnetworks": "azurerm_virtual_network",
+        "microsoft.network/networkinterfaces": "azurerm_network_interface",
+        "microsoft.network/networksecuritygroups": "azurerm_network_security_group",
+        "microsoft.network/publicipaddresses": "azurerm_public_ip",
+        "microsoft.network/loadbalancers": "azurerm_lb",
+        "microsoft.network/applicationgateways": "azurerm_application_gateway",
+        "microsoft.network/routetables": "azurerm_route_table",
+        "microsoft.network/privatednszones": "azurerm_private_dns_zone",
+        "microsoft.network/dnszones": "azurerm_dns_zone",
+        "microsoft.network/privateendpoints": "azurerm_private_endpoint",
+        "microsoft.compute/disks": "azurerm_managed_disk",
+        "microsoft.compute/availabilitysets": "azurerm_availability_set",
+        "microsoft.keyvault/vaults": "azurerm_key_vault",
+        "microsoft.managedidentity/userassignedidentities": "azurerm_user_assigned_identity",
+        "microsoft.containerregistry/registries": "azurerm_container_registry",
+        "microsoft.containerservice/managedclusters": "azurerm_kubernetes_cluster",
+        "microsoft.web/serverfarms": "azurerm_service_plan",
+        "microsoft.sql/servers": "azurerm_mssql_server",
+        "microsoft.sql/servers/databases": "azurerm_mssql_database",
+        "microsoft.dbforpostgresql/flexibleservers": "azurerm_postgresql_flexible_server",
+        "microsoft.documentdb/databaseaccounts": "azurerm_cosmosdb_account",
+        "microsoft.cache/redis": "azurerm_redis_cache",
+        "microsoft.servicebus/namespaces": "azurerm_servicebus_namespace",
+        "microsoft.eventhub/namespaces": "azurerm_eventhub_namespace",
+        "microsoft.operationalinsights/workspaces": "azurerm_log_analytics_workspace",
+        "microsoft.insights/components": "azurerm_application_insights"
+    }
+    VIRTUAL_MACHINE_API_VERSION = "2023-03-01"
+    
+    def __init__(self, resource_client: Any, max_workers: Optional[int] = None, max_resources: Optional[int] = None):
+        """
+        Initialize the importer.
+        
+        Args:
+            resource_client: The ResourceManagementClient, or a stand-in with the same interface.
+            max_workers: Resource groups listed at once. If None, it will try to get from environment variable.
+            max_resources: Maximum number of resources imported at once. If None, it will try to get from
+                environment variable.
+        """
+        self.resource_client = resource_client
+        self.max_workers = max_workers or int(os.getenv("TERRAFORM_IMPORT_WORKERS", "8"))
+        self.max_resources = max_resources or int(os.getenv("TERRAFORM_IMPORT_MAX_RESOURCES", "5000"))
+    
+    def list_resources(self, resource_groups: Optional[List[str]] = None,
+                       resource_types: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], bool]:
+        """
+        List resource groups and their resources, paging through the groups concurrently.
+        
+        Args:
+            resource_groups: The resource groups to import. If None, every group of the subscription is imported.
+            resource_types: ARM resource types to limit the import to. If None, every type is listed.
+            
+        Returns:
+            A tuple containing (resource groups, resources, whether the resources were truncated to the maximum).
+        """
+        type_filter = {resource_type.lower() for resource_type in resource_types or []}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="azure-import") as pool:
+            if resource_groups:
+                groups = list(pool.map(self.resource_client.resource_groups.get, resource_groups))
+            else:
+                groups = list(self.resource_client.resource_groups.list())
+            
+            # Pages of one group follow continuation tokens, so the concurrency is across groups
+            listed = list(pool.map(lambda group: self._list_group(group.name, type_filter), groups))
+            resources = [resource for group_resources in listed for resource in group_resources]
+            truncated = len(resources) > self.max_resources
+            resources = resources[:self.max_resources]
+            
+            # The listing doesn't say which OS a virtual machine runs, and linux and windows VMs are different types
+            virtual_machines = [resource for resource in resources
+                                if resource["type"].lower() == "microsoft.compute/virtualmachines"]
+            for resource, os_type in zip(virtual_machines, pool.map(self._virtual_machine_os_type, virtual_machines)):
+                resource["os_type"] = os_type
+        
+        group_records = [{
+            "id": group.id,
+            "name": group.name,
+            "type": "Microsoft.Resources/resourceGroups",
+            "location": group.location,
+            "resource_group": group.name,
+            "tags": dict(group.tags or {}),
+            "sku": None,
+            "kind": None
+        } for group in groups]
+        return group_records, resources, truncated
+    
+    def _list_group(self, resource_group: str, type_filter: set) -> List[Dict[str, Any]]:
+        """
+        List the resources of a resource group.
+        
+        Args:
+            resource_group: The resource group name.
+            type_filter: Lowercase ARM resource types to keep, or empty to keep all.
+            
+        Returns:
+            The resources as dictionaries.
+        """
+        resources = []
+        for page in self.resource_client.resources.list_by_resource_group(resource_group).by_page():
+            for item in page:
+                if type_filter and item.type.lower() not in type_filter:
+                    continue
+                sku = getattr(item, "sku", None)
+                resources.append({
+                    "id": item.id,
+                    "name": item.name,
+                    "type": item.type,
+                    "location": item.location,
+                    "resource_group": resource_group,
+                    "tags": dict(getattr(item, "tags", None) or {}),
+                    "sku": {"name": getattr(sku, "name", None), "tier": getattr(sku, "tier", None)} if sku else None,
+                    "kind": getattr(item, "kind", None)
+                })
+        return resources
+    
+    def _virtual_machine_os_type(self, resource: Dict[str, Any]) -> Optional[str]:
+        """
+        Look up the OS type of a virtual machine.
+        """
+        try:
+            details = self.resource_client.resources.get_by_id(resource["id"], self.VIRTUAL_MACHINE_API_VERSION)
+            return ((details.properties or {}).get("storageProfile", {}).get("osDisk", {}).get("osType") or "").lower() or None
+        except Exception as e:
+            logger.warning(f"Failed to get the OS type of {resource['id']}: {str(e)}")
+            return None
+    
+    def azurerm_type(self, resource: Dict[str, Any]) -> Optional[str]:
+        """
+        Map a resource to its azurerm resource type.
+        
+        Args:
+            resource: The resource as returned by `list_resources`.
+            
+        Returns:
+            The azurerm resource type, or None if the resource type isn't supported.
+        """
+        arm_type = resource["type"].lower()
+        kind = (resource.get("kind") or "").lower()
+        if arm_type == "microsoft.resources/resourcegroups":
+            return "azurerm_resource_group"
+        if arm_type == "microsoft.compute/virtualmachines":
+            if not resource.get("os_type"):
+                return None
+            return f"azurerm_{resource['os_type']}_virtual_machine"
+        if arm_type == "microsoft.web/sites":
+            platform = "linux" if "linux" in kind else "windows"
+            return f"azurerm_{platform}_function_app" if "functionapp" in kind else f"azurerm_{platform}_web_app"
+        return self.RESOURCE_TYPES.get(arm_type)
+    
+    @staticmethod
+    def template_attributes(azurerm_type: str, resource: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Build the configuration of a resource from its listing, for the types the listing fully describes.
+        
+        Args:
+            azurerm_type: The azurerm resource type.
+            resource: The resource as returned by `list_resources`.
+            
+        Returns:
+            The resource arguments, or None if Terraform has to generate the configuration.
+        """
+        sku_name = (resource.get("sku") or {}).get("name")
+        kind = (resource.get("kind") or "").lower()
+        located = {
+            "name": resource["name"],
+            "resource_group_name": resource["resource_group"],
+            "location": resource["location"]
+        }
+        
+        if azurerm_type == "azurerm_resource_group":
+            attributes = {"name": resource["name"], "location": resource["location"]}
+        elif azurerm_type in ("azurerm_network_security_group", "azurerm_user_assigned_identity"):
+            attributes = dict(located)
+        elif azurerm_type in ("azurerm_private_dns_zone", "azurerm_dns_zone"):
+            attributes = {"name": resource["name"], "resource_group_name": resource["resource_group"]}
+        elif azurerm_type == "azurerm_storage_account" and sku_name and "_" in sku_name:
+            account_tier, replication_type = sku_name.split("_", 1)
+            attributes = {**located, "account_kind": resource.get("kind") or "StorageV2",
+                          "account_tier": account_tier, "account_replication_type": replication_type}
+        elif azurerm_type == "azurerm_public_ip" and sku_name:
+            attributes = {**located, "sku": sku_name,
+                          "allocation_method": "Static" if sku_name == "Standard" else "Dynamic"}
+        elif azurerm_type == "azurerm_container_registry" and sku_name:
+            attributes = {**located, "sku": sku_name}
+        elif azurerm_type == "azurerm_service_plan" and sku_name:
+            attributes = {**located, "os_type": "Linux" if "linux" in kind else "Windows", "sku_name": sku_name}
+        elif azurerm_type == "azurerm_log_analytics_workspace" and sku_name:
+            attributes = {**located, "sku": sku_name}
+        elif azurerm_type == "azurerm_application_insights":
+            attributes = {**located, "application_type": kind or "web"}
+        elif azurerm_type == "azurerm_key_vault" and sku_name and os.getenv("AZURE_TENANT_ID"):
+            attributes = {**located, "tenant_id": os.getenv("AZURE_TENANT_ID"), "sku_name": sku_name.lower()}
+        else:
+            return None
+        
+        if resource.get("tags"):
+            attributes["tags"] = resource["tags"]
+        return attributes
+    
+    def build_files(self, resource_groups: List[Dict[str, Any]],
+                    resources: List[Dict[str, Any]]) -> Tuple[Dict[str, str], Dict[str, Any]]:
+        """
+        Turn listed resources into import blocks and configuration.
+        
+        Args:
+            resource_groups: The resource groups as returned by `list_resources`.
+            resources: The resources as returned by `list_resources`.
+            
+        Returns:
+            A tuple containing (Terraform files, summary). Imports whose configuration Terraform has to
+            generate are kept apart in imports_generated.tf.
+        """
+        used_names: Dict[str, set] = {}
+        templated_imports, generated_imports, configuration = [], [], []
+        unsupported: Dict[str, int] = {}
+        
+        for resource in resource_groups + resources:
+            azurerm_type = self.azurerm_type(resource)
+            if azurerm_type is None:
+                unsupported[resource["type"]] = unsupported.get(resource["type"], 0) + 1
+                continue
+            
+            # Block names must be unique per type and start with a letter or underscore
+            name = re.sub(r"[^a-z0-9_]", "_", resource["name"].lower())
+            name = name if re.match(r"^[a-z_]", name) else f"r_{name}"
+            taken = used_names.setdefault(azurerm_type, set())
+            unique_name, suffix = name, 2
+            while unique_name in taken:
+                unique_name, suffix = f"{name}_{suffix}", suffix + 1
+            taken.add(unique_name)
+            
+            address = f"{azurerm_type}.{unique_name}"
+            import_block = f"import {{\n  to = {address}\n  id = {json.dumps(resource['id'])}\n}}"
+            attributes = self.template_attributes(azurerm_type, resource)
+            if attributes is None:
+                generated_imports.append(import_block)
+                continue
+            
+            templated_imports.append(import_block)
+            width = max(len(key) for key in attributes)
+            body = "\n".join(f"  {key.ljust(width)} = {json.dumps(value)}" for key, value in attributes.items())
+            configuration.append(f'resource "{azurerm_type}" "{unique_name}" {{\n{body}\n}}')
+        
+        files = {
+            "provider.tf": (
+                'terraform {\n  required_version = ">= 1.5.0"\n  required_providers {\n    azurerm = {\n'
+                '      source = "hashicorp/azurerm"\n    }\n  }\n}\n\nprovider "azurerm" {\n  features {}\n}\n'
+            )
+        }
+        if templated_imports:
+            files["imports.tf"] = "\n\n".join(templated_imports) + "\n"
+            files["imported.tf"] = "\n\n".join(configuration) + "\n"
+        if generated_imports:
+            files["imports_generated.tf"] = "\n\n".join(generated_imports) + "\n"
+        
+        summary = {
+            "resource_groups": len(resource_groups),
+            "resources": len(resources),
+            "templated": len(templated_imports),
+            "needs_generated_config": len(generated_imports),
+            "unsupported": unsupported
+        }
+        return files, summary
+
+
+class AzureTerraformAgent:
+    """
+    Main agent class that coordinates conversation, Terraform generation, and execution.
+    Uses Claude AI for model inference.
+    """
+    
+    # Variables that receive a fan-out target's location
+    LOCATION_VARIABLES = ["location", "region", "azure_region", "resource_location"]
+    LOCATION_ATTRIBUTE_PATTERN = re.compile(r'^([ \t]*location[ \t]*=[ \t]*")[^"$]*(")', re.MULTILINE)
+    NAME_ATTRIBUTE_PATTERN = re.compile(r'^[ \t]*name[ \t]*=[ \t]*(.*?)[ \t]*$', re.MULTILINE)
+    # Resource names with a length limit, and the ones that can't contain separators
+    NAME_LIMITS = {
+        "azurerm_storage_account": 24,
+        "azurerm_key_vault": 24,
+        "azurerm_container_registry": 50,
+        "azurerm_windows_virtual_machine": 15
+    }
+    COMPACT_NAME_TYPES = {"azurerm_storage_account", "azurerm_container_registry"}
+    
+    # How often a session save is merged and retried when another request saved the session first
+    SESSION_SAVE_ATTEMPTS = 5
+    
+    def __init__(self, 
+                 anthropic_api_key: Optional[str] = None,
+                 model: Optional[str] = None,
+                 session_store: Optional[SessionStore] = None,
+                 extraction_model: Optional[str] = None,
+                 generation_model: Optional[str] = None,
+                 artifact_store: Optional[ArtifactStore] = None,
+                 transport: Optional[ClaudeTransport] = None):
+        """
+        Initialize the Azure Terraform Agent.
+        
+        Args:
+            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
+            model: The Claude model to use for every stage. If None, each stage uses its own default.
+            session_store: Store for per-session state. If None, it is created from SESSION_STORE_URL.
+            extraction_model: The model for intent and slot extraction. Overrides `model`.
+            generation_model: The model for Terraform code generation. Overrides `model`.
+            artifact_store: Store for generated files. If None, it is created from TERRAFORM_ARTIFACT_DIR.
+            transport: Transport for the Claude calls. If None, it is created from CLAUDE_TRANSPORT_MODE.
+        """
+        # One scheduler and one transport for every Claude call made by this process
+        self.scheduler = ClaudeCallScheduler()
+        self.transport = transport or ClaudeTransport(anthropic_api_key=anthropic_api_key or os.getenv("ANTHROPIC_API_KEY"))
+        # Earlier requests of every session, so rephrased requests skip extraction
+        self.spec_cache = SpecCache()
+        # Known regions and SKUs, for validating specs and autocomplete
+        self.azure_catalog = AzureCatalog()
+        # Per-session state and tenant usage are kept in a shared store so any worker can serve any session
+        self.session_store = session_store or create_session_store()
+        # Claude usage of the bound session and its tenant against their budgets
+        self.usage_budget = UsageBudget(store=self.session_store)
+        self.session_usage = UsageBudget.new_usage()
+        self.tenant_id = "default"
+        self.conversational_agent = ConversationalAgent(
+            anthropic_api_key=anthropic_api_key,
+            model=extraction_model or model,
+            scheduler=self.scheduler,
+            transport=self.transport,
+            spec_cache=self.spec_cache,
+            catalog=self.azure_catalog
+        )
+        # Generated code calls these modules, the executor installs them next to it
+        self.module_library = TerraformModuleLibrary()
+        self.terraform_generator = TerraformGenerator(
+            anthropic_api_key=anthropic_api_key,
+            model=generation_model or model,
+            scheduler=self.scheduler,
+            transport=self.transport,
+            module_library=self.module_library
+        )
+        self.terraform_executor = TerraformExecutor(module_library=self.module_library)
+        # Not started here, the hosting application decides whether this process runs the schedule
+        self.drift_detector = DriftDetector(self.terraform_executor)
+        self.resource_importer = AzureResourceImporter(self.terraform_executor.resource_client)
+        
+        # State to track the current infrastructure spec and Terraform code
+        self.current_infrastructure_spec = None
+        self.current_terraform_files = None
+        
+        # Content hashes kept alongside the current state, used as ETags by the web interface
+        self.current_infrastructure_spec_hash = None
+        self.current_terraform_files_hash = None
+        self.current_terraform_file_hashes = {}
+        self.current_terraform_code = None
+        
+        # State of the last successful apply, used to compute change scopes
+        self.applied_infrastructure_spec = None
+        self.applied_terraform_files = None
+        
+        self.session_id = None
+        self.session_version = 0
+        self.session_snapshot: Dict[str, Any] = {}
+        self.default_workspace_id = uuid.uuid4().hex
+        
+        # Every generation is kept on disk, deduplicated by content across sessions
+        self.artifact_store = artifact_store or ArtifactStore()
+        self.current_generation_id = None
+        
+        # Identical concurrent validate/plan requests share a single terraform run
+        self.single_flight = SingleFlight()
+        # Repeated validate/plan requests on unchanged code and state reuse the last result
+        self.result_cache = TerraformResultCache()
+    
+    @property
+    def workspace_id(self) -> str:
+        """
+        The persistent Terraform workspace of this agent, one per session.
+        """
+        return self.session_id or self.default_workspace_id
+    
+    def get_provider_requirements(self, infrastructure_spec: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Determine the Terraform providers an infrastructure spec needs.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+            
+        Returns:
+            A dictionary mapping provider names to their registry sources.
+        """
+        # Everything the agent generates targets Azure
+        return {"azurerm": "hashicorp/azurerm"}
+    
+    def for_session(self, session_id: str, tenant_id: Optional[str] = None) -> "AzureTerraformAgent":
+        """
+        Get an agent bound to a session, sharing the API clients and Terraform executor with this one.
+        
+        Args:
+            session_id: The session identifier.
+            tenant_id: The tenant the session's usage is charged to. If None, the default tenant is used.
+            
+        Returns:
+            An agent loaded with the session's stored state.
+        """
+        session_agent = copy.copy(self)
+        session_agent.conversational_agent = copy.copy(self.conversational_agent)
+        session_agent.session_id = session_id
+        session_agent.tenant_id = tenant_id or "default"
+        # Without a tenant, earlier requests are only suggested back to the same session
+        session_agent.conversational_agent.spec_cache_scope = f"tenant:{tenant_id}" if tenant_id else f"session:{session_id}"
+        state, session_agent.session_version = self.session_store.load_versioned(session_id)
+        session_agent.session_snapshot = copy.deepcopy(state or {})
+        session_agent.import_state(state or {})
+        return session_agent
+    
+    def export_state(self) -> Dict[str, Any]:
+        """
+        Export the per-session state as a serializable record.
+        
+        Returns:
+            A dictionary containing the conversation history, spec and files.
+        """
+        return {
+            "conversation_history": self.conversational_agent.conversation_history,
+            "pending_messages": self.conversational_agent.pending_messages,
+            "suggested_spec": self.conversational_agent.suggested_spec,
+            "catalog_warnings": self.conversational_agent.catalog_warnings,
+            "infrastructure_spec": self.current_infrastructure_spec,
+            "terraform_files": self.current_terraform_files,
+            "applied_infrastructure_spec": self.applied_infrastructure_spec,
+            "applied_terraform_files": self.applied_terraform_files,
+            "generation_id": self.current_generation_id,
+            "usage": self.session_usage
+        }
+    
+    def import_state(self, state: Dict[str, Any]) -> None:
+        """
+        Replace the per-session state with a record from `export_state`.
+        
+        Args:
+            state: The session record.
+        """
+        self.conversational_agent.conversation_history = list(state.get("conversation_history") or [])
+        self.conversational_agent.pending_messages = list(state.get("pending_messages") or [])
+        self.conversational_agent.suggested_spec = state.get("suggested_spec")
+        self.conversational_agent.catalog_warnings = list(state.get("catalog_warnings") or [])
+        self._set_infrastructure_spec(state.get("infrastructure_spec"))
+        self._set_terraform_files(state.get("terraform_files"))
+        self.applied_infrastructure_spec = state.get("applied_infrastructure_spec")
+        self.applied_terraform_files = state.get("applied_terraform_files")
+        self.current_generation_id = state.get("generation_id")
+        self.session_usage = {**UsageBudget.new_usage(), **(state.get("usage") or {})}
+    
+    def save_session(self) -> None:
+        """
+        Persist the per-session state if the agent is bound to a session.
+        
+        The save only succeeds if nobody else saved the session since it was loaded. Otherwise the
+        fields this request changed are merged into the newer record and the save is retried, so a
+        long apply finishing after a newer generation doesn't bring back the old files. Usage is added
+        to the newer record instead, so concurrent requests don't drop each other's charges.
+        """
+        if not self.session_id:
+            return
+        state = self.export_state()
+        changes = {key: value for key, value in state.items() if self.session_snapshot.get(key) != value}
+        record, version = state, self.session_version
+        try:
+            for attempt in range(self.SESSION_SAVE_ATTEMPTS):
+                new_version = self.session_store.save(self.session_id, record, expected_version=version)
+                if new_version is not None:
+                    self.session_version = new_version
+                    self.session_snapshot = copy.deepcopy(record)
+                    if record is not state:
+                        # The usage budget of a running request keeps charging the same usage record
+                        usage = self.session_usage
+                        self.import_state(record)
+                        usage.update(self.session_usage)
+                        self.session_usage = usage
+                    return
+                
+                latest, version = self.session_store.load_versioned(self.session_id)
+                logger.info(f"Session {self.session_id} changed concurrently, merging {sorted(changes)} into version {version}")
+                if latest is None:
+                    record = state
+                    continue
+                record = {**latest, **changes}
+                record["usage"] = UsageBudget.merge_usage(latest.get("usage"), state["usage"],
+                                                          self.session_snapshot.get("usage"))
+            logger.error(f"Failed to save session {self.session_id}: it kept changing concurrently")
+        except Exception as e:
+            logger.error(f"Failed to save session {self.session_id}: {str(e)}")
+    
+    def process_user_request(self, user_message: str) -> Dict[str, Any]:
+        """
+        Process a user request for infrastructure changes.
+        
+        Args:
+            user_message: The user's message.
+            
+        Returns:
+            A dictionary containing the response information.
+        """
+        # Charge the Claude calls of this request to the session and its tenant
+        with self.usage_budget.bind(self.session_usage, self.tenant_id):
+            return self._process_user_request(user_message)
+    
+    def _process_user_request(self, user_message: str) -> Dict[str, Any]:
+        """
+        Process a user request for infrastructure changes within the session's usage budget.
+        
+        Args:
+            user_message: The user's message.
+            
+        Returns:
+            A dictionary containing the response information.
+        """
+        logger.info(f"Processing user request: {user_message}")
+        
+        budget_level = self.usage_budget.level(self.session_usage, self.tenant_id)
+        if budget_level != UsageBudget.NORMAL:
+            logger.warning(f"Usage budget of session {self.session_id} (tenant {self.tenant_id}) is {budget_level}")
+
+        # Interpret the user's request and generate its code, until the session cancels its operations
+        started_at = time.time()
+        
+        def cancel_check() -> bool:
+            return self.terraform_executor.cancel_requested(self.workspace_id, started_at)
+        
+        # Use the conversational agent to interpret the user's request
+        try:
+            with StageTimings.stage("extraction"):
+                response = self.conversational_agent.process_message(user_message, budget_level, cancel_check)
+        except CancelledError:
+            self.save_session()
+            return {
+                "success": False,
+                "message": "The request was cancelled",
+                "infrastructure_spec": None,
+                "terraform_code": None
+            }
+        
+        # Check if we need more information from the user
+        if "needs_more_info" in response and response["needs_more_info"]:
+            missing_fields = response.get("missing_fields", [])
+            
+            # Format a message asking for the missing information
+            missing_info_message = response.get("message", "I need some additional information to create your Terraform code:")
+            
+            self.save_session()
+            return {
+                "success": False,
+                "message": missing_info_message,
+                "needs_more_info": True,
+                "missing_fields": missing_fields,
+                "invalid_fields": response.get("invalid_fields", {}),
+                "infrastructure_spec": None,
+                "terraform_code": None
+            }
+        
+        # A rephrased earlier request is answered with its spec, which the user confirms before generation
+        if response.get("needs_confirmation"):
+            self.save_session()
+            return {
+                "success": False,
+                "message": response["message"],
+                "needs_confirmation": True,
+                "suggested_spec": response["suggested_spec"],
+                "similarity": response["similarity"],
+                "infrastructure_spec": None,
+                "terraform_code": None
+            }
+        
+        if "error" in response:
+            self.save_session()
+            return {
+                "success": False,
+                "message": f"Failed to interpret infrastructure requirements: {response['error']}",
+                "infrastructure_spec": None,
+                "terraform_code": None
+            }
+        
+        # Store the current infrastructure spec
+        self._set_infrastructure_spec(response)
+        
+        # The providers are known now, so download them while Claude writes the code
+        try:
+            self.terraform_executor.prepare_workspace_async(self.workspace_id, self.get_provider_requirements(response))
+        except Exception as e:
+            logger.warning(f"Failed to start workspace preparation: {str(e)}")
+        
+        # Without budget left, only a module template can produce the code
+        budget_level = self.usage_budget.level(self.session_usage, self.tenant_id)
+        if budget_level == UsageBudget.EXHAUSTED and self.terraform_generator.render_template(response) is None:
+            self.save_session()
+            return {
+                "success": False,
+                "message": "The Claude usage budget of this session is exhausted and no template covers this resource type",
+                "infrastructure_spec": response,
+                "terraform_code": None,
+                "budget": self.usage_budget.get_status(self.session_usage, self.tenant_id)
+            }
+        
+        # Generate Terraform code based on the infrastructure spec
+        try:
+            with StageTimings.stage("generation"):
+                terraform_code = self.terraform_generator.generate_terraform_code(
+                    response,
+                    cancel_check=cancel_check,
+                    budget_level=budget_level
+                )
+        except CancelledError:
+            self.save_session()
+            return {
+                "success": False,
+                "message": "Code generation was cancelled",
+                "infrastructure_spec": response,
+                "terraform_code": None
+            }
+        
+        # Parse the Terraform code into separate files
+        with StageTimings.stage("parse_terraform_files"):
+            terraform_files = self.terraform_generator.parse_terraform_files(terraform_code)
+        
+        # Store the current Terraform files
+        self._set_terraform_files(terraform_files)
+        with StageTimings.stage("store_generation"):
+            self.record_generation()
+            self.save_session()
+        
+        return {
+            "success": True,
+            "message": "Successfully generated Terraform code",
+            "infrastructure_spec": response,
+            "terraform_code": self.current_terraform_code,
+            "terraform_files": terraform_files,
+            "budget_level": budget_level
+        }
+    
+    def _set_infrastructure_spec(self, infrastructure_spec: Optional[Dict[str, Any]]) -> None:
+        """
+        Store the current infrastructure spec together with its content hash.
+        
+        Args:
+            infrastructure_spec: The infrastructure specification dictionary.
+        """
+        self.current_infrastructure_spec = infrastructure_spec
+        self.current_infrastructure_spec_hash = None
+        if infrastructure_spec:
+            serialized = json.dumps(infrastructure_spec, sort_keys=True, separators=(",", ":"))
+            self.current_infrastructure_spec_hash = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    
+    def _set_terraform_files(self, terraform_files: Optional[Dict[str, str]]) -> None:
+        """
+        Store the current Terraform files together with their content hashes and display text.
+        
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
+        """
+        self.current_terraform_files = terraform_files
+        self.current_terraform_file_hashes = {}
+        self.current_terraform_files_hash = None
+        self.current_terraform_code = None
+        if not terraform_files:
+            return
+        
+        files_hash = hashlib.sha256()
+        for file_name in sorted(terraform_files):
+            file_hash = hashlib.sha256(terraform_files[file_name].encode("utf-8")).hexdigest()
+            self.current_terraform_file_hashes[file_name] = file_hash
+            files_hash.update(f"{file_name}\0{file_hash}\0".encode("utf-8"))
+        self.current_terraform_files_hash = files_hash.hexdigest()
+        
+        # Format the Terraform code for display once instead of on every request
+        self.current_terraform_code = "\n\n".join([f"# {file_name}\n{content}" for file_name, content in terraform_files.items()])
+    
+    def validate_terraform(self, log_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Validate the current Terraform code.
+        
+        Validation doesn't depend on state, so concurrent requests validating the same files share a
+        single run, in any session: callers joining it get the result of the first caller's workspace,
+        including its log ID.
+        
+        Args:
+            log_id: The identifier to spool the output under, so clients can follow it while it runs.
+        
+        Returns:
+            A dictionary containing the validation result.
+        """
+        if not self.current_terraform_files:
+            return {
+                "success": False,
+                "message": "No Terraform code has been generated yet"
+            }
+        
+        cached = self.result_cache.get("validate", self._validate_cache_key())
+        if cached is not None:
+            logger.info("Returning the cached validation of unchanged Terraform code")
+            return cached
+        
+        # Validation doesn't depend on state, so any session validating the same files can share the run
+        request_key = SingleFlight.make_key("validate", self.current_terraform_files_hash)
+        log_id = self._new_log_id(log_id)
+        started_at = time.time()
+        try:
+            return self.single_flight.do(
+                request_key,
+                lambda cancel_event: self._run_validate(log_id, cancel_event),
+                cancel_check=lambda: self.terraform_executor.cancel_requested(self.workspace_id, started_at)
+            )
+        except CancelledError:
+            return {
+                "success": False,
+                "message": "Terraform validate was cancelled",
+                "log_id": log_id
+            }
+    
+    def _validate_cache_key(self, fingerprint: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Build the result cache key of validating the current Terraform code in this session's workspace.
+        
+        Args:
+            fingerprint: The workspace fingerprint the validation ran against. If None, the current one is read.
+        
+        Returns:
+            The key over the files, the installed modules and the selected provider versions.
+        """
+        fingerprint = fingerprint or self.terraform_executor.workspace_fingerprint(self.workspace_id)
+        return SingleFlight.make_key("validate", self.current_terraform_files_hash, fingerprint["module_version"],
+                                     fingerprint["provider_lock_hash"])
+    
+    def _run_validate(self, log_id: str, cancel_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """
+        Run terraform validate on the current Terraform code.
+        
+        Args:
+            log_id: The identifier to spool the output under.
+            cancel_event: Set when no caller waits for the result anymore.
+        
+        Returns:
+            A dictionary containing the validation result.
+        """
+        
+        # Execute Terraform validate
+        fingerprint: Dict[str, Any] = {}
+        success, output = self.terraform_executor.execute_terraform(
+            self.current_terraform_files,
+            workspace_id=self.workspace_id,
+            operation="validate",
+            log_id=log_id,
+            cancel_event=cancel_event,
+            fingerprint=fingerprint
+        )
+        
+        result = {
+            "success": success,
+            "message": output,
+            "log_id": log_id
+        }
+        # Keyed by the workspace as the run left it, the first init selects the provider versions
+        if fingerprint:
+            self.result_cache.put("validate", self._validate_cache_key(fingerprint), result)
+        return result
+    
+    def resolve_change_scope(self, change_scope: Optional[Any] = None) -> List[str]:
+        """
+        Translate a change scope into `-target` addresses for the current Terraform code.
+        
+        Args:
+            change_scope: None for the whole configuration, "files" to diff the current files against
+                the last applied files, "spec" to target the resources of the current spec's resource type,
+                or an explicit list of resource addresses.
+            
+        Returns:
+            The target addresses including their dependents. An empty list means no targeting.
+            
+        Raises:
+            ValueError: If the change scope is invalid or matches no resources. A scope is never widened
+                to the whole configuration because nothing matched it.
+        """
+        if not change_scope or not self.current_terraform_files:
+            return []
+        
+        graph = TerraformDependencyGraph(self.current_terraform_files)
+        
+        if isinstance(change_scope, (list, tuple)):
+            addresses = set(change_scope)
+            # Blocks removed since the last apply are still in state, so they can be targeted too
+            known = set(graph.blocks)
+            if self.applied_terraform_files:
+                known |= set(TerraformDependencyGraph(self.applied_terraform_files).blocks)
+            unknown = sorted(
+                address for address in addresses
+                if not isinstance(address, str) or not graph.is_targetable(address)
+                or graph.block_address(address) not in known
+            )
+            if unknown:
+                raise ValueError(f"Change scope names unknown resources: {', '.join(map(str, unknown))}")
+        elif change_scope == "files":
+            if not self.applied_terraform_files:
+                logger.info("No previous apply to diff against, planning the whole configuration")
+                return []
+            addresses = graph.changed_addresses(TerraformDependencyGraph(self.applied_terraform_files))
+            if addresses is None:
+                logger.info("Provider or backend configuration changed, planning the whole configuration")
+                return []
+        elif change_scope == "spec":
+            spec = self.current_infrastructure_spec or {}
+            if spec == self.applied_infrastructure_spec:
+                raise ValueError("Change scope matched no resources: the spec hasn't changed since the last apply")
+            addresses = graph.addresses_for_resource_type(spec.get("resource_type") or "")
+        else:
+            raise ValueError(f"Invalid change scope: {change_scope}. Use 'files', 'spec' or a list of addresses")
+        
+        # The closure keeps addresses removed from the configuration, which are still targetable in state
+        targets = graph.target_addresses(addresses)
+        if not targets:
+            raise ValueError("Change scope matched no resources, pass their addresses or leave out the change scope")
+        
+        logger.info(f"Resolved change scope to targets: {targets}")
+        return targets
+    
+    def plan_terraform(self, change_scope: Optional[Any] = None, refresh: bool = True,
+                       log_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a Terraform plan for the current code.
+        
+        Args:
+            change_scope: Limits the plan to changed resources. See `resolve_change_scope`.
+            refresh: Whether to refresh resource state before planning.
+            log_id: The identifier to spool the output under, so clients can follow it while it runs.
+        
+        Returns:
+            A dictionary containing the plan result.
+        """
+        if not self.current_terraform_files:
+            return {
+                "success": False,
+                "message": "No Terraform code has been generated yet"
+            }
+        
+        try:
+            targets = self.resolve_change_scope(change_scope)
+        except ValueError as e:
+            return {
+                "success": False,
+                "message": str(e)
+            }
+        
+        cached = self.result_cache.get("plan", self._plan_cache_key(targets, refresh))
+        if cached is not None and os.path.exists(self.terraform_executor.get_plan_path(cached["plan_id"])):
+            logger.info("Returning the cached plan of unchanged Terraform code and state")
+            return cached
+        
+        request_key = SingleFlight.make_key("plan", self.workspace_id, self.current_terraform_files_hash, targets, refresh)
+        log_id = self._new_log_id(log_id)
+        started_at = time.time()
+        try:
+            # Cancelling the session stops waiting, and the run itself once no other caller waits for it
+            return self.single_flight.do(
+                request_key,
+                lambda cancel_event: self._run_plan(targets, refresh, log_id, cancel_event),
+                cancel_check=lambda: self.terraform_executor.cancel_requested(self.workspace_id, started_at)
+            )
+        except CancelledError:
+            return {
+                "success": False,
+                "message": "Terraform plan was cancelled",
+                "targets": targets,
+                "log_id": log_id
+            }
+    
+    def _plan_cache_key(self, targets: List[str], refresh: bool, fingerprint: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Build the result cache key of planning the current Terraform code in this session's workspace.
+        
+        Args:
+            targets: The resource addresses the plan is limited to.
+            refresh: Whether the plan refreshes resource state.
+            fingerprint: The workspace fingerprint the plan ran against. If None, the current one is read.
+            
+        Returns:
+            The key over the plan options, files, installed modules, selected provider versions and state serial.
+        """
+        fingerprint = fingerprint or self.terraform_executor.workspace_fingerprint(self.workspace_id)
+        return SingleFlight.make_key("plan", self.workspace_id, self.current_terraform_files_hash, targets, refresh,
+                                     fingerprint["module_version"], fingerprint["provider_lock_hash"],
+                                     fingerprint["state_serial"])
+    
+    def _run_plan(self, targets: List[str], refresh: bool, log_id: str,
+                  cancel_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """
+        Run terraform plan on the current Terraform code and summarize the result.
+        
+        Args:
+            targets: The resource addresses to limit the plan to.
+            refresh: Whether to refresh resource state before planning.
+            log_id: The identifier to spool the output under.
+            cancel_event: Set when no caller waits for the result anymore.
+        
+        Returns:
+            A dictionary containing the plan result.
+        """
+        plan_id = uuid.uuid4().hex
+        
+        # Execute Terraform plan
+        fingerprint: Dict[str, Any] = {}
+        success, output = self.terraform_executor.execute_terraform(
+            self.current_terraform_files,
+            workspace_id=self.workspace_id,
+            operation="plan",
+            targets=targets,
+            refresh=refresh,
+            plan_id=plan_id,
+            log_id=log_id,
+            cancel_event=cancel_event,
+            fingerprint=fingerprint
+        )
+        
+        if not success:
+            return {
+                "success": False,
+                "message": output,
+                "targets": targets,
+                "log_id": log_id
+            }
+        
+        # Return a compact summary, the full plan can be fetched with get_plan
+        try:
+            with StageTimings.stage("plan_summary"):
+                plan_summary = self.terraform_executor.summarize_plan(plan_id)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to summarize plan: {str(e)}")
+            return {
+                "success": True,
+                "message": output,
+                "targets": targets,
+                "plan_id": plan_id,
+                "log_id": log_id
+            }
+        
+        result = {
+            "success": True,
+            "message": TerraformPlanReader.format_summary(plan_summary),
+            "targets": targets,
+            "plan_id": plan_id,
+            "plan_summary": plan_summary,
+            "log_id": log_id
+        }
+        # Keyed by the state serial read before the workspace was unlocked, an apply can't slip in between
+        if fingerprint:
+            self.result_cache.put("plan", self._plan_cache_key(targets, refresh, fingerprint), result)
+        return result
     
-    def __init__(self, 
-                 anthropic_api_key: Optional[str] = None,
-                 model: Optional[str] = None):
+    def get_plan(self, plan_id: str) -> Dict[str, Any]:
         """
-        Initialize the Terraform code generator.
+        Get the location of a saved JSON plan.
         
         Args:
-            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
-            model: The Claude model to use. If None, it will use the default.
+            plan_id: The plan identifier returned by `plan_terraform`.
+            
+        Returns:
+            A dictionary containing the path of the JSON plan file.
         """
-        # Set Anthropic configuration
-        self.api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
-        if not self.api_key:
-            raise ValueError("Anthropic API key is required. Please provide it or set ANTHROPIC_API_KEY environment variable.")
+        try:
+            plan_path = self.terraform_executor.get_plan_path(plan_id)
+        except ValueError as e:
+            return {
+                "success": False,
+                "message": str(e)
+            }
         
-        self.model = model or os.getenv("ANTHROPIC_MODEL", "claude-3-opus-20240229")
+        if not os.path.exists(plan_path):
+            return {
+                "success": False,
+                "message": f"Plan {plan_id} not found"
+            }
         
-        # Initialize Anthropic client
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+        return {
+            "success": True,
+            "message": "Plan retrieved",
+            "plan_path": plan_path
+        }
     
-    def generate_terraform_code(self, infrastructure_spec: Dict[str, Any]) -> str:
+    def apply_terraform(self, auto_approve: bool = False, change_scope: Optional[Any] = None,
+                        refresh: bool = True, log_id: Optional[str] = None) -> Dict[str, Any]:
         """
-        Generate Terraform HCL code based on the infrastructure specification.
+        Apply the current Terraform code.
         
         Args:
-            infrastructure_spec: The infrastructure specification dictionary.
+            auto_approve: Whether to automatically approve the apply operation.
+            change_scope: Limits the apply to changed resources. See `resolve_change_scope`.
+            refresh: Whether to refresh resource state before applying.
+            log_id: The identifier to spool the output under, so clients can follow it while it runs.
             
         Returns:
-            The generated Terraform HCL code as a string.
+            A dictionary containing the apply result.
         """
-        # Prepare a detailed prompt for the Claude model to generate Terraform code
-        system_prompt = "You are an expert Terraform developer specializing in Azure infrastructure."
+        if not self.current_terraform_files:
+            return {
+                "success": False,
+                "message": "No Terraform code has been generated yet"
+            }
         
-        user_prompt = f"""
-        Generate complete, valid Terraform HCL code for Azure to implement the following infrastructure specification:
+        try:
+            targets = self.resolve_change_scope(change_scope)
+        except ValueError as e:
+            return {
+                "success": False,
+                "message": str(e)
+            }
+        log_id = self._new_log_id(log_id)
         
-        {json.dumps(infrastructure_spec, indent=2)}
+        # Execute Terraform apply
+        success, output = self.terraform_executor.execute_terraform(
+            self.current_terraform_files,
+            workspace_id=self.workspace_id,
+            operation="apply",
+            auto_approve=auto_approve,
+            targets=targets,
+            refresh=refresh,
+            log_id=log_id
+        )
         
-        Include:
-        1. Provider configuration for Azure
-        2. Resource group definition
-        3. All required resources with appropriate configurations
-        4. Output definitions for important resource identifiers
+        # A full apply, or one targeted at every changed block, brings the deployment in line with the files
+        if success and (not targets or change_scope == "files"):
+            self.applied_terraform_files = dict(self.current_terraform_files)
+            self.applied_infrastructure_spec = self.current_infrastructure_spec
+            self.save_session()
         
-        Use terraform best practices, including:
-        - Proper variable declarations
-        - Resource naming conventions
-        - Use of locals where appropriate
-        - Organized file structure (provider.tf, variables.tf, main.tf, outputs.tf)
+        return {
+            "success": success,
+            "message": output,
+            "targets": targets,
+            "log_id": log_id
+        }
+    
+    def destroy_terraform(self, auto_approve: bool = False, log_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Destroy the infrastructure created by the current Terraform code.
         
-        Return ONLY the Terraform code, grouped by file, with each file name as a markdown header.
-        Format the code with proper Terraform code blocks like:
+        Args:
+            auto_approve: Whether to automatically approve the destroy operation.
+            log_id: The identifier to spool the output under, so clients can follow it while it runs.
+            
+        Returns:
+            A dictionary containing the destroy result.
+        """
+        if not self.current_terraform_files:
+            return {
+                "success": False,
+                "message": "No Terraform code has been generated yet"
+            }
         
-        # provider.tf
-        ```hcl
-        provider "azurerm" {{
-          features {{}}
-        }}
-        ```
+        log_id = self._new_log_id(log_id)
         
-        # main.tf
-        ```hcl
-        // Terraform code
-        ```
+        # Execute Terraform destroy
+        success, output = self.terraform_executor.execute_terraform(
+            self.current_terraform_files,
+            workspace_id=self.workspace_id,
+            operation="destroy",
+            auto_approve=auto_approve,
+            log_id=log_id
+        )
+        
+        return {
+            "success": success,
+            "message": output,
+            "log_id": log_id
+        }
+    
+    def resource_names(self, terraform_files: Dict[str, str]) -> List[Tuple[str, str, str]]:
         """
+        Find the `name` argument of every resource block.
         
-        try:
-            # Call Anthropic API to generate Terraform code
-            response = self.client.messages.create(
-                model=self.model,
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_prompt}],
-                temperature=0.2,
-                max_tokens=4000
-            )
-            
-            # Extract the generated Terraform code
-            terraform_code = response.content[0].text
+        Args:
+            terraform_files: A dictionary mapping file names to their content.
             
-            return terraform_code
+        Returns:
+            (address, kind, value) tuples, where kind is literal with the name as value, variable with
+            the variable name as value, or expression with the source text as value.
+        """
+        names = []
+        graph = TerraformDependencyGraph()
+        for file_name in sorted(terraform_files):
+            if not file_name.endswith(".tf"):
+                continue
+            for address, body in graph._parse_blocks(terraform_files[file_name]):
+                if address.startswith(("data.", "var.", "module.", "output.", "provider.")) or "." not in address:
+                    continue
+                for match in self.NAME_ATTRIBUTE_PATTERN.finditer(body):
+                    # Only the resource's own name, not the names of nested blocks
+                    prefix = body[:match.start()]
+                    if prefix.count("{") != prefix.count("}"):
+                        continue
+                    value = match.group(1)
+                    literal = re.fullmatch(r'"([^"$%\\]*)"', value)
+                    variable = re.fullmatch(r'var\.([A-Za-z_][\w-]*)', value)
+                    if literal:
+                        names.append((address, "literal", literal.group(1)))
+                    elif variable:
+                        names.append((address, "variable", variable.group(1)))
+                    else:
+                        names.append((address, "expression", value))
+                    break
+        return names
+    
+    def _suffixed_name(self, resource_type: str, name: str, suffix: str) -> str:
+        """
+        Append a target suffix to a resource name within the naming rules of its type.
+        
+        Args:
+            resource_type: The azurerm resource type.
+            name: The name in the current code.
+            suffix: The target suffix.
             
-        except Exception as e:
-            logger.error(f"Failed to call Claude API: {str(e)}")
-            return f"Error generating Terraform code: {str(e)}"
+        Returns:
+            The name for the target.
+        """
+        separator = "" if resource_type in self.COMPACT_NAME_TYPES else "-"
+        limit = self.NAME_LIMITS.get(resource_type)
+        if limit and len(name) + len(separator) + len(suffix) > limit:
+            # A short hash keeps the name unique when the whole suffix doesn't fit
+            suffix = hashlib.sha256(suffix.encode("utf-8")).hexdigest()[:6]
+            name = name[:limit - len(separator) - len(suffix)].rstrip("-_")
+        return f"{name}{separator}{suffix}"
     
-    def parse_terraform_files(self, terraform_code: str) -> Dict[str, str]:
+    def render_target_files(self, target: Dict[str, Any], name_suffix: Optional[str] = None) -> Dict[str, str]:
         """
-        Parse the generated Terraform code into separate files.
+        Render the current Terraform files for one fan-out target.
         
         Args:
-            terraform_code: The Terraform code as a single string with markdown headers.
+            target: A dictionary with an optional `location`, `subscription_id` and `variables` overrides.
+            name_suffix: Appended to the literal resource names, and to every reference to them, so
+                targets in the same subscription don't collide.
             
         Returns:
-            A dictionary mapping file names to their content.
+            The Terraform files with the target's variable overrides.
         """
-        files = {}
-        current_file = None
-        current_content = []
-        in_code_block = False
+        files = dict(self.current_terraform_files)
         
-        # Split the code by lines
-        lines = terraform_code.strip().split('\n')
+        if name_suffix:
+            renames = {}
+            for address, kind, value in self.resource_names(files):
+                if kind == "literal" and value:
+                    renames[value] = self._suffixed_name(address.split(".")[0], value, name_suffix)
+            if renames:
+                pattern = re.compile('"(' + "|".join(re.escape(name) for name in sorted(renames, key=len, reverse=True)) + ')"')
+                for file_name, content in files.items():
+                    if file_name.endswith(".tf"):
+                        files[file_name] = pattern.sub(lambda match: f'"{renames[match.group(1)]}"', content)
         
-        for line in lines:
-            # Check if the line is a markdown header (file name)
-            header_match = re.match(r'^#+\s+(.+\.tf)$', line)
-            if header_match:
-                # Save the previous file if there was one
-                if current_file and current_content:
-                    files[current_file] = '\n'.join(current_content)
-                
-                # Start a new file
-                current_file = header_match.group(1)
-                current_content = []
-                in_code_block = False
-            elif line.strip().startswith('```') and not in_code_block:
-                # Start of code block - skip this line
-                in_code_block = True
-            elif line.strip().startswith('```') and in_code_block:
-                # End of code block - skip this line
-                in_code_block = False
-            elif current_file and in_code_block:
-                # We're inside a code block for the current file - add the line
-                current_content.append(line)
+        declared = {address[len("var."):] for address in TerraformDependencyGraph(files).blocks if address.startswith("var.")}
         
-        # Save the last file
-        if current_file and current_content:
-            files[current_file] = '\n'.join(current_content)
+        overrides = {}
+        for name, value in (target.get("variables") or {}).items():
+            if name in declared:
+                overrides[name] = value
+            else:
+                logger.warning(f"Ignoring override of undeclared variable {name}")
         
-        # If no files were found using markdown headers, assume it's a single file
-        if not files:
-            # Try to extract content from code blocks
-            code_blocks = re.findall(r'```(?:hcl|terraform)?\s*(.*?)\s*```', terraform_code, re.DOTALL)
-            if code_blocks:
-                # Combine all code blocks into main.tf
-                files["main.tf"] = '\n\n'.join(code_blocks)
+        location = target.get("location")
+        if location:
+            location_variables = [name for name in self.LOCATION_VARIABLES if name in declared]
+            if location_variables:
+                for name in location_variables:
+                    overrides.setdefault(name, location)
             else:
-                # Just extract all text as main.tf
-                files["main.tf"] = terraform_code.strip()
+                # The location is hard-coded, so rewrite the literal location attributes
+                for file_name, content in files.items():
+                    if file_name.endswith(".tf"):
+                        files[file_name] = self.LOCATION_ATTRIBUTE_PATTERN.sub(rf'\g<1>{location}\g<2>', content)
         
+        if overrides:
+            files["fanout.auto.tfvars.json"] = json.dumps(overrides, indent=2)
         return files
-
-
-class TerraformExecutor:
-    """
-    Executes Terraform commands on the generated code.
-    """
     
-    def __init__(self):
+    def import_resources(self, resource_groups: Optional[List[str]] = None,
+                         resource_types: Optional[List[str]] = None,
+                         generate_config: bool = True, log_id: Optional[str] = None) -> Dict[str, Any]:
         """
-        Initialize the Terraform executor.
+        Replace the current Terraform code with import blocks and configuration for existing Azure resources.
+        
+        Args:
+            resource_groups: The resource groups to import. If None, every group of the subscription is imported.
+            resource_types: ARM resource types to limit the import to. If None, every supported type is imported.
+            generate_config: Whether Terraform should generate the configuration the templates can't provide.
+                If False, or if generation fails, those resources are left out.
+            log_id: The identifier to spool the config generation output under.
+            
+        Returns:
+            A dictionary containing the import summary and the Terraform code.
         """
-        # Verify terraform is installed
         try:
-            subprocess.run(["terraform", "--version"], check=True, capture_output=True)
-        except (subprocess.SubprocessError, FileNotFoundError):
-            logger.error("Terraform not found. Please install Terraform and make sure it's in your PATH.")
-            raise RuntimeError("Terraform not found")
+            groups, resources, truncated = self.resource_importer.list_resources(resource_groups, resource_types)
+        except Exception as e:
+            logger.error(f"Failed to list Azure resources: {str(e)}")
+            return {
+                "success": False,
+                "message": f"Failed to list Azure resources: {str(e)}"
+            }
+        if not groups:
+            return {
+                "success": False,
+                "message": "No resource groups found to import"
+            }
         
-        # Set up Azure credentials
-        self.credential = DefaultAzureCredential()
-        self.subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-        if not self.subscription_id:
-            raise ValueError("Azure subscription ID is required. Please set AZURE_SUBSCRIPTION_ID environment variable.")
+        terraform_files, summary = self.resource_importer.build_files(groups, resources)
+        summary["truncated"] = truncated
         
-        # Initialize resource client
-        self.resource_client = ResourceManagementClient(self.credential, self.subscription_id)
-    
-    def _write_terraform_files(self, directory: str, files: Dict[str, str]) -> None:
-        """
-        Write Terraform files to a directory.
+        generation_output = None
+        warning = None
+        if "imports_generated.tf" in terraform_files:
+            generated = None
+            if generate_config:
+                log_id = self._new_log_id(log_id)
+                success, generation_output, generated = self.terraform_executor.generate_import_config(terraform_files, log_id)
+                summary["log_id"] = log_id
+                if not success:
+                    # Terraform writes what it could generate even when the plan then fails on it
+                    warning = ("Terraform generated configuration that doesn't plan cleanly, review generated.tf"
+                               if generated else "Terraform could not generate the missing configuration")
+                    logger.warning(f"{warning}, see log {log_id}")
+            if generated:
+                terraform_files["generated.tf"] = generated
+            else:
+                # An import block without configuration fails the plan, so these resources are left out
+                del terraform_files["imports_generated.tf"]
+                summary["skipped"] = summary.pop("needs_generated_config")
         
-        Args:
-            directory: The directory to write the files to.
-            files: A dictionary mapping file names to their content.
-        """
-        for file_name, content in files.items():
-            file_path = os.path.join(directory, file_name)
-            with open(file_path, 'w') as f:
-                f.write(content)
+        resource_group_names = [group["name"] for group in groups]
+        self._set_infrastructure_spec({
+            "resource_type": "imported resources",
+            "resource_groups": resource_group_names,
+            "resource_count": len(resources)
+        })
+        self._set_terraform_files(terraform_files)
+        self.record_generation()
+        self.save_session()
+        
+        message = f"Imported {summary['templated'] + summary.get('needs_generated_config', 0)} resources from {len(groups)} resource groups"
+        if summary.get("skipped"):
+            message += f", {summary['skipped']} resources need configuration Terraform could not generate"
+        if truncated:
+            message += f", limited to the first {len(resources)} resources"
+        return {
+            "success": True,
+            "message": message,
+            "summary": summary,
+            "warning": warning,
+            "generation_output": generation_output,
+            "infrastructure_spec": self.current_infrastructure_spec,
+            "terraform_code": self.current_terraform_code,
+            "terraform_files": list(terraform_files)
+        }
     
-    def execute_terraform(self, terraform_files: Dict[str, str], operation: str = "apply", auto_approve: bool = False) -> Tuple[bool, str]:
+    def fan_out(self, targets: List[Dict[str, Any]], operation: str = "plan", auto_approve: bool = False,
+                max_parallel: Optional[int] = None) -> Dict[str, Any]:
         """
-        Execute Terraform operations on the generated code.
+        Plan or apply the current Terraform code for many locations or subscriptions at once.
+        Every target gets its own persistent workspace and the runs are executed concurrently.
         
         Args:
-            terraform_files: A dictionary mapping file names to their content.
-            operation: The Terraform operation to execute (init, plan, apply, destroy).
-            auto_approve: Whether to automatically approve apply/destroy operations.
+            targets: Dictionaries with a `location` and/or `subscription_id`, and optional `variables` overrides.
+                Targets sharing a subscription get their location, or an explicit `name_suffix`, appended
+                to the resource names.
+            operation: Either plan or apply.
+            auto_approve: Whether to automatically approve the apply operations. Required for apply.
+            max_parallel: The maximum number of concurrent runs. If None, it will try to get from environment variable.
             
         Returns:
-            A tuple containing (success boolean, output/error message).
+            A dictionary containing the per-target results and timings.
         """
-        valid_operations = ["init", "validate", "plan", "apply", "destroy"]
-        if operation not in valid_operations:
-            return False, f"Invalid operation: {operation}. Valid operations are {', '.join(valid_operations)}"
+        if not self.current_terraform_files:
+            return {
+                "success": False,
+                "message": "No Terraform code has been generated yet"
+            }
         
-        # Create a temporary directory for Terraform files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info(f"Using temporary directory: {temp_dir}")
-            
-            # Write Terraform files to the temporary directory
-            self._write_terraform_files(temp_dir, terraform_files)
-            
-            # Set Azure credentials environment variables for Terraform
-            env = os.environ.copy()
-            env["ARM_CLIENT_ID"] = os.getenv("AZURE_CLIENT_ID", "")
-            env["ARM_CLIENT_SECRET"] = os.getenv("AZURE_CLIENT_SECRET", "")
-            env["ARM_SUBSCRIPTION_ID"] = self.subscription_id
-            env["ARM_TENANT_ID"] = os.getenv("AZURE_TENANT_ID", "")
-            env["TF_LOG"] = "INFO"  # Enable Terraform logging
-            
-            # Execute Terraform init
-            logger.info("Running terraform init")
-            init_result = subprocess.run(
-                ["terraform", "init"],
-                cwd=temp_dir,
-                env=env,
-                capture_output=True,
-                text=True
-            )
-            
-            if init_result.returncode != 0:
-                logger.error(f"Terraform init failed: {init_result.stderr}")
-                return False, f"Terraform init failed: {init_result.stderr}"
-            
-            # Execute the requested Terraform operation
-            cmd = ["terraform", operation]
-            if operation in ["apply", "destroy"] and auto_approve:
-                cmd.append("-auto-approve")
+        if operation not in ["plan", "apply"]:
+            return {
+                "success": False,
+                "message": f"Invalid operation: {operation}. Valid operations are plan, apply"
+            }
+        
+        if operation == "apply" and not auto_approve:
+            return {
+                "success": False,
+                "message": "Applying to several targets requires auto_approve"
+            }
+        
+        if not targets:
+            return {
+                "success": False,
+                "message": "No targets given"
+            }
+        
+        # A plain string is shorthand for a location
+        targets = [target if isinstance(target, dict) else {"location": str(target)} for target in targets]
+        
+        for target in targets:
+            location = target.get("location")
+            subscription_id = target.get("subscription_id")
+            if not location and not subscription_id:
+                return {
+                    "success": False,
+                    "message": f"Target {target} needs a location or a subscription_id"
+                }
+            if location and not re.fullmatch(r'[a-z0-9]+', location):
+                return {
+                    "success": False,
+                    "message": f"Invalid location: {location}"
+                }
+            if subscription_id and not re.fullmatch(r'[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}', subscription_id):
+                return {
+                    "success": False,
+                    "message": f"Invalid subscription ID: {subscription_id}"
+                }
+            if target.get("name_suffix") and not re.fullmatch(r'[a-z0-9]{1,16}', str(target["name_suffix"])):
+                return {
+                    "success": False,
+                    "message": f"Invalid name suffix: {target['name_suffix']}"
+                }
+        
+        name_suffixes, collisions = self._plan_target_names(targets)
+        if collisions:
+            return {
+                "success": False,
+                "message": "Targets in the same subscription would create resources with the same name: "
+                           + "; ".join(collisions),
+                "collisions": collisions
+            }
+        
+        max_parallel = max(1, int(max_parallel or os.getenv("TERRAFORM_FANOUT_PARALLELISM", "4")))
+        provider_requirements = self.get_provider_requirements(self.current_infrastructure_spec or {})
+        
+        def workspace_for(target: Dict[str, Any]) -> str:
+            # Stable per session and target, so state is kept between fan-outs
+            key = f"{self.workspace_id}\0{target.get('location') or ''}\0{target.get('subscription_id') or ''}"
+            return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        
+        # Start downloading providers for every target before the runs queue up on the parallelism cap
+        for target in targets:
+            try:
+                self.terraform_executor.prepare_workspace_async(workspace_for(target), provider_requirements)
+            except Exception as e:
+                logger.warning(f"Failed to start workspace preparation: {str(e)}")
+        
+        def run_target(target: Dict[str, Any]) -> Dict[str, Any]:
+            workspace_id = workspace_for(target)
+            plan_id = uuid.uuid4().hex if operation == "plan" else None
+            log_id = uuid.uuid4().hex
+            started_at = time.time()
             
-            logger.info(f"Running terraform {operation}")
-            operation_result = subprocess.run(
-                cmd,
-                cwd=temp_dir,
-                env=env,
-                capture_output=True,
-                text=True
-            )
+            try:
+                success, output = self.terraform_executor.execute_terraform(
+                    self.render_target_files(target, name_suffixes[id(target)]),
+                    workspace_id=workspace_id,
+                    operation=operation,
+                    auto_approve=auto_approve,
+                    plan_id=plan_id,
+                    log_id=log_id,
+                    subscription_id=target.get("subscription_id")
+                )
+            except Exception as e:
+                logger.error(f"Fan-out {operation} for {target} failed: {str(e)}")
+                success, output = False, str(e)
             
-            if operation_result.returncode != 0:
-                logger.error(f"Terraform {operation} failed: {operation_result.stderr}")
-                return False, f"Terraform {operation} failed: {operation_result.stderr}"
+            result = {
+                "target": target,
+                "name_suffix": name_suffixes[id(target)],
+                "workspace_id": workspace_id,
+                "success": success,
+                "message": output,
+                "log_id": log_id,
+                "duration_seconds": round(time.time() - started_at, 1)
+            }
             
-            return True, operation_result.stdout
-
-
-class AzureTerraformAgent:
-    """
-    Main agent class that coordinates conversation, Terraform generation, and execution.
-    Uses Claude AI for model inference.
-    """
+            if success and plan_id:
+                try:
+                    result["plan_id"] = plan_id
+                    result["plan_summary"] = self.terraform_executor.summarize_plan(plan_id)
+                    result["message"] = TerraformPlanReader.format_summary(result["plan_summary"])
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to summarize plan: {str(e)}")
+            return result
+        
+        started_at = time.time()
+        with ThreadPoolExecutor(max_workers=min(max_parallel, len(targets)), thread_name_prefix="terraform-fanout") as pool:
+            futures = [pool.submit(contextvars.copy_context().run, run_target, target) for target in targets]
+            results = [future.result() for future in futures]
+        
+        succeeded = sum(1 for result in results if result["success"])
+        return {
+            "success": succeeded == len(results),
+            "message": f"{operation.capitalize()} succeeded for {succeeded} of {len(results)} targets",
+            "operation": operation,
+            "results": results,
+            "duration_seconds": round(time.time() - started_at, 1)
+        }
     
-    def __init__(self, 
-                 anthropic_api_key: Optional[str] = None,
-                 model: Optional[str] = None):
+    def _plan_target_names(self, targets: List[Dict[str, Any]]) -> Tuple[Dict[int, Optional[str]], List[str]]:
         """
-        Initialize the Azure Terraform Agent.
+        Pick the name suffix of each fan-out target, and find the resources that would still be
+        created under the same name more than once in a subscription.
         
         Args:
-            anthropic_api_key: Anthropic API key. If None, it will try to get from environment variable.
-            model: The Claude model to use. If None, it will use the default.
+            targets: The validated fan-out targets.
+            
+        Returns:
+            A tuple containing (name suffix by target id, descriptions of the collisions).
         """
-        self.conversational_agent = ConversationalAgent(
-            anthropic_api_key=anthropic_api_key,
-            model=model
-        )
-        self.terraform_generator = TerraformGenerator(
-            anthropic_api_key=anthropic_api_key,
-            model=model
-        )
-        self.terraform_executor = TerraformExecutor()
+        name_suffixes: Dict[int, Optional[str]] = {target_id: None for target_id in map(id, targets)}
+        collisions = []
+        names = self.resource_names(self.current_terraform_files)
         
-        # State to track the current infrastructure spec and Terraform code
-        self.current_infrastructure_spec = None
-        self.current_terraform_files = None
+        subscriptions: Dict[str, List[Dict[str, Any]]] = {}
+        for target in targets:
+            subscription_id = (target.get("subscription_id") or self.terraform_executor.subscription_id or "").lower()
+            subscriptions.setdefault(subscription_id, []).append(target)
+        
+        for subscription_id, group in subscriptions.items():
+            if len(group) < 2:
+                continue
+            
+            suffixes = [target.get("name_suffix") or target.get("location") for target in group]
+            if len(set(suffixes)) < len(suffixes):
+                collisions.append(f"targets {', '.join(str(suffix) for suffix in suffixes)} in subscription "
+                                  f"{subscription_id} need distinct locations or name suffixes")
+                continue
+            for target, suffix in zip(group, suffixes):
+                name_suffixes[id(target)] = suffix
+            
+            # Names computed from variables are only distinct if every target overrides them differently
+            for address, kind, value in names:
+                if kind == "expression":
+                    collisions.append(f"{address} is named by an expression, {value}, in subscription {subscription_id}")
+                elif kind == "variable":
+                    overrides = [json.dumps((target.get("variables") or {}).get(value)) for target in group
+                                 if value in (target.get("variables") or {})]
+                    if len(overrides) < len(group) or len(set(overrides)) < len(overrides):
+                        collisions.append(f"{address} is named by var.{value}, which needs a different override "
+                                          f"per target in subscription {subscription_id}")
+        
+        return name_suffixes, collisions
     
-    def process_user_request(self, user_message: str) -> Dict[str, Any]:
+    def _new_log_id(self, requested_log_id: Optional[str] = None) -> str:
         """
-        Process a user request for infrastructure changes.
+        Pick the identifier an operation spools its output under.
         
         Args:
-            user_message: The user's message.
+            requested_log_id: An identifier chosen by the client, used if it is well formed and unused.
             
         Returns:
-            A dictionary containing the response information.
+            The log identifier.
         """
-        logger.info(f"Processing user request: {user_message}")
-
-        # Use the conversational agent to interpret the user's request
-        response = self.conversational_agent.process_message(user_message)
+        if requested_log_id:
+            try:
+                if not os.path.exists(self.terraform_executor.get_log_path(requested_log_id)):
+                    return requested_log_id
+            except ValueError:
+                pass
+            logger.warning(f"Ignoring unusable log ID: {requested_log_id}")
+        return uuid.uuid4().hex
+    
+    def read_operation_log(self, log_id: str, offset: int = 0, limit: int = 65536) -> Dict[str, Any]:
+        """
+        Read a page of the full output of a previous Terraform operation.
         
-        # Check if we need more information from the user
-        if "needs_more_info" in response and response["needs_more_info"]:
-            missing_fields = response.get("missing_fields", [])
-            
-            # Format a message asking for the missing information
-            missing_info_message = response.get("message", "I need some additional information to create your Terraform code:")
+        Args:
+            log_id: The log identifier returned by validate/plan/apply/destroy.
+            offset: The byte offset to start reading from. Negative values count from the end.
+            limit: The maximum number of bytes to return.
             
+        Returns:
+            A dictionary containing the log content and paging offsets.
+        """
+        try:
+            page = self.terraform_executor.read_log(log_id, offset=offset, limit=limit)
+        except ValueError as e:
             return {
                 "success": False,
-                "message": missing_info_message,
-                "needs_more_info": True,
-                "missing_fields": missing_fields,
-                "infrastructure_spec": None,
-                "terraform_code": None
+                "message": str(e)
             }
-        
-        if "error" in response:
+        except FileNotFoundError:
             return {
                 "success": False,
-                "message": f"Failed to interpret infrastructure requirements: {response['error']}",
-                "infrastructure_spec": None,
-                "terraform_code": None
+                "message": f"Log {log_id} not found"
             }
         
-        # Store the current infrastructure spec
-        self.current_infrastructure_spec = response
-        
-        # Generate Terraform code based on the infrastructure spec
-        terraform_code = self.terraform_generator.generate_terraform_code(response)
-        
-        # Parse the Terraform code into separate files
-        terraform_files = self.terraform_generator.parse_terraform_files(terraform_code)
-        
-        # Store the current Terraform files
-        self.current_terraform_files = terraform_files
-        
-        # Format the Terraform code for display
-        formatted_terraform_code = "\n\n".join([f"# {file_name}\n{content}" for file_name, content in terraform_files.items()])
-        
         return {
             "success": True,
-            "message": "Successfully generated Terraform code",
-            "infrastructure_spec": response,
-            "terraform_code": formatted_terraform_code,
-            "terraform_files": terraform_files
+            "message": "Log retrieved",
+            "log_id": log_id,
+            **page
         }
     
-    def validate_terraform(self) -> Dict[str, Any]:
+    def get_terraform_code(self) -> Dict[str, Any]:
         """
-        Validate the current Terraform code.
+        Get the current Terraform code.
         
         Returns:
-            A dictionary containing the validation result.
+            A dictionary containing the Terraform code.
         """
         if not self.current_terraform_files:
             return {
@@ -577,50 +6365,124 @@ class AzureTerraformAgent:
                 "message": "No Terraform code has been generated yet"
             }
         
-        # Execute Terraform validate
-        success, output = self.terraform_executor.execute_terraform(
-            self.current_terraform_files,
-            operation="validate"
-        )
-        
         return {
-            "success": success,
-            "message": output
+            "success": True,
+            "message": "Terraform code retrieved",
+            "terraform_code": self.current_terraform_code,
+            "terraform_files": self.current_terraform_files,
+            "etag": self.current_terraform_files_hash
         }
     
-    def plan_terraform(self) -> Dict[str, Any]:
+    def record_generation(self) -> Optional[Dict[str, Any]]:
         """
-        Generate a Terraform plan for the current code.
+        Persist the current Terraform files as a generation in the artifact store.
         
         Returns:
-            A dictionary containing the plan result.
+            The manifest of the generation, or None if there are no files or the store failed.
         """
         if not self.current_terraform_files:
-            return {
-                "success": False,
-                "message": "No Terraform code has been generated yet"
+            return None
+        
+        spec = self.current_infrastructure_spec or {}
+        try:
+            # Include the called modules so a downloaded generation is complete
+            manifest = self.artifact_store.save_generation(
+                self.workspace_id,
+                {**self.current_terraform_files, **self.module_library.files_for(self.current_terraform_files)},
+                metadata={
+                    "resource_type": spec.get("resource_type"),
+                    "infrastructure_spec_hash": self.current_infrastructure_spec_hash
+                }
+            )
+        except Exception as e:
+            logger.error(f"Failed to record generation: {str(e)}")
+            return None
+        
+        self.current_generation_id = manifest["generation_id"]
+        return manifest
+    
+    def list_generations(self, limit: int = 20) -> Dict[str, Any]:
+        """
+        List the recorded generations of the Terraform code.
+        
+        Args:
+            limit: The maximum number of generations to return.
+            
+        Returns:
+            A dictionary containing the generations, newest first.
+        """
+        manifests = self.artifact_store.list_generations(self.workspace_id, limit=limit)
+        generations = [
+            {
+                "generation_id": manifest["generation_id"],
+                "created_at": manifest["created_at"],
+                "files": manifest.get("sizes", {}),
+                "resource_type": manifest.get("metadata", {}).get("resource_type"),
+                "current": manifest["generation_id"] == self.current_generation_id
             }
+            for manifest in manifests
+        ]
         
-        # Execute Terraform plan
-        success, output = self.terraform_executor.execute_terraform(
-            self.current_terraform_files,
-            operation="plan"
-        )
+        return {
+            "success": True,
+            "message": f"Found {len(generations)} generations",
+            "generations": generations
+        }
+    
+    def get_generation_archive(self, generation_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get a streaming zip archive of a generation of the Terraform code.
+        
+        Args:
+            generation_id: The generation to archive. If None, the current Terraform code is archived.
+            
+        Returns:
+            A dictionary containing the archive file name and an iterator over its bytes.
+        """
+        if generation_id:
+            try:
+                manifest = self.artifact_store.get_generation(self.workspace_id, generation_id)
+            except ValueError as e:
+                return {
+                    "success": False,
+                    "message": str(e)
+                }
+            if manifest is None:
+                return {
+                    "success": False,
+                    "message": f"Generation {generation_id} not found"
+                }
+        else:
+            if not self.current_terraform_files:
+                return {
+                    "success": False,
+                    "message": "No Terraform code has been generated yet"
+                }
+            # Recording is a no-op when the current files are already the latest generation
+            manifest = self.record_generation()
+            if manifest is None:
+                return {
+                    "success": False,
+                    "message": "Failed to store the current Terraform code"
+                }
         
         return {
-            "success": success,
-            "message": output
+            "success": True,
+            "message": "Archive ready",
+            "file_name": f"terraform-{manifest['generation_id']}.zip",
+            "etag": manifest["files_hash"],
+            "chunks": self.artifact_store.iter_zip(manifest)
         }
     
-    def apply_terraform(self, auto_approve: bool = False) -> Dict[str, Any]:
+    def get_terraform_file(self, file_name: str) -> Dict[str, Any]:
         """
-        Apply the current Terraform code.
+        Get a single file of the current Terraform code.
         
         Args:
-            auto_approve: Whether to automatically approve the apply operation.
+            file_name: The name of the file.
             
         Returns:
-            A dictionary containing the apply result.
+            A dictionary containing the file content.
         """
         if not self.current_terraform_files:
             return {
@@ -628,86 +6490,198 @@ class AzureTerraformAgent:
                 "message": "No Terraform code has been generated yet"
             }
         
-        # Execute Terraform apply
-        success, output = self.terraform_executor.execute_terraform(
-            self.current_terraform_files,
-            operation="apply",
-            auto_approve=auto_approve
-        )
+        if file_name not in self.current_terraform_files:
+            return {
+                "success": False,
+                "message": f"Terraform file {file_name} not found"
+            }
         
         return {
-            "success": success,
-            "message": output
+            "success": True,
+            "message": "Terraform file retrieved",
+            "file_name": file_name,
+            "content": self.current_terraform_files[file_name],
+            "etag": self.current_terraform_file_hashes[file_name]
         }
     
-    def destroy_terraform(self, auto_approve: bool = False) -> Dict[str, Any]:
+    def get_infrastructure_spec(self) -> Dict[str, Any]:
         """
-        Destroy the infrastructure created by the current Terraform code.
+        Get the current infrastructure specification.
         
-        Args:
-            auto_approve: Whether to automatically approve the destroy operation.
-            
         Returns:
-            A dictionary containing the destroy result.
+            A dictionary containing the infrastructure specification.
         """
-        if not self.current_terraform_files:
+        if not self.current_infrastructure_spec:
             return {
                 "success": False,
-                "message": "No Terraform code has been generated yet"
+                "message": "No infrastructure specification has been generated yet"
             }
         
-        # Execute Terraform destroy
-        success, output = self.terraform_executor.execute_terraform(
-            self.current_terraform_files,
-            operation="destroy",
-            auto_approve=auto_approve
-        )
+        return {
+            "success": True,
+            "message": "Infrastructure specification retrieved",
+            "infrastructure_spec": self.current_infrastructure_spec,
+            "etag": self.current_infrastructure_spec_hash
+        }
+    
+    def get_scheduler_metrics(self) -> Dict[str, Any]:
+        """
+        Get the Claude call scheduler metrics.
         
+        Returns:
+            A dictionary containing the queue depth and wait times.
+        """
         return {
-            "success": success,
-            "message": output
+            "success": True,
+            "message": "Scheduler metrics retrieved",
+            "metrics": self.scheduler.get_metrics()
         }
     
-    def get_terraform_code(self) -> Dict[str, Any]:
+    def get_budget_status(self) -> Dict[str, Any]:
         """
-        Get the current Terraform code.
+        Get the Claude usage of this session and its tenant against their budgets.
         
         Returns:
-            A dictionary containing the Terraform code.
+            A dictionary containing the degradation level and the usage and budgets.
         """
-        if not self.current_terraform_files:
+        return {
+            "success": True,
+            "message": "Budget status retrieved",
+            "budget": self.usage_budget.get_status(self.session_usage, self.tenant_id)
+        }
+    
+    def search_catalog(self, kind: str, prefix: str, limit: int = 10) -> Dict[str, Any]:
+        """
+        Find catalog values starting with a prefix, for autocomplete.
+        
+        Args:
+            kind: The catalog kind, e.g. locations, vm_sizes or resource_types.
+            prefix: The text typed so far.
+            limit: Maximum number of results.
+            
+        Returns:
+            A dictionary containing the matching values.
+        """
+        try:
+            results = self.azure_catalog.search(kind, prefix, limit)
+        except ValueError as e:
             return {
                 "success": False,
-                "message": "No Terraform code has been generated yet"
+                "message": str(e)
             }
         
-        # Format the Terraform code for display
-        formatted_terraform_code = "\n\n".join([f"# {file_name}\n{content}" for file_name, content in self.current_terraform_files.items()])
+        return {
+            "success": True,
+            "message": f"Found {len(results)} {kind}",
+            "kind": kind,
+            "catalog_version": self.azure_catalog.version,
+            "results": results
+        }
+    
+    def get_workspace_lock_metrics(self) -> Dict[str, Any]:
+        """
+        Get the contention of the workspace locks.
         
+        Returns:
+            A dictionary containing the workspace lock metrics.
+        """
         return {
             "success": True,
-            "message": "Terraform code retrieved",
-            "terraform_code": formatted_terraform_code,
-            "terraform_files": self.current_terraform_files
+            "message": "Workspace lock metrics retrieved",
+            "metrics": self.terraform_executor.workspace_locks.get_metrics()
         }
     
-    def get_infrastructure_spec(self) -> Dict[str, Any]:
+    def get_result_cache_metrics(self) -> Dict[str, Any]:
         """
-        Get the current infrastructure specification.
+        Get the size and hit rates of the validate and plan result cache.
         
         Returns:
-            A dictionary containing the infrastructure specification.
+            A dictionary containing the result cache metrics.
         """
-        if not self.current_infrastructure_spec:
+        return {
+            "success": True,
+            "message": "Result cache metrics retrieved",
+            "metrics": self.result_cache.get_metrics()
+        }
+    
+    def get_spec_cache_metrics(self) -> Dict[str, Any]:
+        """
+        Get the size and hit rate of the spec cache.
+        
+        Returns:
+            A dictionary containing the spec cache metrics.
+        """
+        return {
+            "success": True,
+            "message": "Spec cache metrics retrieved",
+            "metrics": self.spec_cache.get_metrics()
+        }
+    
+    def get_routing_metrics(self) -> Dict[str, Any]:
+        """
+        Get the model routing decisions of each stage.
+        
+        Returns:
+            A dictionary containing the routing metrics per stage.
+        """
+        return {
+            "success": True,
+            "message": "Routing metrics retrieved",
+            "metrics": {
+                "extraction": self.conversational_agent.router.get_metrics(),
+                "generation": self.terraform_generator.router.get_metrics()
+            }
+        }
+    
+    def cancel_operations(self) -> Dict[str, Any]:
+        """
+        Cancel the Claude calls and Terraform operations running for this agent's workspace, in any worker.
+        Claude calls are streamed and closed at their next event, Terraform commands are interrupted.
+        
+        Returns:
+            A dictionary containing the result.
+        """
+        self.terraform_executor.request_cancel(self.workspace_id)
+        running = self.terraform_executor.active_operation_count(self.workspace_id)
+        return {
+            "success": True,
+            "message": f"Cancellation requested for {running} running Terraform operation(s)" if running
+            else "Cancellation requested",
+            "active_operations": running
+        }
+    
+    def get_drift_status(self) -> Dict[str, Any]:
+        """
+        Get the last drift check of this agent's workspace and the state of the drift schedule.
+        
+        Returns:
+            A dictionary containing the drift summary, or None if the workspace was never checked.
+        """
+        return {
+            "success": True,
+            "message": "Drift status retrieved",
+            "drift": self.terraform_executor.read_drift_result(self.workspace_id),
+            "scheduler": self.drift_detector.get_metrics()
+        }
+    
+    def check_drift(self) -> Dict[str, Any]:
+        """
+        Check this agent's workspace for drift now.
+        
+        Returns:
+            A dictionary containing the drift summary.
+        """
+        if self.workspace_id not in self.terraform_executor.list_deployed_workspaces():
             return {
                 "success": False,
-                "message": "No infrastructure specification has been generated yet"
+                "message": "No infrastructure has been deployed from this session yet"
             }
         
+        drift = self.drift_detector.check_async(self.workspace_id).result()
         return {
-            "success": True,
-            "message": "Infrastructure specification retrieved",
-            "infrastructure_spec": self.current_infrastructure_spec
+            "success": drift["status"] != "error",
+            "message": drift.get("message") or f"Drift check finished: {drift['status']}",
+            "drift": drift
         }
     
     def clear_conversation_history(self) -> Dict[str, Any]:
@@ -718,6 +6692,7 @@ class AzureTerraformAgent:
             A dictionary containing the result.
         """
         self.conversational_agent.clear_conversation_history()
+        self.save_session()
         
         return {
             "success": True,
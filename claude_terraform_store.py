@@ -0,0 +1,768 @@
+import os
+import re
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import hashlib
+import logging
+import zipfile
+import tempfile
+import threading
+from typing import Dict, List, Optional, Any, Iterator, Tuple
+from urllib.parse import urlparse
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class SessionStore:
+    """
+    Base class for stores holding per-session agent state (conversation history, spec and files).
+    Records are written as compact compressed JSON so every worker and container can share them.
+    Every record carries a version that is bumped on each save, so concurrent requests of a session
+    can detect that the record changed under them instead of overwriting each other.
+    """
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        """
+        Initialize the session store.
+
+        Args:
+            ttl_seconds: How long an idle session is kept. If None, it will try to get from environment variable.
+        """
+        self.ttl_seconds = ttl_seconds or int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+
+    @staticmethod
+    def serialize(record: Dict[str, Any]) -> bytes:
+        """
+        Serialize a session record.
+
+        Args:
+            record: The session record.
+
+        Returns:
+            The compressed JSON bytes.
+        """
+        return zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def deserialize(data: bytes) -> Dict[str, Any]:
+        """
+        Deserialize a session record.
+
+        Args:
+            data: The compressed JSON bytes.
+
+        Returns:
+            The session record.
+        """
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Load a session record.
+
+        Args:
+            session_id: The session identifier.
+
+        Returns:
+            The session record, or None if it doesn't exist or has expired.
+        """
+        record, _ = self.load_versioned(session_id)
+        return record
+
+    def load_versioned(self, session_id: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        """
+        Load a session record together with its version.
+
+        Args:
+            session_id: The session identifier.
+
+        Returns:
+            A tuple of (record, version). The record is None and the version 0 if it doesn't exist or has expired.
+        """
+        data, version = self._get(session_id)
+        if data is None:
+            return None, 0
+        return self.deserialize(data), version
+
+    def save(self, session_id: str, record: Dict[str, Any],
+             expected_version: Optional[int] = None, ttl_seconds: Optional[int] = None) -> Optional[int]:
+        """
+        Save a session record.
+
+        Args:
+            session_id: The session identifier.
+            record: The session record.
+            expected_version: Only save if the stored version still matches (0 for a new session).
+                If None, any previous record is replaced.
+            ttl_seconds: How long the record is kept. If None, the store's TTL is used.
+
+        Returns:
+            The new version, or None if the stored version didn't match.
+        """
+        return self._set(session_id, self.serialize(record), expected_version, ttl_seconds or self.ttl_seconds)
+
+    def delete(self, session_id: str) -> None:
+        """
+        Delete a session record.
+
+        Args:
+            session_id: The session identifier.
+        """
+        raise NotImplementedError
+
+    def _get(self, session_id: str) -> Tuple[Optional[bytes], int]:
+        """
+        Read the serialized record of a session and its version, or (None, 0) if it doesn't exist or has expired.
+        """
+        raise NotImplementedError
+
+    def _set(self, session_id: str, data: bytes, expected_version: Optional[int], ttl_seconds: int) -> Optional[int]:
+        """
+        Write the serialized record of a session if its version matches, refresh its expiry and
+        return the new version, or None on a version mismatch.
+        """
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps sessions in process memory. Only suitable for a single worker.
+    """
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        super().__init__(ttl_seconds)
+        self.records: Dict[str, tuple] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, session_id: str) -> Tuple[Optional[bytes], int]:
+        with self.lock:
+            entry = self.records.get(session_id)
+            if entry is None:
+                return None, 0
+            data, expires_at, version = entry
+            if expires_at < time.time():
+                del self.records[session_id]
+                return None, 0
+            return data, version
+
+    def _set(self, session_id: str, data: bytes, expected_version: Optional[int], ttl_seconds: int) -> Optional[int]:
+        with self.lock:
+            now = time.time()
+            self.records = {key: entry for key, entry in self.records.items() if entry[1] >= now}
+            current = self.records[session_id][2] if session_id in self.records else 0
+            if expected_version is not None and current != expected_version:
+                return None
+            self.records[session_id] = (data, now + ttl_seconds, current + 1)
+            return current + 1
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            self.records.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps sessions in a SQLite database in WAL mode, shared by all workers on a single host.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[int] = None):
+        """
+        Initialize the SQLite session store.
+
+        Args:
+            path: The path of the database file.
+            ttl_seconds: How long an idle session is kept.
+        """
+        super().__init__(ttl_seconds)
+        self.path = path
+        self.local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, record BLOB NOT NULL, expires_at REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 1)"
+        )
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(sessions)")]
+        if "version" not in columns:
+            # Databases created before records were versioned
+            connection.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Get the connection for the current thread.
+
+        Returns:
+            A SQLite connection in WAL mode.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _get(self, session_id: str) -> Tuple[Optional[bytes], int]:
+        row = self._connection().execute(
+            "SELECT record, version FROM sessions WHERE session_id = ? AND expires_at >= ?",
+            (session_id, time.time())
+        ).fetchone()
+        return (bytes(row[0]), row[1]) if row else (None, 0)
+
+    def _set(self, session_id: str, data: bytes, expected_version: Optional[int], ttl_seconds: int) -> Optional[int]:
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # Expired records count as missing, so they are removed before comparing versions
+            connection.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+            if expected_version is None:
+                connection.execute(
+                    "INSERT INTO sessions (session_id, record, expires_at, version) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (session_id) DO UPDATE SET record = excluded.record, "
+                    "expires_at = excluded.expires_at, version = sessions.version + 1",
+                    (session_id, sqlite3.Binary(data), now + ttl_seconds)
+                )
+            elif expected_version == 0:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, record, expires_at, version) VALUES (?, ?, ?, 1)",
+                    (session_id, sqlite3.Binary(data), now + ttl_seconds)
+                )
+                if cursor.rowcount == 0:
+                    return None
+            else:
+                cursor = connection.execute(
+                    "UPDATE sessions SET record = ?, expires_at = ?, version = version + 1 "
+                    "WHERE session_id = ? AND version = ?",
+                    (sqlite3.Binary(data), now + ttl_seconds, session_id, expected_version)
+                )
+                if cursor.rowcount == 0:
+                    return None
+            row = connection.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            return row[0]
+
+    def delete(self, session_id: str) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Keeps sessions in Redis, or any server speaking the Redis protocol, so several hosts can share them.
+    Uses a minimal RESP client to avoid an extra dependency. The version of a record is kept
+    in a companion key and compared with WATCH/MULTI/EXEC.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, ttl_seconds: Optional[int] = None,
+                 key_prefix: str = "terraform-agent:session:"):
+        """
+        Initialize the Redis session store.
+
+        Args:
+            host: The server host.
+            port: The server port.
+            db: The database number to select.
+            password: The password to authenticate with, if any.
+            ttl_seconds: How long an idle session is kept.
+            key_prefix: The prefix of the session keys.
+        """
+        super().__init__(ttl_seconds)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.key_prefix = key_prefix
+        self.local = threading.local()
+
+    def _connect(self):
+        """
+        Open a connection for the current thread and authenticate it. The connection is only
+        kept once AUTH and SELECT succeeded, so a failure is retried on the next command.
+        """
+        connection = socket.create_connection((self.host, self.port), timeout=10)
+        reader = connection.makefile("rb")
+        try:
+            if self.password:
+                self._exchange(connection, reader, "AUTH", self.password)
+            if self.db:
+                self._exchange(connection, reader, "SELECT", str(self.db))
+        except BaseException:
+            try:
+                reader.close()
+                connection.close()
+            except OSError:
+                pass
+            raise
+        self.local.connection = connection
+        self.local.reader = reader
+
+    def _close(self) -> None:
+        """
+        Close the connection of the current thread.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            try:
+                self.local.reader.close()
+                connection.close()
+            except OSError:
+                pass
+        self.local.connection = None
+
+    def _read_reply(self, reader) -> Any:
+        """
+        Read a single RESP reply.
+
+        Args:
+            reader: The buffered reader of the connection.
+
+        Returns:
+            The decoded reply.
+        """
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+
+        prefix, payload = line[:1], line[1:].rstrip(b"\r\n")
+        if prefix == b"+":
+            return payload.decode("utf-8")
+        if prefix == b"-":
+            raise RuntimeError(f"Redis error: {payload.decode('utf-8')}")
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:length]
+        if prefix == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _exchange(self, connection: socket.socket, reader, *args) -> Any:
+        """
+        Send a command on a connection and read its reply.
+
+        Args:
+            connection: The connection.
+            reader: The buffered reader of the connection.
+            args: The command and its arguments as strings or bytes.
+
+        Returns:
+            The decoded reply.
+        """
+        parts: List[bytes] = [f"*{len(args)}\r\n".encode("utf-8")]
+        for arg in args:
+            value = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(value)}\r\n".encode("utf-8"))
+            parts.append(value)
+            parts.append(b"\r\n")
+        connection.sendall(b"".join(parts))
+        return self._read_reply(reader)
+
+    def _send_command(self, *args) -> Any:
+        """
+        Send a command on the current thread's connection and read its reply.
+
+        Args:
+            args: The command and its arguments as strings or bytes.
+
+        Returns:
+            The decoded reply.
+        """
+        return self._exchange(self.local.connection, self.local.reader, *args)
+
+    def _command(self, *args) -> Any:
+        """
+        Send a command, reconnecting once if the connection was dropped.
+
+        Args:
+            args: The command and its arguments as strings or bytes.
+
+        Returns:
+            The decoded reply.
+        """
+        for attempt in range(2):
+            try:
+                if getattr(self.local, "connection", None) is None:
+                    self._connect()
+                return self._send_command(*args)
+            except (ConnectionError, OSError) as e:
+                self._close()
+                if attempt == 1:
+                    raise
+                logger.warning(f"Redis connection lost, reconnecting: {str(e)}")
+
+    def _get(self, session_id: str) -> Tuple[Optional[bytes], int]:
+        key = self.key_prefix + session_id
+        data, version = self._command("MGET", key, key + ":version")
+        if data is None:
+            return None, 0
+        return data, int(version) if version is not None else 0
+
+    def _set(self, session_id: str, data: bytes, expected_version: Optional[int], ttl_seconds: int) -> Optional[int]:
+        key = self.key_prefix + session_id
+        version_key = key + ":version"
+        # WATCH may reconnect; the rest of the transaction must run on the watching connection
+        self._command("WATCH", version_key)
+        try:
+            stored, current = self._send_command("MGET", key, version_key)
+            current = int(current) if stored is not None and current is not None else 0
+            if expected_version is not None and current != expected_version:
+                self._send_command("UNWATCH")
+                return None
+            self._send_command("MULTI")
+            self._send_command("SET", key, data, "EX", str(ttl_seconds))
+            self._send_command("SET", version_key, str(current + 1), "EX", str(ttl_seconds))
+            if self._send_command("EXEC") is None:
+                return None
+            return current + 1
+        except (ConnectionError, OSError):
+            self._close()
+            raise
+
+    def delete(self, session_id: str) -> None:
+        key = self.key_prefix + session_id
+        self._command("DEL", key, key + ":version")
+
+
+def create_session_store(url: Optional[str] = None) -> SessionStore:
+    """
+    Create a session store from a URL.
+
+    Args:
+        url: memory://, sqlite:///path/to/sessions.db or redis://[:password@]host:port/db.
+            If None, it will try to get from the SESSION_STORE_URL environment variable.
+
+    Returns:
+        The session store.
+    """
+    url = url or os.getenv("SESSION_STORE_URL", "memory://")
+    parsed = urlparse(url)
+
+    if parsed.scheme == "memory":
+        return MemorySessionStore()
+    if parsed.scheme == "sqlite":
+        # sqlite:///relative.db and sqlite:////absolute.db, as in SQLAlchemy
+        path = parsed.netloc + parsed.path if parsed.netloc else parsed.path[1:]
+        return SQLiteSessionStore(path or "sessions.db")
+    if parsed.scheme == "redis":
+        db = parsed.path.lstrip("/")
+        return RedisSessionStore(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=parsed.password
+        )
+
+    raise ValueError(f"Unsupported session store URL: {url}")
+
+
+class _ZipStreamBuffer:
+    """
+    A write-only, unseekable file object collecting what zipfile writes so it can be yielded in pieces.
+    """
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        """
+        Take everything written since the last drain.
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ArtifactStore:
+    """
+    Content-addressed store for generated Terraform files. File contents are kept once as blobs named by
+    their SHA-256, shared by every session, and each generation is a small manifest mapping file names to blobs.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_generations: Optional[int] = None):
+        """
+        Initialize the artifact store.
+
+        Args:
+            root: The directory holding blobs and manifests. If None, it will try to get from environment variable.
+            max_generations: How many generations are kept per namespace. If None, it will try to get from environment variable.
+        """
+        self.root = root or os.getenv("TERRAFORM_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "terraform-agent-artifacts"))
+        self.max_generations = max_generations or int(os.getenv("TERRAFORM_MAX_GENERATIONS", "50"))
+        self.gc_interval = int(os.getenv("TERRAFORM_ARTIFACT_GC_INTERVAL", "3600"))
+        self.blob_directory = os.path.join(self.root, "blobs")
+        self.manifest_directory = os.path.join(self.root, "manifests")
+        self.last_gc = 0.0
+        self.gc_lock = threading.Lock()
+        os.makedirs(self.blob_directory, exist_ok=True)
+        os.makedirs(self.manifest_directory, exist_ok=True)
+
+    @staticmethod
+    def _check_id(value: str, kind: str) -> str:
+        """
+        Make sure an identifier is safe to use as a path component.
+        """
+        if not re.fullmatch(r'[0-9A-Za-z_-]{1,64}', value or ""):
+            raise ValueError(f"Invalid {kind}: {value}")
+        return value
+
+    def get_blob_path(self, digest: str) -> str:
+        """
+        Get the path of a blob.
+
+        Args:
+            digest: The SHA-256 hex digest of the content.
+
+        Returns:
+            The path of the blob file.
+        """
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ""):
+            raise ValueError(f"Invalid blob digest: {digest}")
+        return os.path.join(self.blob_directory, digest[:2], digest)
+
+    def put_blob(self, content: str) -> str:
+        """
+        Store file content, unless a blob with the same content already exists.
+
+        Args:
+            content: The file content.
+
+        Returns:
+            The SHA-256 hex digest addressing the content.
+        """
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_blob_path(digest)
+        if os.path.exists(blob_path):
+            try:
+                # Refresh the blob so garbage collection treats it as recently used
+                os.utime(blob_path)
+                return digest
+            except FileNotFoundError:
+                pass
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest
+
+    def read_blob(self, digest: str) -> str:
+        """
+        Read the content of a blob.
+
+        Args:
+            digest: The SHA-256 hex digest of the content.
+
+        Returns:
+            The file content.
+        """
+        with open(self.get_blob_path(digest), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def _namespace_directory(self, namespace: str) -> str:
+        return os.path.join(self.manifest_directory, self._check_id(namespace, "namespace"))
+
+    def _manifest_names(self, namespace: str) -> List[str]:
+        """
+        List the manifest file names of a namespace, newest first.
+        """
+        try:
+            names = os.listdir(self._namespace_directory(namespace))
+        except FileNotFoundError:
+            return []
+        return sorted((name for name in names if name.endswith(".json")), reverse=True)
+
+    def save_generation(self, namespace: str, terraform_files: Dict[str, str],
+                        metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Record a generation of Terraform files. Saving the same files as the latest generation is a no-op.
+
+        Args:
+            namespace: The owner of the generation, usually a session.
+            terraform_files: A dictionary mapping file names to their content.
+            metadata: Extra serializable information to keep in the manifest.
+
+        Returns:
+            The manifest of the generation.
+        """
+        files = {file_name: self.put_blob(content) for file_name, content in sorted(terraform_files.items())}
+        files_hash = hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()
+
+        latest = self.list_generations(namespace, limit=1)
+        if latest and latest[0]["files_hash"] == files_hash:
+            return latest[0]
+
+        # Millisecond timestamps first so manifest names sort chronologically
+        generation_id = f"{int(time.time() * 1000):013d}-{files_hash[:12]}"
+        manifest = {
+            "generation_id": generation_id,
+            "created_at": time.time(),
+            "files_hash": files_hash,
+            "files": files,
+            "sizes": {file_name: len(content.encode("utf-8")) for file_name, content in terraform_files.items()},
+            "metadata": metadata or {}
+        }
+
+        directory = self._namespace_directory(namespace)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(temp_path, os.path.join(directory, f"{generation_id}.json"))
+
+        self._prune_generations(namespace)
+        return manifest
+
+    def _prune_generations(self, namespace: str) -> None:
+        """
+        Remove the oldest manifests of a namespace beyond the retention limit.
+        """
+        old_names = self._manifest_names(namespace)[self.max_generations:]
+        for name in old_names:
+            try:
+                os.remove(os.path.join(self._namespace_directory(namespace), name))
+            except OSError as e:
+                logger.warning(f"Failed to remove old manifest {name}: {str(e)}")
+        if old_names:
+            self.collect_garbage()
+
+    def list_generations(self, namespace: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        List the generations of a namespace.
+
+        Args:
+            namespace: The owner of the generations.
+            limit: The maximum number of generations to return.
+
+        Returns:
+            The manifests, newest first.
+        """
+        manifests = []
+        for name in self._manifest_names(namespace)[:max(0, limit)]:
+            try:
+                with open(os.path.join(self._namespace_directory(namespace), name), 'r', encoding='utf-8') as f:
+                    manifests.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable manifest {name}: {str(e)}")
+        return manifests
+
+    def get_generation(self, namespace: str, generation_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the manifest of a generation.
+
+        Args:
+            namespace: The owner of the generation.
+            generation_id: The generation identifier.
+
+        Returns:
+            The manifest, or None if it doesn't exist.
+        """
+        path = os.path.join(self._namespace_directory(namespace), f"{self._check_id(generation_id, 'generation ID')}.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def iter_zip(self, manifest: Dict[str, Any], chunk_size: int = 65536) -> Iterator[bytes]:
+        """
+        Stream the files of a generation as a zip archive, one piece at a time.
+
+        Args:
+            manifest: The manifest of the generation.
+            chunk_size: The number of bytes read from a blob at a time.
+
+        Yields:
+            Successive pieces of the archive.
+        """
+        buffer = _ZipStreamBuffer()
+        # zipfile writes data descriptors instead of seeking back when the output isn't seekable
+        with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for file_name, digest in sorted(manifest["files"].items()):
+                info = zipfile.ZipInfo(file_name, date_time=time.localtime(manifest["created_at"])[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(self.get_blob_path(digest), 'rb') as source, archive.open(info, mode='w') as target:
+                    for data in iter(lambda: source.read(chunk_size), b""):
+                        target.write(data)
+                        if buffer.chunks:
+                            yield buffer.drain()
+                yield buffer.drain()
+        yield buffer.drain()
+
+    def collect_garbage(self, force: bool = False) -> int:
+        """
+        Remove blobs no manifest refers to anymore. Runs at most once per GC interval unless forced.
+
+        Args:
+            force: Whether to ignore the GC interval.
+
+        Returns:
+            The number of blobs removed.
+        """
+        with self.gc_lock:
+            now = time.time()
+            if not force and now - self.last_gc < self.gc_interval:
+                return 0
+            self.last_gc = now
+
+            referenced = set()
+            for namespace in os.listdir(self.manifest_directory):
+                if not os.path.isdir(os.path.join(self.manifest_directory, namespace)):
+                    continue
+                for manifest in self.list_generations(namespace, limit=self.max_generations):
+                    referenced.update(manifest.get("files", {}).values())
+
+            removed = 0
+            for prefix in os.listdir(self.blob_directory):
+                prefix_directory = os.path.join(self.blob_directory, prefix)
+                if not os.path.isdir(prefix_directory):
+                    continue
+                for name in os.listdir(prefix_directory):
+                    path = os.path.join(prefix_directory, name)
+                    try:
+                        # Leave recent blobs alone, a generation referring to them may still be in the making
+                        if name not in referenced and now - os.path.getmtime(path) > self.gc_interval:
+                            os.remove(path)
+                            removed += 1
+                    except OSError as e:
+                        logger.warning(f"Failed to remove blob {name}: {str(e)}")
+
+            logger.info(f"Removed {removed} unreferenced blobs")
+            return removed
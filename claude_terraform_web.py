@@ -1,9 +1,19 @@
 import os
+import re
 import json
+import gzip
+import time
+import random
+import pstats
+import cProfile
 import logging
-from flask import Flask, render_template, request, jsonify, session
+import tempfile
+import threading
+from collections import deque
+from flask import Flask, Response, g, render_template, request, jsonify, session, send_file, stream_with_context
 from dotenv import load_dotenv
-from claude_terraform_agent import AzureTerraformAgent
+import uuid
+from claude_terraform_agent import AzureTerraformAgent, ClaudeTransport, ModelRouter, StageTimings, TerraformExecutor
 
 # Load environment variables
 load_dotenv()
@@ -15,9 +25,46 @@ logger = logging.getLogger(__name__)
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24))
+if not os.getenv("FLASK_SECRET_KEY"):
+    logger.warning("FLASK_SECRET_KEY is not set, sessions won't be shared between workers")
+
+# Terraform commands run in their own session and would outlive the worker. The agent is created in a request
+# thread, where no signal handler can be installed, so install it while gunicorn imports the app in the worker
+TerraformExecutor.install_shutdown_handler()
+
+# Brotli is optional, gzip is used when it isn't installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON responses smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_ETAG_SUFFIXES = ["", "-gzip", "-br"]
+
+# Opt-in request profiling, triggered by the X-Profile-Token header or sampled while the admin toggle is on
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "terraform-agent-profiles"))
+PROFILE_MAX_PER_MINUTE = int(os.getenv("PROFILE_MAX_PER_MINUTE", "6"))
+PROFILE_MAX_SAVED = int(os.getenv("PROFILE_MAX_SAVED", "100"))
+PROFILE_CLOCK = os.getenv("PROFILE_CLOCK", "wall")
+PROFILE_SETTINGS_PATH = os.path.join(PROFILE_DIR, "settings.json")
+os.makedirs(PROFILE_DIR, exist_ok=True)
+
+# Only one profiler can be active per process, and the rate limit keeps the overhead bounded
+profiling_lock = threading.Lock()
+profiling_times = deque()
+profiling_times_lock = threading.Lock()
+profiling_settings_cache = {'mtime': None, 'settings': {'enabled': False, 'sample_rate': 0.0}}
+
+# Header naming the tenant whose usage budget a request is charged to. Clients could set it themselves,
+# so it is only read when a fronting proxy that sets or strips it is configured
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-Id")
+TRUST_TENANT_HEADER = os.getenv("TRUST_TENANT_HEADER", "false").lower() in ("1", "true", "yes")
 
 # Initialize global variables
 agent = None
+agent_lock = threading.Lock()
 
 def setup_agent():
     """
@@ -30,43 +77,260 @@ def setup_agent():
         "AZURE_SUBSCRIPTION_ID",
         "ANTHROPIC_API_KEY"
     ]
+    # Replaying recorded Claude responses doesn't need the API
+    replaying = ClaudeTransport.default_mode() == "replay"
+    if replaying:
+        required_vars.remove("ANTHROPIC_API_KEY")
     
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
         logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
         return False, f"Missing required environment variables: {', '.join(missing_vars)}"
     
-    # Initialize the agent
-    try:
-        anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-        model = os.getenv("ANTHROPIC_MODEL", "claude-3-sonnet-20240229")
+    # One agent per process. Its drift scheduler, pools and exit hooks run until the process ends,
+    # so initializing again keeps the agent instead of starting a second set of them
+    with agent_lock:
+        if agent is not None:
+            return True, "Agent already initialized"
         
-        # Validate Anthropic API key with a simple request
+        # Initialize the agent
         try:
-            import anthropic
-            client = anthropic.Anthropic(api_key=anthropic_api_key)
-            
-            # Make a simple request to check if the API key is valid
-            response = client.messages.create(
-                model=model,
-                max_tokens=10,
-                messages=[{"role": "user", "content": "Hello"}],
-                system="You are a helpful assistant."
-            )
-            
-            # If we get here, the API key is valid
-            agent = AzureTerraformAgent(
-                anthropic_api_key=anthropic_api_key,
-                model=model
-            )
-            return True, f"Agent initialized successfully with Claude model: {model}"
+            anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
+            # Each stage has its own model: a fast one for extraction, a strong one for generation
+            extraction_model = ModelRouter.default_model("extraction")
+            generation_model = ModelRouter.default_model("generation")
             
+            # Validate Anthropic API key with a simple request
+            try:
+                import anthropic
+                
+                # Make a simple request to check if the API key is valid
+                if not replaying:
+                    client = anthropic.Anthropic(api_key=anthropic_api_key)
+                    response = client.messages.create(
+                        model=extraction_model,
+                        max_tokens=10,
+                        messages=[{"role": "user", "content": "Hello"}],
+                        system="You are a helpful assistant."
+                    )
+                
+                # If we get here, the API key is valid
+                agent = AzureTerraformAgent(
+                    anthropic_api_key=anthropic_api_key,
+                    extraction_model=extraction_model,
+                    generation_model=generation_model
+                )
+                agent.drift_detector.start()
+                return True, f"Agent initialized successfully with Claude models: {extraction_model} (extraction), {generation_model} (generation)"
+                
+            except Exception as e:
+                return False, f"Failed to connect to Claude API: {str(e)}"
+                
         except Exception as e:
-            return False, f"Failed to connect to Claude API: {str(e)}"
-            
+            logger.error(f"Failed to initialize agent: {str(e)}")
+            return False, f"Failed to initialize agent: {str(e)}"
+
+def conditional_json_response(etag, build_result):
+    """
+    Return 304 Not Modified if the client already has the current representation,
+    otherwise build the result and return it with a strong ETag.
+    """
+    if etag and any(request.if_none_match.contains(etag + suffix) for suffix in COMPRESSION_ETAG_SUFFIXES):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_result())
+    
+    if etag:
+        response.set_etag(etag)
+    # Make the browser revalidate on every fetch so it sends If-None-Match
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def get_profiling_settings():
+    """
+    Get the admin profiling toggle. It lives in a file so every worker process sees the same setting.
+    """
+    try:
+        mtime = os.path.getmtime(PROFILE_SETTINGS_PATH)
+    except OSError:
+        return {'enabled': False, 'sample_rate': 0.0}
+    
+    if mtime != profiling_settings_cache['mtime']:
+        try:
+            with open(PROFILE_SETTINGS_PATH, 'r') as f:
+                profiling_settings_cache['settings'] = json.load(f)
+            profiling_settings_cache['mtime'] = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read profiling settings: {str(e)}")
+    return profiling_settings_cache['settings']
+
+def has_profiling_token():
+    """Check whether the request carries the profiling token."""
+    return bool(PROFILING_TOKEN) and request.headers.get('X-Profile-Token') == PROFILING_TOKEN
+
+def reserve_profile_slot():
+    """Take a slot of the per-minute profiling budget, returning False if it is used up."""
+    with profiling_times_lock:
+        now = time.time()
+        while profiling_times and profiling_times[0] <= now - 60:
+            profiling_times.popleft()
+        if len(profiling_times) >= PROFILE_MAX_PER_MINUTE:
+            return False
+        profiling_times.append(now)
+        return True
+
+@app.before_request
+def start_profiling():
+    """Start profiling the request if it asked for it or was sampled."""
+    if request.path.startswith('/api/admin/profiling') or request.path.startswith('/static/'):
+        return
+    
+    if not has_profiling_token():
+        settings = get_profiling_settings()
+        if not settings.get('enabled') or random.random() >= float(settings.get('sample_rate', 0.0)):
+            return
+    
+    if not profiling_lock.acquire(blocking=False):
+        return
+    if not reserve_profile_slot():
+        profiling_lock.release()
+        return
+    
+    g.profile_id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+    g.profile_cpu_start = time.thread_time()
+    g.profile_wall_start = time.perf_counter()
+    g.stage_timings = StageTimings.activate()
+    g.profiler = cProfile.Profile(time.thread_time if PROFILE_CLOCK == 'cpu' else time.perf_counter)
+    try:
+        g.profiler.enable()
+    except ValueError as e:
+        # Another profiling tool is already active in this interpreter
+        logger.warning(f"Could not start profiler: {str(e)}")
+        g.profiler = None
+
+@app.after_request
+def tag_profiled_response(response):
+    """Tell the client where the profile of its request is."""
+    if 'profile_id' in g:
+        g.profile_status = response.status_code
+        response.headers['X-Profile-Id'] = g.profile_id
+    return response
+
+@app.teardown_request
+def finish_profiling(exception=None):
+    """Stop profiling the request and write its profiles to disk."""
+    if 'profile_id' not in g:
+        return
+    
+    try:
+        if g.profiler is not None:
+            g.profiler.disable()
+        StageTimings.deactivate()
+        write_profile(exception)
     except Exception as e:
-        logger.error(f"Failed to initialize agent: {str(e)}")
-        return False, f"Failed to initialize agent: {str(e)}"
+        logger.error(f"Failed to write profile {g.profile_id}: {str(e)}")
+    finally:
+        g.pop('profile_id')
+        profiling_lock.release()
+
+def write_profile(exception=None):
+    """Write the cProfile stats and the timing breakdown of the profiled request."""
+    profile_id = g.profile_id
+    summary = {
+        'profile_id': profile_id,
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': g.get('profile_status'),
+        'error': str(exception) if exception else None,
+        'created_at': time.time(),
+        'clock': PROFILE_CLOCK,
+        'wall_seconds': round(time.perf_counter() - g.profile_wall_start, 4),
+        'cpu_seconds': round(time.thread_time() - g.profile_cpu_start, 4),
+        **g.stage_timings.summary()
+    }
+    
+    if g.profiler is not None:
+        g.profiler.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+        
+        # The most expensive functions, so the summary is useful without loading the profile
+        stats = pstats.Stats(g.profiler).stats
+        top = sorted(stats.items(), key=lambda item: -item[1][3])[:25]
+        summary['top_functions'] = [
+            {
+                'function': f"{file_name}:{line}({function})",
+                'calls': calls,
+                'own_seconds': round(own_time, 4),
+                'cumulative_seconds': round(cumulative_time, 4)
+            }
+            for (file_name, line, function), (_, calls, own_time, cumulative_time, _) in top
+        ]
+    
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+    
+    # Keep the most recent profiles only
+    summaries = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json') and name != 'settings.json')
+    for name in summaries[:-PROFILE_MAX_SAVED]:
+        for suffix in ['.json', '.prof']:
+            path = os.path.join(PROFILE_DIR, name[:-len('.json')] + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+    
+    logger.info(f"Wrote profile {profile_id} for {request.method} {request.path}")
+
+@app.after_request
+def compress_response(response):
+    """Compress large JSON responses with brotli or gzip if the client accepts it."""
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    with StageTimings.stage("compression"):
+        if brotli and request.accept_encodings['br']:
+            encoding, data = 'br', brotli.compress(data)
+        elif request.accept_encodings['gzip']:
+            encoding, data = 'gzip', gzip.compress(data, compresslevel=6)
+        else:
+            return response
+    
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    
+    # Each encoding is a different representation, so it needs its own strong ETag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+    return response
+
+def ensure_agent():
+    """
+    Make sure this worker has an agent. Sessions can be served by any worker,
+    so a worker may see an initialized session before it has set up its own agent.
+    """
+    if agent:
+        return True
+    success, message = setup_agent()
+    if not success:
+        logger.error(f"Failed to set up the agent for this worker: {message}")
+    return success
+
+def get_session_id():
+    """Get the identifier of the current browser session, creating one if needed."""
+    if 'session_id' not in session:
+        session['session_id'] = uuid.uuid4().hex
+    return session['session_id']
+
+def get_session_agent():
+    """Get the agent bound to the current browser session's stored state."""
+    # The tenant header is set by the fronting proxy, sessions without one share the default tenant
+    tenant_id = request.headers.get(TENANT_HEADER) if TRUST_TENANT_HEADER else None
+    return agent.for_session(get_session_id(), tenant_id)
 
 @app.route('/')
 def index():
@@ -114,7 +378,7 @@ def process_request():
     
     try:
         # Process the user request
-        result = agent.process_user_request(user_message)
+        result = get_session_agent().process_user_request(user_message)
         
         # Check if the agent needs more information
         if not result.get('success', False) and result.get('needs_more_info', False):
@@ -123,7 +387,8 @@ def process_request():
                 'success': False,
                 'message': result['message'],
                 'needs_more_info': True,
-                'missing_fields': result.get('missing_fields', [])
+                'missing_fields': result.get('missing_fields', []),
+                'invalid_fields': result.get('invalid_fields', {})
             })
         
         # Store the result in the session for later use
@@ -143,7 +408,7 @@ def get_terraform_code():
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
@@ -157,8 +422,8 @@ def get_terraform_code():
         })
     
     try:
-        result = agent.get_terraform_code()
-        return jsonify(result)
+        session_agent = get_session_agent()
+        return conditional_json_response(session_agent.current_terraform_files_hash, session_agent.get_terraform_code)
     except Exception as e:
         logger.error(f"Error getting Terraform code: {str(e)}")
         return jsonify({
@@ -166,13 +431,120 @@ def get_terraform_code():
             'message': f"Error getting Terraform code: {str(e)}"
         })
 
+@app.route('/api/terraform/files/<path:file_name>', methods=['GET'])
+def get_terraform_file(file_name):
+    """Get a single file of the current Terraform code."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    # Check if there is Terraform code
+    if not session.get('has_terraform_code', False):
+        return jsonify({
+            'success': False,
+            'message': "No Terraform code has been generated yet"
+        })
+    
+    try:
+        session_agent = get_session_agent()
+        etag = session_agent.current_terraform_file_hashes.get(file_name)
+        return conditional_json_response(etag, lambda: session_agent.get_terraform_file(file_name))
+    except Exception as e:
+        logger.error(f"Error getting Terraform file: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting Terraform file: {str(e)}"
+        })
+
+@app.route('/api/terraform/generations', methods=['GET'])
+def list_terraform_generations():
+    """List the stored generations of the Terraform code."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    limit = request.args.get('limit', 20, type=int)
+    
+    try:
+        result = get_session_agent().list_generations(limit=limit)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error listing Terraform generations: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error listing Terraform generations: {str(e)}"
+        })
+
+@app.route('/api/terraform/download', methods=['GET'])
+def download_terraform():
+    """Download the current Terraform code, or a stored generation of it, as a zip archive."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    generation_id = request.args.get('generation_id')
+    
+    try:
+        result = get_session_agent().get_generation_archive(generation_id)
+        if not result.get('success', False):
+            return jsonify(result), 404
+        
+        # The archive is built while it is sent, so it is never held in memory as a whole
+        response = Response(stream_with_context(result['chunks']), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f"attachment; filename={result['file_name']}"
+        response.set_etag(result['etag'])
+        return response
+    except Exception as e:
+        logger.error(f"Error downloading Terraform code: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error downloading Terraform code: {str(e)}"
+        })
+
+@app.route('/api/infrastructure/spec', methods=['GET'])
+def get_infrastructure_spec():
+    """Get the current infrastructure specification."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        session_agent = get_session_agent()
+        return conditional_json_response(session_agent.current_infrastructure_spec_hash, session_agent.get_infrastructure_spec)
+    except Exception as e:
+        logger.error(f"Error getting infrastructure specification: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting infrastructure specification: {str(e)}"
+        })
+
 @app.route('/api/terraform/validate', methods=['POST'])
 def validate_terraform():
     """Validate the current Terraform code."""
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
@@ -185,8 +557,12 @@ def validate_terraform():
             'message': "No Terraform code has been generated yet"
         })
     
+    # The client may pick the log ID so it can follow the output while validation runs
+    data = request.get_json(silent=True) or {}
+    log_id = data.get('log_id')
+    
     try:
-        result = agent.validate_terraform()
+        result = get_session_agent().validate_terraform(log_id=log_id)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error validating Terraform: {str(e)}")
@@ -201,7 +577,7 @@ def plan_terraform():
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
@@ -214,8 +590,14 @@ def plan_terraform():
             'message': "No Terraform code has been generated yet"
         })
     
+    # Get change scope options from request
+    data = request.get_json(silent=True) or {}
+    change_scope = data.get('change_scope')
+    refresh = data.get('refresh', True)
+    log_id = data.get('log_id')
+    
     try:
-        result = agent.plan_terraform()
+        result = get_session_agent().plan_terraform(change_scope=change_scope, refresh=refresh, log_id=log_id)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error generating Terraform plan: {str(e)}")
@@ -224,13 +606,135 @@ def plan_terraform():
             'message': f"Error generating Terraform plan: {str(e)}"
         })
 
+@app.route('/api/terraform/plan/<plan_id>', methods=['GET'])
+def get_terraform_plan(plan_id):
+    """Download the full JSON plan for a previous plan operation."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = get_session_agent().get_plan(plan_id)
+        if not result.get('success', False):
+            return jsonify(result), 404
+        return send_file(result['plan_path'], mimetype='application/json')
+    except Exception as e:
+        logger.error(f"Error getting Terraform plan: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting Terraform plan: {str(e)}"
+        })
+
+@app.route('/api/terraform/logs/<log_id>', methods=['GET'])
+def get_terraform_log(log_id):
+    """Get a page of the full output of a Terraform operation."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    # Get paging options from the query string
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 65536, type=int)
+    
+    try:
+        result = get_session_agent().read_operation_log(log_id, offset=offset, limit=limit)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error reading Terraform log: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error reading Terraform log: {str(e)}"
+        })
+
+@app.route('/api/terraform/fanout', methods=['POST'])
+def fan_out_terraform():
+    """Plan or apply the current Terraform code for many locations or subscriptions at once."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    # Check if there is Terraform code
+    if not session.get('has_terraform_code', False):
+        return jsonify({
+            'success': False,
+            'message': "No Terraform code has been generated yet"
+        })
+    
+    # Get targets and options from request
+    data = request.get_json(silent=True) or {}
+    targets = data.get('targets') or []
+    operation = data.get('operation', 'plan')
+    auto_approve = data.get('auto_approve', False)
+    max_parallel = data.get('max_parallel')
+    
+    try:
+        result = get_session_agent().fan_out(targets, operation=operation, auto_approve=auto_approve,
+                                             max_parallel=max_parallel)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error running fan-out {operation}: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error running fan-out {operation}: {str(e)}"
+        })
+
+@app.route('/api/terraform/import', methods=['POST'])
+def import_resources():
+    """Generate import blocks and configuration for existing Azure resources."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    # Get the import scope from request
+    data = request.get_json(silent=True) or {}
+    resource_groups = data.get('resource_groups') or None
+    resource_types = data.get('resource_types') or None
+    generate_config = data.get('generate_config', True)
+    log_id = data.get('log_id')
+    
+    try:
+        result = get_session_agent().import_resources(resource_groups, resource_types,
+                                                      generate_config=generate_config, log_id=log_id)
+        
+        # The imported code replaces the current Terraform code
+        if result.get('success', False):
+            session['has_terraform_code'] = True
+        
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error importing resources: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error importing resources: {str(e)}"
+        })
+
 @app.route('/api/terraform/apply', methods=['POST'])
 def apply_terraform():
     """Apply the current Terraform code."""
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
@@ -246,9 +750,13 @@ def apply_terraform():
     # Get auto-approve option from request
     data = request.json
     auto_approve = data.get('auto_approve', False)
+    change_scope = data.get('change_scope')
+    refresh = data.get('refresh', True)
+    log_id = data.get('log_id')
     
     try:
-        result = agent.apply_terraform(auto_approve=auto_approve)
+        result = get_session_agent().apply_terraform(auto_approve=auto_approve, change_scope=change_scope, refresh=refresh,
+                                                     log_id=log_id)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error applying Terraform: {str(e)}")
@@ -263,7 +771,7 @@ def destroy_terraform():
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
@@ -279,9 +787,10 @@ def destroy_terraform():
     # Get auto-approve option from request
     data = request.json
     auto_approve = data.get('auto_approve', False)
+    log_id = data.get('log_id')
     
     try:
-        result = agent.destroy_terraform(auto_approve=auto_approve)
+        result = get_session_agent().destroy_terraform(auto_approve=auto_approve, log_id=log_id)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error destroying infrastructure: {str(e)}")
@@ -290,20 +799,322 @@ def destroy_terraform():
             'message': f"Error destroying infrastructure: {str(e)}"
         })
 
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_metrics():
+    """Get the Claude call scheduler queue depth and wait times."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = agent.get_scheduler_metrics()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting scheduler metrics: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting scheduler metrics: {str(e)}"
+        })
+
+@app.route('/api/catalog/<kind>', methods=['GET'])
+def search_catalog(kind):
+    """Autocomplete Azure regions, VM sizes, storage SKUs and resource types from the offline catalog."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    prefix = request.args.get('prefix', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    
+    try:
+        result = agent.search_catalog(kind, prefix, limit)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error searching catalog: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error searching catalog: {str(e)}"
+        })
+
+@app.route('/api/terraform/locks', methods=['GET'])
+def get_workspace_lock_metrics():
+    """Get the held workspaces, queued operations and lock wait times."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = agent.get_workspace_lock_metrics()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting workspace lock metrics: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting workspace lock metrics: {str(e)}"
+        })
+
+@app.route('/api/budget', methods=['GET'])
+def get_budget_status():
+    """Get the Claude usage of this session and its tenant against their budgets."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = get_session_agent().get_budget_status()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting budget status: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting budget status: {str(e)}"
+        })
+
+@app.route('/api/terraform/result-cache', methods=['GET'])
+def get_result_cache_metrics():
+    """Get the size and hit rates of the validate and plan result cache."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = agent.get_result_cache_metrics()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting result cache metrics: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting result cache metrics: {str(e)}"
+        })
+
+@app.route('/api/spec-cache', methods=['GET'])
+def get_spec_cache_metrics():
+    """Get the size and hit rate of the spec cache."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = agent.get_spec_cache_metrics()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting spec cache metrics: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting spec cache metrics: {str(e)}"
+        })
+
+@app.route('/api/routing', methods=['GET'])
+def get_routing_metrics():
+    """Get the model routing decisions of each stage."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = agent.get_routing_metrics()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting routing metrics: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting routing metrics: {str(e)}"
+        })
+
+@app.route('/api/terraform/drift', methods=['GET'])
+def get_drift_status():
+    """Get the last drift check of the deployed infrastructure."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = get_session_agent().get_drift_status()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error getting drift status: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error getting drift status: {str(e)}"
+        })
+
+@app.route('/api/terraform/drift', methods=['POST'])
+def check_drift():
+    """Check the deployed infrastructure for drift now."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = get_session_agent().check_drift()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error checking drift: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error checking drift: {str(e)}"
+        })
+
+@app.route('/api/terraform/cancel', methods=['POST'])
+def cancel_operations():
+    """Cancel the code generation and Terraform operations running for this session."""
+    global agent
+    
+    # Check if agent is initialized
+    if not session.get('agent_initialized', False) or not ensure_agent():
+        return jsonify({
+            'success': False,
+            'message': "Agent not initialized"
+        })
+    
+    try:
+        result = get_session_agent().cancel_operations()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error cancelling operations: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f"Error cancelling operations: {str(e)}"
+        })
+
+@app.route('/api/admin/profiling', methods=['GET'])
+def get_profiling():
+    """Get the profiling toggle and the most recent profiles."""
+    if not has_profiling_token():
+        return jsonify({
+            'success': False,
+            'message': "Profiling is disabled or the profiling token is missing"
+        }), 403
+    
+    limit = request.args.get('limit', 20, type=int)
+    names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith('.json') and name != 'settings.json'),
+                   reverse=True)[:limit]
+    profiles = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name), 'r') as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiles.append({key: summary.get(key) for key in ['profile_id', 'method', 'path', 'status', 'wall_seconds', 'cpu_seconds']})
+    
+    return jsonify({
+        'success': True,
+        'message': "Profiling status retrieved",
+        'settings': get_profiling_settings(),
+        'max_per_minute': PROFILE_MAX_PER_MINUTE,
+        'profiles': profiles
+    })
+
+@app.route('/api/admin/profiling', methods=['POST'])
+def set_profiling():
+    """Turn sampled profiling on or off for every worker."""
+    if not has_profiling_token():
+        return jsonify({
+            'success': False,
+            'message': "Profiling is disabled or the profiling token is missing"
+        }), 403
+    
+    data = request.get_json(silent=True) or {}
+    settings = {
+        'enabled': bool(data.get('enabled', False)),
+        'sample_rate': min(1.0, max(0.0, float(data.get('sample_rate', 0.1))))
+    }
+    with open(PROFILE_SETTINGS_PATH, 'w') as f:
+        json.dump(settings, f)
+    
+    return jsonify({
+        'success': True,
+        'message': f"Profiling {'enabled' if settings['enabled'] else 'disabled'}",
+        'settings': settings
+    })
+
+@app.route('/api/admin/profiling/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Download a profile, the timing summary as JSON or the cProfile stats with ?format=prof."""
+    if not has_profiling_token():
+        return jsonify({
+            'success': False,
+            'message': "Profiling is disabled or the profiling token is missing"
+        }), 403
+    
+    if not re.fullmatch(r'[0-9]{13}-[0-9a-f]{8}', profile_id):
+        return jsonify({
+            'success': False,
+            'message': f"Invalid profile ID: {profile_id}"
+        }), 404
+    
+    suffix = '.prof' if request.args.get('format') == 'prof' else '.json'
+    path = os.path.join(PROFILE_DIR, profile_id + suffix)
+    if not os.path.exists(path):
+        return jsonify({
+            'success': False,
+            'message': f"Profile {profile_id} not found"
+        }), 404
+    
+    if suffix == '.prof':
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=profile_id + suffix)
+    return send_file(path, mimetype='application/json')
+
 @app.route('/api/clear', methods=['POST'])
 def clear_conversation():
     """Clear the conversation history."""
     global agent
     
     # Check if agent is initialized
-    if not agent or not session.get('agent_initialized', False):
+    if not session.get('agent_initialized', False) or not ensure_agent():
         return jsonify({
             'success': False,
             'message': "Agent not initialized"
         })
     
     try:
-        result = agent.clear_conversation_history()
+        result = get_session_agent().clear_conversation_history()
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error clearing conversation: {str(e)}")
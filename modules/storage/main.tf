@@ -0,0 +1,22 @@
+# Storage account with secure defaults and optional blob containers
+
+resource "azurerm_storage_account" "this" {
+  name                            = var.name
+  resource_group_name             = var.resource_group_name
+  location                        = var.location
+  account_kind                    = var.account_kind
+  account_tier                    = var.account_tier
+  account_replication_type        = var.account_replication_type
+  access_tier                     = var.access_tier
+  min_tls_version                 = "TLS1_2"
+  allow_nested_items_to_be_public = false
+  tags                            = var.tags
+}
+
+resource "azurerm_storage_container" "this" {
+  for_each = toset(var.containers)
+
+  name                  = each.value
+  storage_account_name  = azurerm_storage_account.this.name
+  container_access_type = "private"
+}
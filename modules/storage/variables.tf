@@ -0,0 +1,50 @@
+variable "name" {
+  description = "Storage account name, 3-24 lowercase letters and digits"
+  type        = string
+}
+
+variable "resource_group_name" {
+  description = "Resource group of the storage account"
+  type        = string
+}
+
+variable "location" {
+  description = "Azure region"
+  type        = string
+}
+
+variable "account_kind" {
+  description = "StorageV2, BlobStorage, BlockBlobStorage, FileStorage or Storage"
+  type        = string
+  default     = "StorageV2"
+}
+
+variable "account_tier" {
+  description = "Standard or Premium"
+  type        = string
+  default     = "Standard"
+}
+
+variable "account_replication_type" {
+  description = "LRS, GRS, RAGRS, ZRS, GZRS or RAGZRS"
+  type        = string
+  default     = "LRS"
+}
+
+variable "access_tier" {
+  description = "Hot or Cool"
+  type        = string
+  default     = "Hot"
+}
+
+variable "containers" {
+  description = "Names of private blob containers to create"
+  type        = list(string)
+  default     = []
+}
+
+variable "tags" {
+  description = "Tags to apply"
+  type        = map(string)
+  default     = {}
+}
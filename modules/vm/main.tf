@@ -0,0 +1,55 @@
+# Linux virtual machine with SSH key authentication, a network interface and an optional public IP
+
+resource "azurerm_public_ip" "this" {
+  count = var.public_ip ? 1 : 0
+
+  name                = "${var.name}-pip"
+  resource_group_name = var.resource_group_name
+  location            = var.location
+  allocation_method   = "Static"
+  sku                 = "Standard"
+  tags                = var.tags
+}
+
+resource "azurerm_network_interface" "this" {
+  name                = "${var.name}-nic"
+  resource_group_name = var.resource_group_name
+  location            = var.location
+  tags                = var.tags
+
+  ip_configuration {
+    name                          = "internal"
+    subnet_id                     = var.subnet_id
+    private_ip_address_allocation = "Dynamic"
+    public_ip_address_id          = var.public_ip ? azurerm_public_ip.this[0].id : null
+  }
+}
+
+resource "azurerm_linux_virtual_machine" "this" {
+  name                            = var.name
+  resource_group_name             = var.resource_group_name
+  location                        = var.location
+  size                            = var.size
+  admin_username                  = var.admin_username
+  disable_password_authentication = true
+  network_interface_ids           = [azurerm_network_interface.this.id]
+  tags                            = var.tags
+
+  admin_ssh_key {
+    username   = var.admin_username
+    public_key = var.admin_ssh_public_key
+  }
+
+  os_disk {
+    caching              = "ReadWrite"
+    storage_account_type = var.os_disk_type
+    disk_size_gb         = var.os_disk_size_gb
+  }
+
+  source_image_reference {
+    publisher = var.image.publisher
+    offer     = var.image.offer
+    sku       = var.image.sku
+    version   = var.image.version
+  }
+}
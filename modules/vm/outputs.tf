@@ -0,0 +1,15 @@
+output "id" {
+  value = azurerm_linux_virtual_machine.this.id
+}
+
+output "private_ip_address" {
+  value = azurerm_network_interface.this.private_ip_address
+}
+
+output "public_ip_address" {
+  value = var.public_ip ? azurerm_public_ip.this[0].ip_address : null
+}
+
+output "network_interface_id" {
+  value = azurerm_network_interface.this.id
+}
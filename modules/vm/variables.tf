@@ -0,0 +1,76 @@
+variable "name" {
+  description = "Virtual machine name"
+  type        = string
+}
+
+variable "resource_group_name" {
+  description = "Resource group of the virtual machine"
+  type        = string
+}
+
+variable "location" {
+  description = "Azure region"
+  type        = string
+}
+
+variable "subnet_id" {
+  description = "Subnet of the network interface, for example module.vnet.subnet_ids[\"default\"]"
+  type        = string
+}
+
+variable "admin_ssh_public_key" {
+  description = "SSH public key of the admin user"
+  type        = string
+}
+
+variable "admin_username" {
+  description = "Admin user name"
+  type        = string
+  default     = "azureuser"
+}
+
+variable "size" {
+  description = "VM size"
+  type        = string
+  default     = "Standard_B2s"
+}
+
+variable "public_ip" {
+  description = "Whether to attach a static public IP"
+  type        = bool
+  default     = false
+}
+
+variable "os_disk_type" {
+  description = "Standard_LRS, StandardSSD_LRS or Premium_LRS"
+  type        = string
+  default     = "StandardSSD_LRS"
+}
+
+variable "os_disk_size_gb" {
+  description = "OS disk size, the image default when null"
+  type        = number
+  default     = null
+}
+
+variable "image" {
+  description = "Marketplace image"
+  type = object({
+    publisher = string
+    offer     = string
+    sku       = string
+    version   = string
+  })
+  default = {
+    publisher = "Canonical"
+    offer     = "0001-com-ubuntu-server-jammy"
+    sku       = "22_04-lts-gen2"
+    version   = "latest"
+  }
+}
+
+variable "tags" {
+  description = "Tags to apply"
+  type        = map(string)
+  default     = {}
+}
@@ -0,0 +1,11 @@
+output "id" {
+  value = azurerm_virtual_network.this.id
+}
+
+output "name" {
+  value = azurerm_virtual_network.this.name
+}
+
+output "subnet_ids" {
+  value = { for name, subnet in azurerm_subnet.this : name => subnet.id }
+}
@@ -0,0 +1,38 @@
+variable "name" {
+  description = "Virtual network name"
+  type        = string
+}
+
+variable "resource_group_name" {
+  description = "Resource group of the virtual network"
+  type        = string
+}
+
+variable "location" {
+  description = "Azure region"
+  type        = string
+}
+
+variable "address_space" {
+  description = "Address spaces of the network"
+  type        = list(string)
+  default     = ["10.0.0.0/16"]
+}
+
+variable "subnets" {
+  description = "Map of subnet name to address prefix"
+  type        = map(string)
+  default     = { default = "10.0.1.0/24" }
+}
+
+variable "dns_servers" {
+  description = "Custom DNS servers, Azure DNS when empty"
+  type        = list(string)
+  default     = []
+}
+
+variable "tags" {
+  description = "Tags to apply"
+  type        = map(string)
+  default     = {}
+}
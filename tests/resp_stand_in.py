@@ -0,0 +1,203 @@
+import time
+import socket
+import threading
+import socketserver
+from typing import Any, Dict, List, Optional
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """
+    A small in-process server speaking enough of the Redis protocol for RedisSessionStore:
+    AUTH, SELECT, PING, GET, SET with EX, MGET, DEL, WATCH, UNWATCH, MULTI and EXEC.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password: Optional[str] = None, databases: int = 16):
+        super().__init__(("127.0.0.1", 0), _RespHandler)
+        self.password = password
+        self.databases = databases
+        self.data: Dict[int, Dict[bytes, tuple]] = {}
+        self.revisions: Dict[tuple, int] = {}
+        self.lock = threading.Lock()
+        self.clients: List[socket.socket] = []
+        self.commands: List[List[bytes]] = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "RespStandIn":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self) -> None:
+        """
+        Close every client connection, as a server restart or an idle timeout would.
+        """
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+            except OSError:
+                pass
+
+    def lookup(self, db: int, key: bytes) -> Optional[bytes]:
+        entry = self.data.get(db, {}).get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.data[db][key]
+            return None
+        return value
+
+    def store(self, db: int, key: bytes, value: Optional[bytes], expires_at: Optional[float] = None) -> None:
+        if value is None:
+            self.data.get(db, {}).pop(key, None)
+        else:
+            self.data.setdefault(db, {})[key] = (value, expires_at)
+        self.revisions[(db, key)] = self.revisions.get((db, key), 0) + 1
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.server.clients.append(self.request)
+        self.authenticated = self.server.password is None
+        self.db = 0
+        self.watched: Dict[bytes, int] = {}
+        self.queued: Optional[List[List[bytes]]] = None
+
+    def handle(self):
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, OSError, ValueError):
+                return
+            if command is None:
+                return
+            self.server.commands.append(command)
+            try:
+                self.wfile.write(self.encode(self.dispatch(command)))
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:].strip())
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:].strip())
+            args.append(self.rfile.read(length + 2)[:length])
+        return args
+
+    def encode(self, reply: Any) -> bytes:
+        if isinstance(reply, _Status):
+            return b"+" + reply.text.encode() + b"\r\n"
+        if isinstance(reply, _Error):
+            return b"-" + reply.text.encode() + b"\r\n"
+        if isinstance(reply, int):
+            return b":" + str(reply).encode() + b"\r\n"
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, _NullArray):
+            return b"*-1\r\n"
+        if isinstance(reply, list):
+            return b"*" + str(len(reply)).encode() + b"\r\n" + b"".join(self.encode(item) for item in reply)
+        return b"$" + str(len(reply)).encode() + b"\r\n" + reply + b"\r\n"
+
+    def dispatch(self, command: List[bytes]) -> Any:
+        name, args = command[0].upper().decode(), command[1:]
+        if name == "AUTH":
+            if self.server.password is None:
+                return _Error("ERR AUTH <password> called without any password configured")
+            if args[-1].decode() != self.server.password:
+                return _Error("WRONGPASS invalid username-password pair or user is disabled.")
+            self.authenticated = True
+            return _Status("OK")
+        if not self.authenticated:
+            return _Error("NOAUTH Authentication required.")
+        if name == "SELECT":
+            db = int(args[0])
+            if not 0 <= db < self.server.databases:
+                return _Error("ERR DB index is out of range")
+            self.db = db
+            return _Status("OK")
+        if name == "MULTI":
+            self.queued = []
+            return _Status("OK")
+        if name == "EXEC":
+            return self.execute()
+        if self.queued is not None:
+            self.queued.append(command)
+            return _Status("QUEUED")
+        if name == "WATCH":
+            with self.server.lock:
+                for key in args:
+                    self.watched[key] = self.server.revisions.get((self.db, key), 0)
+            return _Status("OK")
+        if name == "UNWATCH":
+            self.watched = {}
+            return _Status("OK")
+        with self.server.lock:
+            return self.run(name, args)
+
+    def execute(self) -> Any:
+        queued, self.queued = self.queued or [], None
+        watched, self.watched = self.watched, {}
+        with self.server.lock:
+            for key, revision in watched.items():
+                if self.server.revisions.get((self.db, key), 0) != revision:
+                    return _NullArray()
+            return [self.run(command[0].upper().decode(), command[1:]) for command in queued]
+
+    def run(self, name: str, args: List[bytes]) -> Any:
+        server = self.server
+        if name == "PING":
+            return _Status("PONG")
+        if name == "GET":
+            return server.lookup(self.db, args[0])
+        if name == "MGET":
+            return [server.lookup(self.db, key) for key in args]
+        if name == "SET":
+            expires_at = None
+            if len(args) >= 4 and args[2].upper() == b"EX":
+                expires_at = time.time() + int(args[3])
+            server.store(self.db, args[0], args[1], expires_at)
+            return _Status("OK")
+        if name == "DEL":
+            removed = 0
+            for key in args:
+                if server.lookup(self.db, key) is not None:
+                    removed += 1
+                server.store(self.db, key, None)
+            return removed
+        return _Error(f"ERR unknown command '{name}'")
+
+
+class _Status:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Error:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _NullArray:
+    pass
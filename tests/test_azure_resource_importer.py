@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import AzureResourceImporter
+
+
+class FakePager:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def by_page(self):
+        return iter(self.pages)
+
+
+class FakeResourceClient:
+    """
+    Stands in for ResourceManagementClient with resource groups whose resources come in pages.
+    """
+
+    def __init__(self, groups, os_types=None):
+        self.groups = groups
+        self.os_types = os_types or {}
+        self.os_lookups = []
+        self.resource_groups = SimpleNamespace(get=self._get_group, list=self._list_groups)
+        self.resources = SimpleNamespace(list_by_resource_group=self._list_by_resource_group,
+                                         get_by_id=self._get_by_id)
+
+    def _group(self, name):
+        return SimpleNamespace(id=f"/subscriptions/s/resourceGroups/{name}", name=name, location="westeurope",
+                               tags={"env": "test"})
+
+    def _get_group(self, name):
+        return self._group(name)
+
+    def _list_groups(self):
+        return [self._group(name) for name in self.groups]
+
+    def _list_by_resource_group(self, name):
+        return FakePager(self.groups[name])
+
+    def _get_by_id(self, resource_id, api_version):
+        self.os_lookups.append(resource_id)
+        os_type = self.os_types[resource_id]
+        if isinstance(os_type, Exception):
+            raise os_type
+        return SimpleNamespace(properties={"storageProfile": {"osDisk": {"osType": os_type}}})
+
+
+def resource(group, name, resource_type, sku=None, kind=None):
+    provider, type_name = resource_type.rsplit("/", 1)
+    return SimpleNamespace(
+        id=f"/subscriptions/s/resourceGroups/{group}/providers/{provider}/{type_name}/{name}",
+        name=name, type=resource_type, location="westeurope", tags=None,
+        sku=SimpleNamespace(name=sku, tier=None) if sku else None, kind=kind
+    )
+
+
+def test_list_resources_pages_through_every_group():
+    client = FakeResourceClient({
+        "app": [
+            [resource("app", "data", "Microsoft.Storage/storageAccounts", "Standard_LRS", "StorageV2")],
+            [resource("app", "vnet", "Microsoft.Network/virtualNetworks")],
+            [resource("app", "logs", "Microsoft.OperationalInsights/workspaces", "PerGB2018")]
+        ],
+        "web": [[], [resource("web", "plan", "Microsoft.Web/serverfarms", "P1v3", "linux")]]
+    })
+    importer = AzureResourceImporter(client, max_workers=2, max_resources=100)
+
+    groups, resources, truncated = importer.list_resources()
+
+    assert [group["name"] for group in groups] == ["app", "web"]
+    assert [item["name"] for item in resources] == ["data", "vnet", "logs", "plan"]
+    assert resources[0]["sku"] == {"name": "Standard_LRS", "tier": None}
+    assert not truncated
+
+    _, resources, _ = importer.list_resources(["app"], ["microsoft.storage/storageaccounts"])
+    assert [item["name"] for item in resources] == ["data"]
+
+
+def test_virtual_machines_are_typed_by_their_os():
+    linux = resource("app", "vm1", "Microsoft.Compute/virtualMachines")
+    windows = resource("app", "vm2", "Microsoft.Compute/virtualMachines")
+    unknown = resource("app", "vm3", "Microsoft.Compute/virtualMachines")
+    client = FakeResourceClient({"app": [[linux, windows, unknown]]}, os_types={
+        linux.id: "Linux", windows.id: "Windows", unknown.id: RuntimeError("forbidden")
+    })
+    importer = AzureResourceImporter(client, max_workers=2)
+
+    groups, resources, _ = importer.list_resources()
+
+    assert [importer.azurerm_type(item) for item in resources] == [
+        "azurerm_linux_virtual_machine", "azurerm_windows_virtual_machine", None]
+    _, summary = importer.build_files(groups, resources)
+    assert summary["unsupported"] == {"Microsoft.Compute/virtualMachines": 1}
+    assert summary["needs_generated_config"] == 2
+
+
+def test_resources_are_truncated_to_the_maximum():
+    client = FakeResourceClient({
+        "app": [[resource("app", f"id{index}", "Microsoft.ManagedIdentity/userAssignedIdentities")
+                 for index in range(5)]] * 2,
+        "vms": [[resource("vms", "vm", "Microsoft.Compute/virtualMachines")]]
+    }, os_types={})
+    importer = AzureResourceImporter(client, max_workers=2, max_resources=4)
+
+    _, resources, truncated = importer.list_resources()
+
+    assert truncated
+    assert len(resources) == 4
+    # Virtual machines cut off by the maximum aren't looked up
+    assert client.os_lookups == []
+
+
+def test_block_names_are_unique_per_type():
+    client = FakeResourceClient({"app": [[
+        resource("app", "data", "Microsoft.Storage/storageAccounts", "Standard_LRS"),
+        resource("app", "Data", "Microsoft.Storage/storageAccounts", "Standard_GRS"),
+        resource("app", "data", "Microsoft.ManagedIdentity/userAssignedIdentities"),
+        resource("app", "1st-identity", "Microsoft.ManagedIdentity/userAssignedIdentities")
+    ]]})
+    importer = AzureResourceImporter(client)
+
+    groups, resources, _ = importer.list_resources()
+    files, summary = importer.build_files(groups, resources)
+
+    assert 'resource "azurerm_storage_account" "data" {' in files["imported.tf"]
+    assert 'resource "azurerm_storage_account" "data_2" {' in files["imported.tf"]
+    assert 'resource "azurerm_user_assigned_identity" "data" {' in files["imported.tf"]
+    assert 'resource "azurerm_user_assigned_identity" "r_1st_identity" {' in files["imported.tf"]
+    assert "to = azurerm_resource_group.app" in files["imports.tf"]
+    assert summary["templated"] == 5
@@ -0,0 +1,130 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import AzureTerraformAgent
+from claude_terraform_store import MemorySessionStore
+
+
+@pytest.fixture
+def agent():
+    """
+    An agent with only the session state, enough to bind it to sessions and save them.
+    """
+    agent = AzureTerraformAgent.__new__(AzureTerraformAgent)
+    agent.session_store = MemorySessionStore(ttl_seconds=60)
+    agent.conversational_agent = SimpleNamespace(conversation_history=[], pending_messages=[],
+                                                 suggested_spec=None, catalog_warnings=[])
+    return agent
+
+
+def charge(session_agent, input_tokens, output_tokens):
+    session_agent.session_usage["input_tokens"] += input_tokens
+    session_agent.session_usage["output_tokens"] += output_tokens
+    session_agent.session_usage["calls"] += 1
+
+
+def test_concurrent_requests_add_their_usage(agent):
+    first = agent.for_session("session")
+    charge(first, 100, 10)
+    first.save_session()
+
+    second = agent.for_session("session")
+    third = agent.for_session("session")
+    charge(second, 20, 2)
+    charge(third, 3, 1)
+    second.save_session()
+    third.save_session()
+
+    usage = agent.for_session("session").session_usage
+    assert (usage["input_tokens"], usage["output_tokens"], usage["calls"]) == (123, 13, 3)
+    assert third.session_usage["input_tokens"] == 123
+
+
+def test_merged_usage_keeps_charging_the_bound_record(agent):
+    second = agent.for_session("session")
+    third = agent.for_session("session")
+    usage = third.session_usage
+    charge(second, 20, 2)
+    second.save_session()
+    charge(third, 3, 1)
+    third.save_session()
+
+    # A request still running charges the record it was bound to
+    assert third.session_usage is usage
+    charge(third, 1, 1)
+    third.save_session()
+
+    assert agent.for_session("session").session_usage["input_tokens"] == 24
+
+
+def test_concurrent_changes_to_other_fields_are_kept(agent):
+    first = agent.for_session("session")
+    second = agent.for_session("session")
+    first.applied_terraform_files = {"main.tf": "applied"}
+    first.save_session()
+    charge(second, 5, 5)
+    second.save_session()
+
+    loaded = agent.for_session("session")
+    assert loaded.applied_terraform_files == {"main.tf": "applied"}
+    assert loaded.session_usage["input_tokens"] == 5
+
+
+FILES = {"main.tf": '''
+resource "azurerm_resource_group" "main" {
+  name     = "rg"
+  location = "westeurope"
+}
+
+resource "azurerm_virtual_network" "main" {
+  name                = "vnet"
+  resource_group_name = azurerm_resource_group.main.name
+}
+
+resource "azurerm_subnet" "app" {
+  virtual_network_name = azurerm_virtual_network.main.name
+}
+'''}
+
+
+@pytest.fixture
+def scoped_agent(agent):
+    agent.current_terraform_files = FILES
+    agent.applied_terraform_files = {"main.tf": FILES["main.tf"] + 'resource "azurerm_public_ip" "old" {}\n'}
+    agent.current_infrastructure_spec = {"resource_type": "Virtual Network"}
+    agent.applied_infrastructure_spec = None
+    return agent
+
+
+def test_spec_scope_targets_the_matching_resources(scoped_agent):
+    assert scoped_agent.resolve_change_scope("spec") == ["azurerm_subnet.app", "azurerm_virtual_network.main"]
+
+
+def test_spec_scope_matching_nothing_is_not_widened(scoped_agent):
+    scoped_agent.current_infrastructure_spec = {"resource_type": "VNet"}
+
+    with pytest.raises(ValueError, match="matched no resources"):
+        scoped_agent.resolve_change_scope("spec")
+
+
+def test_explicit_addresses_are_checked(scoped_agent):
+    # Removed since the last apply, but still in state
+    assert scoped_agent.resolve_change_scope(["azurerm_public_ip.old"]) == ["azurerm_public_ip.old"]
+    assert "azurerm_subnet.app" in scoped_agent.resolve_change_scope(["azurerm_virtual_network.main[0]"])
+
+    with pytest.raises(ValueError, match="azurerm_virtual_network.typo"):
+        scoped_agent.resolve_change_scope(["azurerm_virtual_network.typo"])
+    with pytest.raises(ValueError, match="var.location"):
+        scoped_agent.resolve_change_scope(["var.location"])
+
+
+def test_unchanged_files_scope_is_not_widened(scoped_agent):
+    scoped_agent.applied_terraform_files = FILES
+
+    with pytest.raises(ValueError, match="matched no resources"):
+        scoped_agent.resolve_change_scope("files")
@@ -0,0 +1,184 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import ClaudeCallScheduler, SchedulerTimeoutError
+
+INTERACTIVE = ClaudeCallScheduler.INTERACTIVE
+BATCH = ClaudeCallScheduler.BATCH
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Monotonic time that only moves when the test moves it. Waiting calls are woken with `advance`.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    def advance(scheduler, seconds):
+        now[0] += seconds
+        with scheduler.condition:
+            scheduler.condition.notify_all()
+
+    return SimpleNamespace(now=lambda: now[0], advance=advance)
+
+
+def scheduler_with(tokens_per_minute=100, requests_per_minute=10, max_wait_seconds=300):
+    return ClaudeCallScheduler(tokens_per_minute=tokens_per_minute, requests_per_minute=requests_per_minute,
+                               max_wait_seconds=max_wait_seconds, worker_count=1)
+
+
+def eventually(condition):
+    # Real time passes here, the scheduler's clock stands still
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not met in time")
+
+
+def call_in_thread(scheduler, priority, tokens, name, admitted):
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = scheduler.call(priority, tokens, lambda: admitted.append(name) or name)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_calls_fitting_the_budget_wait_for_nothing():
+    scheduler = scheduler_with()
+
+    assert scheduler._wait_time(50, 0.0) == 0.0
+    scheduler.window.extend([[0.0, 30], [10.0, 20]])
+    assert scheduler._wait_time(50, 20.0) == 0.0
+
+
+def test_oversized_call_is_admitted_into_an_empty_window():
+    scheduler = scheduler_with(tokens_per_minute=100)
+
+    assert scheduler._wait_time(500, 0.0) == 0.0
+    scheduler.window.append([0.0, 1])
+    assert scheduler._wait_time(500, 10.0) == 50.0
+
+
+@pytest.mark.parametrize("tokens, expected", [
+    # Waits for the first call to leave the window
+    (50, 40.0),
+    # Waits for both calls to leave it
+    (95, 50.0),
+])
+def test_token_budget_waits_for_enough_calls_to_expire(tokens, expected):
+    scheduler = scheduler_with(tokens_per_minute=100)
+    scheduler.window.extend([[0.0, 60], [10.0, 30]])
+
+    assert scheduler._wait_time(tokens, 20.0) == expected
+
+
+def test_request_budget_waits_for_the_oldest_call_to_expire():
+    scheduler = scheduler_with(tokens_per_minute=1000, requests_per_minute=2)
+    scheduler.window.extend([[0.0, 1], [10.0, 1]])
+
+    assert scheduler._wait_time(1, 20.0) == 40.0
+
+
+@pytest.mark.parametrize("workers, tokens, requests", [(1, 1000, 10), (4, 250, 2), (20, 50, 1)])
+def test_budgets_are_split_between_workers(workers, tokens, requests):
+    scheduler = ClaudeCallScheduler(tokens_per_minute=1000, requests_per_minute=10, worker_count=workers)
+
+    assert (scheduler.tokens_per_minute, scheduler.requests_per_minute) == (tokens, requests)
+    assert (scheduler.total_tokens_per_minute, scheduler.total_requests_per_minute) == (1000, 10)
+
+
+@pytest.mark.parametrize("environment, expected", [
+    ({}, 1),
+    ({"GUNICORN_CMD_ARGS": "--workers 4 --worker-class gthread"}, 4),
+    ({"GUNICORN_CMD_ARGS": "-w 3"}, 3),
+    ({"WEB_CONCURRENCY": "6", "GUNICORN_CMD_ARGS": "--workers 4"}, 6),
+    ({"ANTHROPIC_SCHEDULER_WORKERS": "8", "WEB_CONCURRENCY": "6"}, 8),
+])
+def test_worker_count_comes_from_the_environment(monkeypatch, environment, expected):
+    for name in ["ANTHROPIC_SCHEDULER_WORKERS", "WEB_CONCURRENCY", "GUNICORN_CMD_ARGS"]:
+        monkeypatch.delenv(name, raising=False)
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+
+    assert ClaudeCallScheduler.default_worker_count() == expected
+
+
+def test_calls_wait_until_the_window_frees_budget(clock):
+    scheduler = scheduler_with(requests_per_minute=1)
+    admitted = []
+    scheduler.call(BATCH, 10, lambda: admitted.append("first"))
+
+    thread, outcome = call_in_thread(scheduler, BATCH, 10, "second", admitted)
+    eventually(lambda: len(scheduler.queue) == 1)
+    clock.advance(scheduler, 59)
+    time.sleep(0.05)
+    assert admitted == ["first"]
+
+    clock.advance(scheduler, 1)
+    thread.join(5)
+    assert outcome == {"result": "second"}
+    assert scheduler.get_metrics()["wait_times"]["batch"]["max_wait_seconds"] == 60.0
+
+
+def test_interactive_calls_are_served_first(clock):
+    scheduler = scheduler_with(requests_per_minute=1)
+    admitted = []
+    scheduler.call(BATCH, 10, lambda: admitted.append("first"))
+
+    batch, _ = call_in_thread(scheduler, BATCH, 10, "batch", admitted)
+    eventually(lambda: len(scheduler.queue) == 1)
+    interactive, _ = call_in_thread(scheduler, INTERACTIVE, 10, "interactive", admitted)
+    eventually(lambda: len(scheduler.queue) == 2)
+    assert scheduler.get_metrics()["queue_depth"] == {"interactive": 1, "batch": 1}
+
+    clock.advance(scheduler, 60)
+    interactive.join(5)
+    time.sleep(0.05)
+    assert admitted == ["first", "interactive"]
+
+    clock.advance(scheduler, 60)
+    batch.join(5)
+    assert admitted == ["first", "interactive", "batch"]
+
+
+def test_calls_give_up_after_the_maximum_wait(clock):
+    scheduler = scheduler_with(requests_per_minute=1, max_wait_seconds=30)
+    admitted = []
+    scheduler.call(BATCH, 10, lambda: admitted.append("first"))
+
+    thread, outcome = call_in_thread(scheduler, BATCH, 10, "second", admitted)
+    eventually(lambda: len(scheduler.queue) == 1)
+    clock.advance(scheduler, 31)
+    thread.join(5)
+
+    assert isinstance(outcome["error"], SchedulerTimeoutError)
+    assert admitted == ["first"]
+    assert scheduler.queue == []
+
+
+def test_reported_usage_replaces_the_estimate(clock):
+    scheduler = scheduler_with()
+    response = SimpleNamespace(usage=SimpleNamespace(input_tokens=7, output_tokens=5))
+
+    assert scheduler.call(INTERACTIVE, 90, lambda: response) is response
+
+    metrics = scheduler.get_metrics()
+    assert metrics["tokens_used_last_minute"] == 12
+    assert metrics["requests_last_minute"] == 1
+    clock.advance(scheduler, 60)
+    assert scheduler.get_metrics()["requests_last_minute"] == 0
@@ -0,0 +1,130 @@
+import time
+
+import pytest
+
+from claude_terraform_store import MemorySessionStore, RedisSessionStore, SQLiteSessionStore, create_session_store
+from resp_stand_in import RespStandIn
+
+
+@pytest.fixture
+def server():
+    server = RespStandIn(password="secret").start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Lets a test move time forward for the stores and the stand-in alike.
+    """
+    offset = [0.0]
+    real_time = time.time
+    monkeypatch.setattr(time, "time", lambda: real_time() + offset[0])
+    return lambda seconds: offset.__setitem__(0, offset[0] + seconds)
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield MemorySessionStore(ttl_seconds=60)
+    elif request.param == "sqlite":
+        yield SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl_seconds=60)
+    else:
+        server = RespStandIn(password="secret").start()
+        yield RedisSessionStore(port=server.port, password="secret", db=2, ttl_seconds=60)
+        server.stop()
+
+
+RECORD = {"conversation_history": [{"role": "user", "content": "A storage account in westeurope"}],
+          "terraform_files": {"main.tf": 'resource "azurerm_resource_group" "main" {}\n'}}
+
+
+def test_round_trip(store):
+    assert store.load("session") is None
+    assert store.save("session", RECORD) == 1
+    assert store.load("session") == RECORD
+    assert store.load_versioned("session") == (RECORD, 1)
+
+    store.delete("session")
+    assert store.load_versioned("session") == (None, 0)
+
+
+def test_expired_sessions_are_gone(store, clock):
+    store.save("session", RECORD)
+    clock(30)
+    assert store.load("session") == RECORD
+    clock(31)
+    assert store.load_versioned("session") == (None, 0)
+    # An expired session starts over as a new one
+    assert store.save("session", RECORD, expected_version=0) == 1
+
+
+def test_save_checks_the_version(store):
+    assert store.save("session", RECORD, expected_version=0) == 1
+    assert store.save("session", {"generation_id": "stale"}, expected_version=0) is None
+    assert store.save("session", {"generation_id": "new"}, expected_version=1) == 2
+    assert store.save("session", {"generation_id": "stale"}, expected_version=1) is None
+    assert store.load_versioned("session") == ({"generation_id": "new"}, 2)
+    assert store.save("session", RECORD) == 3
+
+
+def test_redis_uses_the_selected_database(server):
+    first = RedisSessionStore(port=server.port, password="secret", db=1)
+    second = RedisSessionStore(port=server.port, password="secret", db=2)
+    first.save("session", RECORD)
+    assert second.load("session") is None
+    assert first.load("session") == RECORD
+
+
+def test_redis_reconnects_after_a_dropped_connection(server):
+    store = RedisSessionStore(port=server.port, password="secret", db=3)
+    store.save("session", RECORD)
+    server.drop_connections()
+
+    assert store.load("session") == RECORD
+    # The new connection is authenticated and on the right database again
+    assert [command[0] for command in server.commands].count(b"AUTH") == 2
+    assert [command for command in server.commands if command[0] == b"SELECT"][-1] == [b"SELECT", b"3"]
+
+
+def test_redis_auth_failure_keeps_no_connection(server):
+    store = RedisSessionStore(port=server.port, password="wrong")
+    with pytest.raises(RuntimeError, match="WRONGPASS"):
+        store.load("session")
+    assert getattr(store.local, "connection", None) is None
+
+    store.password = "secret"
+    store.save("session", RECORD)
+    assert store.load("session") == RECORD
+
+
+def test_redis_select_failure_keeps_no_connection(server):
+    store = RedisSessionStore(port=server.port, password="secret", db=99)
+    with pytest.raises(RuntimeError, match="out of range"):
+        store.load("session")
+    assert getattr(store.local, "connection", None) is None
+
+
+def test_redis_detects_a_concurrent_write_during_save(server, monkeypatch):
+    store = RedisSessionStore(port=server.port, password="secret")
+    other = RedisSessionStore(port=server.port, password="secret")
+    store.save("session", RECORD)
+
+    send_command = store._send_command
+
+    def interleaved(*args):
+        if args[0] == "MULTI":
+            other.save("session", {"generation_id": "other"})
+        return send_command(*args)
+
+    monkeypatch.setattr(store, "_send_command", interleaved)
+    assert store.save("session", {"generation_id": "mine"}, expected_version=1) is None
+    assert store.load_versioned("session") == ({"generation_id": "other"}, 2)
+
+
+def test_create_session_store_from_url(tmp_path):
+    assert isinstance(create_session_store("memory://"), MemorySessionStore)
+    assert isinstance(create_session_store(f"sqlite:///{tmp_path}/sessions.db"), SQLiteSessionStore)
+    store = create_session_store("redis://:secret@cache:6380/4")
+    assert (store.host, store.port, store.db, store.password) == ("cache", 6380, 4, "secret")
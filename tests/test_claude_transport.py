@@ -0,0 +1,94 @@
+import threading
+from concurrent.futures import CancelledError
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import ClaudeTransport
+
+
+class FakeStream:
+    """
+    Stands in for the stream manager of `client.messages.stream`, yielding one event per text chunk.
+    """
+
+    def __init__(self, chunks, on_event=None):
+        self.chunks = chunks
+        self.on_event = on_event
+        self.sent = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+        return False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.sent += 1
+            if self.on_event:
+                self.on_event(self.sent)
+            yield SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(text=chunk))
+
+    def get_final_message(self):
+        return SimpleNamespace(content=[SimpleNamespace(text="".join(self.chunks))], stop_reason="end_turn")
+
+
+def transport_with(stream):
+    transport = ClaudeTransport(anthropic_api_key="test", mode="passthrough")
+    created = []
+    transport.client = SimpleNamespace(messages=SimpleNamespace(
+        stream=lambda **request: stream,
+        create=lambda **request: created.append(request) or stream.get_final_message()
+    ))
+    return transport, created
+
+
+def test_cancelled_call_closes_the_stream():
+    cancel_event = threading.Event()
+    stream = FakeStream(["a", "b", "c", "d"], on_event=lambda sent: sent == 2 and cancel_event.set())
+    transport, _ = transport_with(stream)
+
+    with pytest.raises(CancelledError):
+        transport.create_message(cancel_check=cancel_event.is_set, model="m", max_tokens=10, messages=[])
+
+    assert stream.sent == 2
+    assert stream.closed
+
+
+def test_uncancelled_stream_returns_the_final_message():
+    stream = FakeStream(["a", "b"])
+    transport, created = transport_with(stream)
+
+    response = transport.create_message(cancel_check=lambda: False, model="m", max_tokens=10, messages=[])
+
+    assert response.content[0].text == "ab"
+    assert stream.closed
+    assert not created
+
+
+def test_calls_without_cancel_check_are_not_streamed():
+    stream = FakeStream(["a"])
+    transport, created = transport_with(stream)
+
+    transport.create_message(model="m", max_tokens=10, messages=[])
+
+    assert created == [{"model": "m", "max_tokens": 10, "messages": []}]
+    assert stream.sent == 0
+
+
+def test_cancelled_call_is_never_sent():
+    stream = FakeStream(["a"])
+    transport, created = transport_with(stream)
+
+    with pytest.raises(CancelledError):
+        transport.create_message(cancel_check=lambda: True, model="m", max_tokens=10, messages=[])
+
+    assert stream.sent == 0
+    assert not created
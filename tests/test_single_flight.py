@@ -0,0 +1,135 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import SingleFlight
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+class Computation:
+    """
+    A computation that runs until released or cancelled, counting its runs.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.release = threading.Event()
+        self.cancel_events = []
+
+    def __call__(self, cancel_event):
+        self.runs += 1
+        self.cancel_events.append(cancel_event)
+        while not self.release.wait(0.01):
+            if cancel_event.is_set():
+                raise CancelledError("computation was cancelled")
+        return f"result {self.runs}"
+
+
+def call_in_thread(group, key, fn, **kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = group.do(key, fn, **kwargs)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def waiters(group, key):
+    with group.lock:
+        call = group.calls.get(key)
+        return call[2] if call else 0
+
+
+def test_concurrent_callers_share_one_run():
+    group = SingleFlight(max_workers=2)
+    computation = Computation()
+
+    first, first_outcome = call_in_thread(group, "key", computation)
+    wait_until(lambda: waiters(group, "key") == 1)
+    second, second_outcome = call_in_thread(group, "key", computation)
+    wait_until(lambda: waiters(group, "key") == 2)
+    computation.release.set()
+    first.join()
+    second.join()
+
+    assert first_outcome == second_outcome == {"result": "result 1"}
+    assert computation.runs == 1
+    assert group.calls == {}
+
+
+def test_last_caller_leaving_cancels_the_run():
+    group = SingleFlight(max_workers=2)
+    computation = Computation()
+    cancelled = threading.Event()
+
+    caller, outcome = call_in_thread(group, "key", computation, cancel_check=cancelled.is_set)
+    wait_until(lambda: computation.runs == 1)
+    cancelled.set()
+    caller.join()
+
+    assert isinstance(outcome["error"], CancelledError)
+    assert computation.cancel_events[0].is_set()
+    assert "key" not in group.calls
+
+
+def test_cancelled_caller_leaves_the_run_to_the_others():
+    group = SingleFlight(max_workers=2)
+    computation = Computation()
+    cancelled = threading.Event()
+
+    leaving, leaving_outcome = call_in_thread(group, "key", computation, cancel_check=cancelled.is_set)
+    wait_until(lambda: waiters(group, "key") == 1)
+    staying, staying_outcome = call_in_thread(group, "key", computation)
+    wait_until(lambda: waiters(group, "key") == 2)
+    cancelled.set()
+    leaving.join()
+
+    # The cancelled caller stops waiting at once, the run goes on for the other caller
+    assert isinstance(leaving_outcome["error"], CancelledError)
+    assert not computation.cancel_events[0].is_set()
+    computation.release.set()
+    staying.join()
+    assert staying_outcome == {"result": "result 1"}
+
+
+def test_callers_after_completion_run_again():
+    group = SingleFlight(max_workers=2)
+    computation = Computation()
+    computation.release.set()
+
+    results = [group.do("key", computation) for _ in range(20)]
+
+    assert results == [f"result {run}" for run in range(1, 21)]
+
+
+def test_failures_are_shared_and_forgotten():
+    group = SingleFlight(max_workers=2)
+    attempts = []
+
+    def fail(cancel_event):
+        attempts.append(cancel_event)
+        raise RuntimeError("boom")
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="boom"):
+            group.do("key", fail)
+
+    assert len(attempts) == 2
@@ -0,0 +1,77 @@
+import os
+import signal
+import subprocess
+import time
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import TerraformExecutor
+
+
+@pytest.fixture
+def executor(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    terraform = bin_dir / "terraform"
+    terraform.write_text("#!/bin/sh\nexit 0\n")
+    terraform.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    for name in ["TERRAFORM_WORKSPACE_ROOT", "TERRAFORM_LOG_DIR", "TERRAFORM_PLAN_DIR", "TF_PLUGIN_CACHE_DIR"]:
+        monkeypatch.setenv(name, str(tmp_path / name.lower()))
+    monkeypatch.setenv("TERRAFORM_KILL_GRACE_SECONDS", "2")
+    # Tests install the signal handler themselves and restore the original one
+    monkeypatch.setattr(TerraformExecutor, "shutdown_handler_installed", True)
+    return TerraformExecutor()
+
+
+def process_group_exists(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGTERM") or not hasattr(os, "killpg"), reason="needs POSIX signals")
+def test_sigterm_stops_the_running_process_groups(executor, monkeypatch):
+    received = []
+    original = signal.signal(signal.SIGTERM, lambda signum, frame: received.append(signum))
+    monkeypatch.setattr(TerraformExecutor, "shutdown_handler_installed", False)
+    # The shell waits in the foreground like terraform does for its provider plugins
+    process = subprocess.Popen(["sh", "-c", "sleep 60; exit 0"], start_new_session=True)
+    try:
+        assert TerraformExecutor.install_shutdown_handler()
+        with executor.running_processes_lock:
+            executor.running_processes[process.pid] = process
+
+        os.kill(os.getpid(), signal.SIGTERM)
+
+        # The previous handler still runs, e.g. gunicorn's graceful shutdown
+        assert received == [signal.SIGTERM]
+        process.wait(timeout=10)
+        deadline = time.monotonic() + 10
+        while process_group_exists(process.pid) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert not process_group_exists(process.pid)
+    finally:
+        signal.signal(signal.SIGTERM, original)
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def test_shutdown_handler_is_installed_once(executor, monkeypatch):
+    original = signal.getsignal(signal.SIGTERM)
+    monkeypatch.setattr(TerraformExecutor, "shutdown_handler_installed", False)
+    try:
+        assert TerraformExecutor.install_shutdown_handler()
+        handler = signal.getsignal(signal.SIGTERM)
+        assert TerraformExecutor.install_shutdown_handler()
+        assert signal.getsignal(signal.SIGTERM) is handler
+    finally:
+        signal.signal(signal.SIGTERM, original)
@@ -0,0 +1,195 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import TerraformGenerator
+
+
+class ScriptedTransport:
+    """
+    Stands in for ClaudeTransport, answering each request with the next scripted (text, stop reason).
+    """
+
+    mode = "passthrough"
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def create_message(self, timeout=None, cancel_check=None, **request):
+        self.requests.append(request)
+        text, stop_reason = self.responses.pop(0)
+        return response(text, stop_reason)
+
+
+def response(text, stop_reason="end_turn"):
+    return SimpleNamespace(content=[SimpleNamespace(text=text)] if text else [], stop_reason=stop_reason, usage=None)
+
+
+def generator_with(transport, monkeypatch, **settings):
+    for name, value in {"ANTHROPIC_GENERATION_MAX_CONTINUATIONS": "3", **settings}.items():
+        monkeypatch.setenv(name, value)
+    return TerraformGenerator(anthropic_api_key="test", transport=transport, fallback_model="fallback")
+
+
+@pytest.mark.parametrize("responses, expected", [
+    # Not truncated
+    ([('resource "a" "b" {}', "end_turn")], 'resource "a" "b" {}'),
+    # Cut mid-token
+    ([("resource \"a\" \"b\" {\n  na", "max_tokens"), ('me = "x"\n}', "end_turn")],
+     'resource "a" "b" {\n  name = "x"\n}'),
+    # Cut after a line break, the continuation starts the next line
+    ([("locals {\n", "max_tokens"), ("  a = 1\n}", "end_turn")], "locals {\n  a = 1\n}"),
+    ([("locals {\n", "max_tokens"), ("a = 1\n}", "end_turn")], "locals {\na = 1\n}"),
+    ([("locals {\n", "max_tokens"), ("\n  a = 1\n}", "end_turn")], "locals {\n  a = 1\n}"),
+    # Cut after the indentation of the next line
+    ([("locals {\n  ", "max_tokens"), ("a = 1\n}", "end_turn")], "locals {\n  a = 1\n}"),
+    ([("locals {\n  ", "max_tokens"), ("  a = 1\n}", "end_turn")], "locals {\n  a = 1\n}"),
+    ([("locals {\n  ", "max_tokens"), ("\n  a = 1\n}", "end_turn")], "locals {\n  a = 1\n}"),
+    # Cut before a space within a line
+    ([("a =", "max_tokens"), (" 1", "end_turn")], "a = 1"),
+    ([("a = ", "max_tokens"), ("1", "end_turn")], "a = 1"),
+    ([("a = ", "max_tokens"), (" 1", "end_turn")], "a = 1"),
+    # An empty continuation keeps the truncated output as it was
+    ([("locals {\n  ", "max_tokens"), ("", "end_turn")], "locals {\n  "),
+    # Several continuations
+    ([("a", "max_tokens"), ("b\n", "max_tokens"), ("  c", "max_tokens"), ("d", "end_turn")], "ab\n  cd"),
+])
+def test_continuations_are_stitched(monkeypatch, responses, expected):
+    transport = ScriptedTransport(responses)
+    generator = generator_with(transport, monkeypatch)
+
+    assert generator._generate_with_continuation("system", "prompt", 100) == expected
+
+    assert not transport.responses
+    for request in transport.requests[1:]:
+        # The API rejects a prefill ending in whitespace
+        prefill = request["messages"][-1]
+        assert prefill["role"] == "assistant" and prefill["content"] == prefill["content"].rstrip()
+
+
+def test_continuations_are_limited(monkeypatch):
+    transport = ScriptedTransport([("a", "max_tokens")] * 5)
+    generator = generator_with(transport, monkeypatch, ANTHROPIC_GENERATION_MAX_CONTINUATIONS="2")
+
+    assert generator._generate_with_continuation("system", "prompt", 100) == "aaa"
+    assert len(transport.requests) == 3
+
+
+VALID = '# main.tf\n```hcl\nresource "azurerm_resource_group" "main" {\n  name = "%s"\n}\n```'
+INVALID = '# main.tf\n```hcl\nresource "azurerm_resource_group" "main" {\n  name = "%s"\n```'
+
+
+class RacingTransport:
+    """
+    Stands in for ClaudeTransport, answering the n-th request to arrive with the n-th (delay, text)
+    and stopping early when the call is cancelled.
+    """
+
+    mode = "passthrough"
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.lock = threading.Lock()
+        self.started = []
+        self.cancelled = []
+
+    def create_message(self, timeout=None, cancel_check=None, **request):
+        with self.lock:
+            index = len(self.started)
+            self.started.append(time.monotonic())
+        delay, answer = self.answers[index]
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if cancel_check is not None and cancel_check():
+                self.cancelled.append(index)
+                raise CancelledError("cancelled")
+            time.sleep(0.01)
+        if isinstance(answer, Exception):
+            raise answer
+        return response(answer)
+
+
+def racing_generator(answers, monkeypatch, candidates, hedge_delay=0.0):
+    transport = RacingTransport(answers)
+    generator = generator_with(transport, monkeypatch, ANTHROPIC_GENERATION_CANDIDATES=str(candidates),
+                               ANTHROPIC_GENERATION_HEDGE_DELAY_SECONDS=str(hedge_delay))
+    return generator, transport
+
+
+def test_first_valid_candidate_wins(monkeypatch):
+    generator, transport = racing_generator(
+        [(2.0, VALID % "slow"), (0.05, INVALID % "fast"), (0.2, VALID % "medium")], monkeypatch, candidates=3)
+
+    assert generator._generate_candidates("system", "prompt", 100) == VALID % "medium"
+
+    # The slow candidate stops instead of running to the end
+    time.sleep(0.2)
+    assert transport.cancelled == [0]
+
+
+def test_hedged_candidate_only_starts_when_the_first_is_slow(monkeypatch):
+    generator, transport = racing_generator([(0.05, VALID % "first")], monkeypatch, candidates=2, hedge_delay=0.5)
+
+    assert generator._generate_candidates("system", "prompt", 100) == VALID % "first"
+    time.sleep(0.6)
+    assert len(transport.started) == 1
+
+    generator, transport = racing_generator(
+        [(2.0, VALID % "slow"), (0.05, VALID % "hedge")], monkeypatch, candidates=2, hedge_delay=0.3)
+
+    assert generator._generate_candidates("system", "prompt", 100) == VALID % "hedge"
+    assert transport.started[1] - transport.started[0] >= 0.3
+
+
+def test_all_rejected_candidates_return_the_first_finished(monkeypatch):
+    generator, _ = racing_generator([(0.3, INVALID % "later"), (0.05, INVALID % "first")], monkeypatch, candidates=2)
+
+    assert generator._generate_candidates("system", "prompt", 100) == INVALID % "first"
+
+
+def test_failed_candidates_raise_the_first_error(monkeypatch):
+    generator, _ = racing_generator([(0.05, RuntimeError("boom")), (0.1, RuntimeError("bang"))], monkeypatch,
+                                    candidates=2)
+    # No fallback model to retry with
+    generator.router.fallback_model = None
+
+    with pytest.raises(RuntimeError, match="boom"):
+        generator._generate_candidates("system", "prompt", 100)
+
+
+def test_cancelling_stops_every_candidate(monkeypatch):
+    generator, transport = racing_generator([(5.0, VALID % "a"), (5.0, VALID % "b")], monkeypatch, candidates=2)
+    cancel_event = threading.Event()
+    threading.Timer(0.2, cancel_event.set).start()
+
+    started = time.monotonic()
+    with pytest.raises(CancelledError):
+        generator._generate_candidates("system", "prompt", 100, cancel_event)
+
+    assert time.monotonic() - started < 2.0
+    time.sleep(0.2)
+    assert sorted(transport.cancelled) == [0, 1]
+
+
+@pytest.mark.parametrize("files, problem", [
+    ({"main.tf": 'resource "a" "b" {\n  x = 1\n}\n'}, None),
+    ({"main.tf": "# comments only\n", "locals.tf": "locals {}\n"}, None),
+    ({"main.tf": 'locals {\n  a = <<EOT\nhi\nEOT\n}\n'}, None),
+    ({}, "no Terraform files"),
+    ({"main.tf": "# comments only\n"}, "the Terraform files contain no blocks"),
+    ({"main.txt": "locals {}\n"}, "main.txt is not a Terraform file"),
+    ({"main.tf": 'resource "a" "b" {\n'}, "main.tf: 1 unclosed '{'"),
+    ({"main.tf": 'locals {\n  a = "abc\n}\n'}, "main.tf:2: unterminated string"),
+    ({"main.tf": "locals {\n  a = <<EOT\nhi\n}\n"}, "main.tf:2: unterminated heredoc EOT"),
+    ({"main.tf": "locals { a = [1, 2) }"}, "main.tf:1: expected ']' but found ')'"),
+])
+def test_check_syntax(files, problem):
+    assert TerraformGenerator.check_syntax(files) == problem
@@ -0,0 +1,232 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.mgmt.resource")
+
+from claude_terraform_agent import WorkspaceLockManager
+
+# Other processes are forked so they share the imported module without re-importing the tests
+fork = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+def queue_length(manager, workspace_id):
+    with manager.lock:
+        entry = manager.workspaces.get(workspace_id)
+        return len(entry["queue"]) if entry else 0
+
+
+def waiter_markers(manager, workspace_id):
+    try:
+        return os.listdir(manager._waiters_path(workspace_id))
+    except FileNotFoundError:
+        return []
+
+
+def test_waiters_acquire_in_arrival_order(tmp_path):
+    manager = WorkspaceLockManager(str(tmp_path))
+    order = []
+
+    def run(index):
+        with manager.hold("ws", timeout=5):
+            order.append(index)
+
+    threads = []
+    with manager.hold("ws"):
+        for index in range(4):
+            thread = threading.Thread(target=run, args=(index,))
+            thread.start()
+            threads.append(thread)
+            wait_until(lambda: queue_length(manager, "ws") == index + 2)
+    for thread in threads:
+        thread.join()
+
+    assert order == [0, 1, 2, 3]
+    assert manager.workspaces == {}
+
+
+def test_timed_out_waiter_leaves_the_queue(tmp_path):
+    manager = WorkspaceLockManager(str(tmp_path))
+
+    with manager.hold("ws"):
+        with pytest.raises(TimeoutError):
+            with manager.hold("ws", timeout=0.2):
+                pass
+        assert queue_length(manager, "ws") == 1
+
+    assert manager.workspaces == {}
+    assert manager.get_metrics()["timeouts"] == 1
+    with manager.hold("ws", timeout=0):
+        pass
+
+
+def test_cancelled_waiter_leaves_the_queue(tmp_path):
+    manager = WorkspaceLockManager(str(tmp_path))
+    cancelled = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            with manager.hold("ws", timeout=5, cancel_check=cancelled.is_set):
+                pass
+        except CancelledError as e:
+            errors.append(e)
+
+    with manager.hold("ws"):
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_until(lambda: queue_length(manager, "ws") == 2)
+        cancelled.set()
+        thread.join()
+        assert queue_length(manager, "ws") == 1
+
+    assert len(errors) == 1
+    assert manager.get_metrics()["cancellations"] == 1
+    assert manager.workspaces == {}
+
+
+@pytest.mark.parametrize("outcome", ["timeout", "cancel"])
+def test_waiting_on_another_holder_leaves_no_marker(tmp_path, outcome):
+    # Separate managers have separate lock files open, like separate processes
+    holder = WorkspaceLockManager(str(tmp_path))
+    waiter = WorkspaceLockManager(str(tmp_path))
+    cancelled = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            with waiter.hold("ws", timeout=0.5 if outcome == "timeout" else 5, cancel_check=cancelled.is_set):
+                pass
+        except (TimeoutError, CancelledError) as e:
+            errors.append(e)
+
+    with holder.hold("ws", background=True):
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_until(lambda: holder.interactive_waiting("ws"))
+        if outcome == "cancel":
+            cancelled.set()
+        thread.join()
+
+        assert waiter_markers(holder, "ws") == []
+        assert not holder.interactive_waiting("ws")
+    assert isinstance(errors[0], TimeoutError if outcome == "timeout" else CancelledError)
+    assert waiter.workspaces == {}
+
+
+def try_hold(manager, workspace_id, **kwargs):
+    try:
+        with manager.hold(workspace_id, **kwargs):
+            pass
+    except TimeoutError:
+        pass
+
+
+def test_background_holder_sees_interactive_waiters_in_the_process(tmp_path):
+    manager = WorkspaceLockManager(str(tmp_path))
+
+    with manager.hold("ws", background=True):
+        background = threading.Thread(target=try_hold, args=(manager, "ws"),
+                                      kwargs={"timeout": 1, "background": True})
+        background.start()
+        wait_until(lambda: queue_length(manager, "ws") == 2)
+        assert not manager.interactive_waiting("ws")
+
+        interactive = threading.Thread(target=try_hold, args=(manager, "ws"), kwargs={"timeout": 1})
+        interactive.start()
+        wait_until(lambda: manager.interactive_waiting("ws"))
+        interactive.join()
+        background.join()
+        assert not manager.interactive_waiting("ws")
+
+
+def test_markers_of_dead_processes_are_ignored(tmp_path):
+    manager = WorkspaceLockManager(str(tmp_path))
+    process = multiprocessing.get_context().Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    os.makedirs(manager._waiters_path("ws"))
+    open(os.path.join(manager._waiters_path("ws"), f"{process.pid}-stale"), 'w').close()
+
+    assert not manager.interactive_waiting("ws")
+    assert waiter_markers(manager, "ws") == []
+
+
+def wait_in_other_process(root, background, start, acquired):
+    start.wait(10)
+    with WorkspaceLockManager(root).hold("ws", timeout=10, background=background):
+        acquired.set()
+
+
+@fork
+@pytest.mark.parametrize("background", [False, True])
+def test_interactive_waiting_across_processes(tmp_path, background):
+    context = multiprocessing.get_context("fork")
+    manager = WorkspaceLockManager(str(tmp_path))
+    start = context.Event()
+    acquired = context.Event()
+    # Forked before the lock is taken, an inherited lock file descriptor would keep the lock held
+    process = context.Process(target=wait_in_other_process, args=(str(tmp_path), background, start, acquired))
+    process.start()
+
+    with manager.hold("ws", background=True):
+        start.set()
+        try:
+            if background:
+                # Background waiters don't announce themselves
+                time.sleep(0.5)
+                assert not manager.interactive_waiting("ws")
+            else:
+                wait_until(lambda: manager.interactive_waiting("ws"))
+            assert not acquired.is_set()
+        except BaseException:
+            process.kill()
+            raise
+
+    process.join(10)
+    assert acquired.is_set()
+    assert process.exitcode == 0
+    assert not manager.interactive_waiting("ws")
+
+
+def hold_repeatedly(root, held_path, rounds):
+    manager = WorkspaceLockManager(root)
+    overlaps = 0
+    for _ in range(rounds):
+        with manager.hold("ws", timeout=30):
+            try:
+                fd = os.open(held_path, os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                overlaps += 1
+                continue
+            os.close(fd)
+            time.sleep(0.005)
+            os.remove(held_path)
+    os._exit(min(overlaps, 100))
+
+
+@fork
+def test_processes_never_hold_a_workspace_together(tmp_path):
+    context = multiprocessing.get_context("fork")
+    held_path = str(tmp_path / "held")
+    processes = [context.Process(target=hold_repeatedly, args=(str(tmp_path), held_path, 20)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]